@@ -0,0 +1,148 @@
+"""
+Import-time and cold-start benchmark for the Lambda functions
+
+Runs every function in a fresh interpreter, the same way a new Lambda container does:
+* import time of the handler module, broken down with python -X importtime
+* duration of the first (cold) and second (warm) invocation with AWS and DB calls faked
+
+Requires the layer dependencies: pip install -r functions/layer/requirements.txt
+
+Usage:
+    python benchmarks/cold_start.py [--runs 5] [--engine mysql] [--top 10] [function ...]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+import fakes
+
+FUNCTIONS = [
+    'forward-create-event',
+    'forward-delete-event',
+    'create-user-function',
+    'delete-user-function',
+    'sns-notify-function',
+]
+
+def child(function, engine):
+    """
+    Runs inside a fresh interpreter, prints timings as JSON
+    """
+
+    fakes.add_paths(function)
+    # Handlers read their configuration at import time, the fakes are installed after to keep the layer unimported
+    fakes.set_env(engine)
+
+    started = time.perf_counter()
+    import handler
+    imported = time.perf_counter()
+
+    aws, _ = fakes.install(engine)
+    event = fakes.sample_event(function)
+    table = aws.table(os.environ['DDB_TABLE'])
+
+    def invoke():
+        # Delete function only touches the DB when the mapping exists
+        table['user-0001'] = {'userID': 'user-0001', 'username': 'jdoe'}
+        started = time.perf_counter()
+        handler.handler(event, None)
+        return time.perf_counter() - started
+
+    cold = invoke()
+    warm = invoke()
+
+    # A forwarder that skipped the event would only measure its early return
+    if function.startswith('forward-') and len(aws.events) != 2:
+        raise RuntimeError(f"{function} published {len(aws.events)} of 2 events")
+
+    print(json.dumps({
+        'import_ms': (imported - started) * 1000,
+        'cold_ms': cold * 1000,
+        'warm_ms': warm * 1000,
+        'modules': len(sys.modules),
+    }))
+
+def run_child(function, engine):
+    cmd = [sys.executable, __file__, '--child', function, '--engine', engine]
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    out = subprocess.run(cmd, capture_output=True, text=True, env=env)
+    if out.returncode != 0:
+        raise RuntimeError(f"{function} failed:\n{out.stderr}")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def import_breakdown(function, top):
+    """
+    Returns the slowest top level imports of the handler by cumulative time in ms
+    """
+
+    paths = [os.path.join(fakes.FUNCTIONS_DIR, function), fakes.LAYER_DIR]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(paths))
+    cmd = [sys.executable, '-X', 'importtime', '-c', 'import handler']
+    out = subprocess.run(cmd, capture_output=True, text=True, env=env, check=True)
+
+    lines = []
+    for line in out.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        lines.append((len(name) - len(name.lstrip()), int(cumulative) / 1000, name.strip()))
+
+    # Children are printed before their parent and indented one level deeper
+    end = max(i for i, line in enumerate(lines) if line[2] == 'handler')
+    depth = lines[end][0]
+    imports = [(lines[end][1], 'handler (total)')]
+    for indent, cumulative, name in reversed(lines[:end]):
+        if indent <= depth:
+            break
+        if indent == depth + 2:
+            imports.append((cumulative, name))
+
+    return sorted(imports, reverse=True)[:top]
+
+def summary(values):
+    return f"p50 {statistics.median(values):8.1f}  min {min(values):8.1f}  max {max(values):8.1f}"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('functions', nargs='*', default=FUNCTIONS)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--engine', choices=['mysql', 'postgres'], default='mysql')
+    parser.add_argument('--top', type=int, default=10, help="number of slowest imports to show")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.engine)
+        return
+
+    results = {}
+    for function in args.functions:
+        runs = [run_child(function, args.engine) for _ in range(args.runs)]
+        results[function] = {
+            key: [run[key] for run in runs] for key in ('import_ms', 'cold_ms', 'warm_ms')
+        }
+        results[function]['imports'] = import_breakdown(function, args.top)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for function, result in results.items():
+        print(f"\n{function} ({args.runs} runs, {args.engine}), ms")
+        print(f"  import handler   {summary(result['import_ms'])}")
+        print(f"  cold invocation  {summary(result['cold_ms'])}")
+        print(f"  warm invocation  {summary(result['warm_ms'])}")
+        print("  slowest imports (cumulative ms):")
+        for cumulative, name in result['imports']:
+            print(f"    {cumulative:8.1f}  {name}")
+
+if __name__ == '__main__':
+    main()
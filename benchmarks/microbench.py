@@ -0,0 +1,326 @@
+"""
+Per-phase microbenchmark for the create and delete user functions and SQLExecutor
+
+Runs the real handlers in-process against fake DB-API connections and a fake DynamoDB table
+with configurable injected latency, and reports for every phase:
+* calls and mean time per event
+* p50 and p99 of the time spent in the phase per event
+and p50/p99 of the event totals
+
+Phases:
+* token - IAM authentication token (real signing, cached by the layer)
+* connect - driver connect without the token
+* sql:<kind> - DB round trips by statement kind (exists, create, grant, create+grant, drop, ...)
+* ddb:<operation> - DynamoDB calls (get_item, put_item, batch_write_item, ...)
+* other - time not spent in any of the above
+
+Time of calls running in parallel threads (e.g. several DB targets) is added up,
+so phases can exceed the event total.
+
+Scenarios:
+* create - new user per event
+* redeliver - the same create event delivered again for a managed user
+* delete - managed user removed from the group
+* batch - SQS batch of --batch-size create events
+* executor - SQLExecutor provision_batch, existing_users and drop_batch for --batch-size users
+
+Requires the layer dependencies: pip install -r functions/layer/requirements.txt
+
+Usage:
+    python benchmarks/microbench.py [--events 200] [--engine mysql] [--connect-ms 20] [--query-ms 2] [scenario ...]
+"""
+import os
+import re
+import sys
+import json
+import time
+import types
+import logging
+import argparse
+import threading
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+import fakes
+
+sys.path.insert(0, fakes.LAYER_DIR)
+
+SCENARIOS = ['create', 'redeliver', 'delete', 'batch', 'executor']
+
+class Profiler:
+    """
+    Accumulates self time per phase for the current event
+    Nested phases are subtracted from the enclosing one, timers are kept per thread
+    """
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.times = Counter()
+        self.calls = Counter()
+
+    def reset(self):
+        self.times = Counter()
+        self.calls = Counter()
+
+    def wrap(self, func, phase):
+        """
+        Returns func timed as the phase, phase can be a callable of the call arguments
+        """
+
+        def timed(*args, **kwargs):
+            name = phase(*args, **kwargs) if callable(phase) else phase
+            stack = self.local.__dict__.setdefault('stack', [])
+            stack.append(0.0)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - started
+                nested = stack.pop()
+                if stack:
+                    stack[-1] += duration
+                with self.lock:
+                    self.times[name] += duration - nested
+                    self.calls[name] += 1
+
+        timed.wrapped = func
+        return timed
+
+def sql_phase(cursor, query, params=None):
+    """
+    Classifies a DB round trip by the statements it contains
+    """
+
+    if 'mysql.user' in query or 'pg_user' in query:
+        return 'sql:exists'
+    if 'role_edges' in query or 'pg_auth_members' in query:
+        return 'sql:roles'
+    if query.startswith('SELECT 1'):
+        return 'sql:ping'
+    if 'CREATE USER' in query and 'GRANT' in query:
+        return 'sql:create+grant'
+
+    verb = query.split(None, 1)[0].rstrip(';').lower()
+    if verb == 'begin':
+        verb = query.split(None, 2)[1].rstrip(';').lower()
+
+    return f"sql:{verb}"
+
+def aws_phase(aws, service, operation, params):
+    # PutItem -> put_item, same as the boto3 method names
+    name = re.sub(r'(?<!^)(?=[A-Z])', '_', operation).lower()
+    return f"{'ddb' if service == 'dynamodb' else service}:{name}"
+
+def instrument(profiler):
+    """
+    Wraps the layer and fakes with profiler timers
+    """
+
+    import connection_manager
+
+    def unwrap(func):
+        return getattr(func, 'wrapped', func)
+
+    connection_manager.get_auth_token = profiler.wrap(unwrap(connection_manager.get_auth_token), 'token')
+    # Token time is nested, so connect is only the driver connect
+    connection_manager.get_db_connection = profiler.wrap(unwrap(connection_manager.get_db_connection), 'connect')
+    fakes.FakeCursor.execute = profiler.wrap(unwrap(fakes.FakeCursor.execute), sql_phase)
+    fakes.FakeAWS.call = profiler.wrap(unwrap(fakes.FakeAWS.call), aws_phase)
+
+def reset_connections(modules):
+    """
+    Drops cached connections and tokens, like a new Lambda container
+    """
+
+    import connection_manager
+
+    connection_manager.TOKEN_CACHE.clear()
+    for module in modules:
+        module.DB_CONN.close()
+        module.DB_CONN = connection_manager.ClusterConnections()
+
+def build_scenario(name, args, aws, dbs):
+    """
+    Returns (run, modules) where run(i) processes event number i
+    """
+
+    table = aws.table(os.environ['DDB_TABLE'])
+
+    def seed(user_id, user_name):
+        table[user_id] = {'userID': user_id, 'username': user_name}
+        for db in dbs:
+            db.users.add(user_name)
+            db.grants.setdefault(user_name, set()).add('DBA')
+
+    if name in ('create', 'redeliver', 'batch'):
+        create = fakes.load_handler('create-user-function')
+
+        if name == 'create':
+            def run(i):
+                create.handler(fakes.sample_event(
+                    'create-user-function', user_id=f"c-{i}", user_name=f"create_{i}"
+                ), None)
+
+        elif name == 'redeliver':
+            seed('r-0', 'redeliver_0')
+
+            def run(i):
+                create.handler(fakes.sample_event(
+                    'create-user-function', user_id='r-0', user_name='redeliver_0'
+                ), None)
+
+        else:
+            def run(i):
+                records = [
+                    {'messageId': str(n), 'body': json.dumps(fakes.sample_event(
+                        'create-user-function', user_id=f"b-{i}-{n}", user_name=f"batch_{i}_{n}"
+                    ))}
+                    for n in range(args.batch_size)
+                ]
+                resp = create.handler({'Records': records}, None)
+                if resp['batchItemFailures']:
+                    raise RuntimeError(f"Batch failed: {resp['batchItemFailures']}")
+
+        return run, [create]
+
+    if name == 'delete':
+        delete = fakes.load_handler('delete-user-function')
+
+        def run(i):
+            seed(f"d-{i}", f"delete_{i}")
+            delete.handler(fakes.sample_event('delete-user-function', user_id=f"d-{i}"), None)
+
+        return run, [delete]
+
+    if name == 'executor':
+        import connection_manager
+
+        # Exposes DB_CONN like the handlers, so --cold works the same way
+        state = types.SimpleNamespace(DB_CONN=connection_manager.ClusterConnections())
+
+        def run(i):
+            executor = state.DB_CONN.executor()
+            pairs = [(f"exec_{i}_{n}", 'DBA') for n in range(args.batch_size)]
+            user_names = [user_name for user_name, _ in pairs]
+            executor.existing_users(user_names, friendly_name="select users")
+            executor.provision_batch(pairs, friendly_name="provision users")
+            executor.drop_batch(user_names, friendly_name="drop users")
+
+        return run, [state]
+
+    raise ValueError(f"Unknown scenario {name}")
+
+def percentile(values, pct):
+    # Nearest rank
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(round(pct / 100 * len(values))) - 1))]
+
+def run_scenario(name, args, profiler, aws, dbs):
+    run, modules = build_scenario(name, args, aws, dbs)
+
+    # Warm up clients and connections outside of the measurements
+    run(-1)
+
+    totals = []
+    phases = []
+    calls = Counter()
+
+    for i in range(args.events):
+        if args.cold:
+            reset_connections(modules)
+        profiler.reset()
+        started = time.perf_counter()
+        run(i)
+        total = time.perf_counter() - started
+
+        times = Counter(profiler.times)
+        times['other'] = max(0.0, total - sum(times.values()))
+        totals.append(total)
+        phases.append(times)
+        calls.update(profiler.calls)
+
+    names = sorted({phase for times in phases for phase in times}, key=lambda phase: (phase == 'other', phase))
+    result = {'events': args.events, 'phases': {}}
+
+    for phase in names:
+        values = [times.get(phase, 0.0) * 1000 for times in phases]
+        result['phases'][phase] = {
+            'calls': calls[phase] / args.events,
+            'mean_ms': sum(values) / len(values),
+            'p50_ms': percentile(values, 50),
+            'p99_ms': percentile(values, 99),
+        }
+
+    values = [total * 1000 for total in totals]
+    result['total'] = {
+        'mean_ms': sum(values) / len(values),
+        'p50_ms': percentile(values, 50),
+        'p99_ms': percentile(values, 99),
+        'events_per_s': len(totals) / sum(totals),
+    }
+
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', default=SCENARIOS, help=f"any of {', '.join(SCENARIOS)}")
+    parser.add_argument('--events', type=int, default=200)
+    parser.add_argument('--engine', choices=['mysql', 'postgres'], default='mysql')
+    parser.add_argument('--targets', type=int, default=1, help="number of fake DB clusters")
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--cold', action='store_true', help="new DB connection and token for every event")
+    parser.add_argument('--connect-ms', type=float, default=0.0, help="median DB connect latency")
+    parser.add_argument('--query-ms', type=float, default=0.0, help="median DB round trip latency")
+    parser.add_argument('--ddb-ms', type=float, default=0.0, help="median DynamoDB call latency")
+    parser.add_argument('--p99-factor', type=float, default=3.0, help="p99 latency as a multiple of the median")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    fakes.set_latency(**{
+        phase: fakes.lognormal(median / 1000, median * args.p99_factor / 1000)
+        for phase, median in (('connect', args.connect_ms), ('query', args.query_ms), ('ddb', args.ddb_ms))
+    })
+
+    os.environ['RDS_DB_ENGINE'] = args.engine
+    # Per-invocation metrics lines would be printed between the results
+    os.environ['METRICS_ENABLED'] = 'false'
+    dbs = [fakes.FakeDB(args.engine) for _ in range(args.targets)]
+    if args.targets > 1:
+        hosts = [f"db{n}.cluster-fake.us-east-1.rds.amazonaws.com" for n in range(args.targets)]
+        os.environ['RDS_DB_TARGETS'] = json.dumps([
+            {'name': f"cluster-{n}", 'engine': args.engine, 'endpoint': host, 'user': 'sso_provisioner'}
+            for n, host in enumerate(hosts)
+        ])
+        aws, _ = fakes.install(args.engine, db=dict(zip(hosts, dbs)))
+    else:
+        aws, _ = fakes.install(args.engine, db=dbs[0])
+
+    # Handler logging would dominate the measurements
+    logging.disable(logging.CRITICAL)
+
+    profiler = Profiler()
+    instrument(profiler)
+
+    results = {name: run_scenario(name, args, profiler, aws, dbs) for name in args.scenarios}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for name, result in results.items():
+        print(f"\n{name} ({result['events']} events, {args.engine}, {args.targets} target(s){', cold' if args.cold else ''})")
+        print(f"  {'phase':<22}{'calls':>7}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        for phase, stats in result['phases'].items():
+            print(f"  {phase:<22}{stats['calls']:>7.2f}{stats['mean_ms']:>10.2f}{stats['p50_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+        total = result['total']
+        print(f"  {'total':<22}{'':>7}{total['mean_ms']:>10.2f}{total['p50_ms']:>10.2f}{total['p99_ms']:>10.2f}")
+        print(f"  {total['events_per_s']:.0f} events/s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,483 @@
+"""
+End-to-end load generator and replay harness for the event pipeline
+
+Drives CloudTrail events through the real handlers, the same way EventBridge does:
+* AddMemberToGroup goes to forward-create-event, RemoveMemberFromGroup and DeleteUser to forward-delete-event
+* every event the forwarders put on the bus is delivered to create-user-function or delete-user-function
+  after --bus-ms, with a new event ID like EventBridge
+* failed invocations are retried up to --retries times after --retry-delay seconds, like Lambda async retries
+
+AWS APIs and DB drivers are replaced by the in-process fakes with lognormal latency models.
+Every function runs on --concurrency worker threads, each thread is a separate container
+with its own DB connections.
+
+Events are either generated (--events at --rate per second with the --mix of event types,
+over --users users who join at most one of the configured groups) or replayed from a JSON lines
+file of CloudTrail events (--replay), keeping their relative timing scaled by --speed.
+--record saves the generated events in the same format.
+
+Reports throughput, end-to-end and per-function latency percentiles, queue wait, outcomes per
+event type, the most frequent errors and the drift between the expected and the actual DB users.
+
+Requires the layer dependencies: pip install -r functions/layer/requirements.txt
+
+Usage:
+    python benchmarks/replay.py [--events 1000] [--rate 100] [--mix add=90,remove=8,delete=2] [--concurrency 10]
+    python benchmarks/replay.py --users 10000 --events 10000 --rate 200 --mix add=100
+    python benchmarks/replay.py --replay events.jsonl --speed 10
+"""
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import logging
+import argparse
+import threading
+from datetime import datetime, timezone
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+import fakes
+
+sys.path.insert(0, fakes.LAYER_DIR)
+
+IDENTITY_STORE_ID = 'd-1234567890'
+
+FORWARDERS = {
+    'AddMemberToGroup': 'forward-create-event',
+    'RemoveMemberFromGroup': 'forward-delete-event',
+    'DeleteUser': 'forward-delete-event',
+}
+
+# Source of the forwarded events to the function the bus rule targets
+TARGETS = {
+    'Lambda function: forward-create-event': 'create-user-function',
+    'Lambda function: forward-delete-event': 'delete-user-function',
+}
+
+MIX_NAMES = {'add': 'AddMemberToGroup', 'remove': 'RemoveMemberFromGroup', 'delete': 'DeleteUser'}
+
+class PipelineAWS(fakes.FakeAWS):
+    """
+    FakeAWS that also keeps the events put on the bus by the current thread
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbox = threading.local()
+
+    def events_PutEvents(self, params):
+        resp = super().events_PutEvents(params)
+        sent = self.outbox.__dict__.setdefault('entries', [])
+        sent += [entry for entry, result in zip(params['Entries'], resp['Entries']) if 'ErrorCode' not in result]
+        return resp
+
+    def take_outbox(self):
+        entries = self.outbox.__dict__.get('entries', [])
+        self.outbox.entries = []
+        return entries
+
+class PerContainer:
+    """
+    Gives every worker thread its own instance, like separate Lambda containers
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        instance = self.local.__dict__.get('instance')
+        if instance is None:
+            instance = self.local.instance = self.factory()
+        return getattr(instance, name)
+
+def cloudtrail_event(event_name, user_id, group_id, at):
+    """
+    Returns CloudTrail event in the format EventBridge delivers it to the forwarders
+    """
+
+    if event_name == 'AddMemberToGroup':
+        params = {'groupId': group_id, 'identityStoreId': IDENTITY_STORE_ID, 'member': {'memberId': user_id}}
+    elif event_name == 'RemoveMemberFromGroup':
+        params = {'groupId': group_id, 'identityStoreId': IDENTITY_STORE_ID, 'memberId': user_id}
+    else:
+        params = {'identityStoreId': IDENTITY_STORE_ID, 'userId': user_id}
+
+    return {
+        'source': 'aws.sso-directory',
+        'detail-type': 'AWS API Call via CloudTrail',
+        # Milliseconds keep the spacing of the events when replayed
+        'time': datetime.fromtimestamp(at, timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z'),
+        'detail': {'eventSource': 'sso-directory.amazonaws.com', 'eventName': event_name, 'requestParameters': params},
+    }
+
+def parse_mix(text):
+    """
+    Returns list of (event name, weight) from add=90,remove=8,delete=2
+    """
+
+    mix = []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in MIX_NAMES:
+            raise ValueError(f"Unknown event type {name}, use {', '.join(MIX_NAMES)}")
+        mix.append((MIX_NAMES[name], float(weight or 1)))
+    return mix
+
+def generate(args, group_ids):
+    """
+    Returns list of (offset in seconds, CloudTrail event)
+    Users join at most one group, removes and deletes pick current members when there are any
+    """
+
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    names, weights = zip(*mix)
+
+    free = [f"u-{i:06d}" for i in range(args.users)]
+    rng.shuffle(free)
+    members = {}
+    started = time.time()
+    offset = 0.0
+    events = []
+
+    for _ in range(args.events):
+        event_name = rng.choices(names, weights)[0]
+
+        # Nothing to remove yet, or everybody already joined
+        if event_name != 'AddMemberToGroup' and not members:
+            event_name = 'AddMemberToGroup'
+        if event_name == 'AddMemberToGroup' and not free:
+            event_name = 'RemoveMemberFromGroup'
+
+        if event_name == 'AddMemberToGroup':
+            user_id = free.pop()
+            group_id = rng.choice(group_ids)
+            members[user_id] = group_id
+        else:
+            user_id = rng.choice(list(members))
+            group_id = members.pop(user_id)
+            # Joins again last, an immediate re-add would race the remove
+            free.insert(0, user_id)
+
+        events.append((offset, cloudtrail_event(event_name, user_id, group_id, started + offset)))
+        offset += rng.expovariate(args.rate) if args.poisson else 1.0 / args.rate
+
+    return events
+
+def load_replay(path, speed, rate):
+    """
+    Returns list of (offset in seconds, CloudTrail event) from a JSON lines file
+    Keeps the relative timing of the events, scaled by speed, or sends them at rate if they have no time
+    """
+
+    with open(path, encoding='utf-8') as log:
+        events = [json.loads(line) for line in log if line.strip()]
+
+    def parse_time(event):
+        value = event.get('time') or event.get('detail', {}).get('eventTime')
+        if not value:
+            return None
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+    times = [parse_time(event) for event in events]
+    if None in times or speed <= 0:
+        return [(i / rate, event) for i, event in enumerate(events)]
+
+    first = min(times)
+    # Stable sort, events logged in the same second keep their order
+    return sorted([((at - first) / speed, event) for at, event in zip(times, events)], key=lambda item: item[0])
+
+def expected_users(events, user_names):
+    """
+    Returns usernames that should exist in the DB after all events in order of their time
+    """
+
+    members = {}
+    for _, event in events:
+        details = event['detail']
+        params = details['requestParameters']
+        if details['eventName'] == 'AddMemberToGroup':
+            members[params['member']['memberId']] = params['groupId']
+        elif details['eventName'] == 'RemoveMemberFromGroup':
+            members.pop(params['memberId'], None)
+        else:
+            members.pop(params['userId'], None)
+
+    return {user_names.get(user_id, f"user-{user_id}") for user_id in members}
+
+def percentile(values, pct):
+    # Nearest rank
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(round(pct / 100 * len(values))) - 1))]
+
+def stats(values):
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 50),
+        'p90_ms': percentile(values, 90),
+        'p99_ms': percentile(values, 99),
+        'max_ms': max(values, default=0.0),
+    }
+
+class Pipeline:
+    """
+    Schedules invocations of the functions on their worker pools
+    Forwarder results are delivered to the target functions, failures are retried
+    """
+    def __init__(self, args, aws, handlers, bus_latency):
+        self.args = args
+        self.aws = aws
+        self.handlers = handlers
+        self.bus_latency = bus_latency
+        self.pools = {name: ThreadPoolExecutor(max_workers=args.concurrency) for name in handlers}
+        self.queue = []
+        self.sequence = 0
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        self.rng = random.Random(args.seed)
+        self.deliveries = 0
+
+        self.records = []
+        self.durations = {name: [] for name in handlers}
+        self.waits = {name: [] for name in handlers}
+        self.errors = Counter()
+
+    def schedule(self, due, function, record, event):
+        with self.cond:
+            self.sequence += 1
+            heapq.heappush(self.queue, (due, self.sequence, function, record, event, 0))
+            self.cond.notify()
+
+    def retry(self, function, record, event, attempt):
+        with self.cond:
+            self.sequence += 1
+            due = time.monotonic() + self.args.retry_delay
+            heapq.heappush(self.queue, (due, self.sequence, function, record, event, attempt))
+            self.cond.notify()
+
+    def run(self, events):
+        started = time.monotonic()
+
+        for offset, event in events:
+            record = {
+                'event_name': event['detail']['eventName'], 'arrival': started + offset,
+                'pending': 1, 'outcome': None, 'finished': None, 'retries': 0,
+            }
+            self.records.append(record)
+            self.schedule(started + offset, FORWARDERS[record['event_name']], record, event)
+
+        with self.cond:
+            while self.queue or self.in_flight:
+                now = time.monotonic()
+                if self.queue and self.queue[0][0] <= now:
+                    due, _, function, record, event, attempt = heapq.heappop(self.queue)
+                    self.in_flight += 1
+                    self.pools[function].submit(self.invoke, due, function, record, event, attempt)
+                    continue
+                self.cond.wait(self.queue[0][0] - now if self.queue else None)
+
+        for pool in self.pools.values():
+            pool.shutdown()
+
+        return time.monotonic() - started
+
+    def invoke(self, due, function, record, event, attempt):
+        started = time.monotonic()
+        error = None
+
+        try:
+            self.handlers[function].handler(event, None)
+        except Exception as err:
+            error = err
+
+        finished = time.monotonic()
+        entries = self.aws.take_outbox()
+
+        with self.cond:
+            self.waits[function].append((started - due) * 1000)
+            self.durations[function].append((finished - started) * 1000)
+
+            if error is not None and attempt < self.args.retries:
+                record['retries'] += 1
+                self.in_flight -= 1
+                self.retry(function, record, event, attempt + 1)
+                return
+
+            if error is not None:
+                message = str(error).splitlines()[0] if str(error) else type(error).__name__
+                self.errors[f"{function}: {message}"] += 1
+                record['outcome'] = 'failed'
+
+            # Every forwarded event is a separate delivery to the target function
+            for entry in entries:
+                self.deliveries += 1
+                record['pending'] += 1
+                delivered = {
+                    'id': f"replay-{self.deliveries}",
+                    'source': entry['Source'],
+                    'detail-type': entry['DetailType'],
+                    'time': event.get('time'),
+                    'detail': json.loads(entry['Detail']),
+                }
+                self.sequence += 1
+                heapq.heappush(self.queue, (
+                    finished + self.bus_delay(), self.sequence, TARGETS[entry['Source']], record, delivered, 0
+                ))
+
+            # Forwarder decided the event doesn't need any change
+            if error is None and not entries and function in FORWARDERS.values():
+                record['outcome'] = record['outcome'] or 'filtered'
+
+            record['pending'] -= 1
+            if record['pending'] == 0:
+                record['outcome'] = record['outcome'] or 'ok'
+                record['finished'] = finished
+
+            self.in_flight -= 1
+            self.cond.notify()
+
+    def bus_delay(self):
+        return self.bus_latency() if callable(self.bus_latency) else self.bus_latency
+
+def build_report(pipeline, events, elapsed, db, user_names):
+    records = pipeline.records
+    latencies = [(record['finished'] - record['arrival']) * 1000 for record in records if record['finished']]
+
+    outcomes = {}
+    for record in records:
+        counts = outcomes.setdefault(record['event_name'], Counter())
+        counts[record['outcome'] or 'unfinished'] += 1
+        counts['retries'] += record['retries']
+
+    expected = expected_users(events, user_names)
+    actual = set(db.users)
+
+    return {
+        'events': len(records),
+        'duration_s': elapsed,
+        'offered_rate': (len(events) - 1) / max(events[-1][0], 1e-9) if len(events) > 1 else 0.0,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'end_to_end': stats(latencies),
+        'functions': {
+            name: {'invocations': len(pipeline.durations[name]), 'duration': stats(pipeline.durations[name]),
+                   'queue_wait': stats(pipeline.waits[name])}
+            for name in pipeline.handlers
+        },
+        'outcomes': {name: dict(counts) for name, counts in outcomes.items()},
+        'errors': dict(pipeline.errors.most_common(10)),
+        'drift': {'missing': len(expected - actual), 'unexpected': len(actual - expected)},
+    }
+
+def print_report(report):
+    print(f"\n{report['events']} events, offered {report['offered_rate']:.0f}/s, "
+          f"finished in {report['duration_s']:.1f}s, {report['throughput']:.0f} events/s")
+
+    print(f"\n  {'latency ms':<28}{'count':>8}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+    rows = [('end to end', report['end_to_end'])]
+    for name, result in report['functions'].items():
+        rows.append((name, result['duration']))
+        rows.append(("  queue wait", result['queue_wait']))
+    for name, result in rows:
+        print(f"  {name:<28}{result['count']:>8}{result['p50_ms']:>10.1f}{result['p90_ms']:>10.1f}"
+              f"{result['p99_ms']:>10.1f}{result['max_ms']:>10.1f}")
+
+    print("\n  outcomes")
+    for name, counts in report['outcomes'].items():
+        print(f"  {name:<28}" + ", ".join(f"{outcome} {count}" for outcome, count in sorted(counts.items())))
+
+    if report['errors']:
+        print("\n  errors")
+        for message, count in report['errors'].items():
+            print(f"  {count:>6}  {message}")
+
+    drift = report['drift']
+    print(f"\n  drift: {drift['missing']} users missing, {drift['unexpected']} unexpected users in the DB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=100.0, help="events per second")
+    parser.add_argument('--poisson', action='store_true', help="exponential inter-arrival times instead of constant")
+    parser.add_argument('--mix', default='add=90,remove=8,delete=2', help="weights of add, remove and delete events")
+    parser.add_argument('--users', type=int, default=10000, help="size of the generated user population")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--replay', help="JSON lines file of CloudTrail events to replay instead of generating")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed-up, 0 sends events at --rate")
+    parser.add_argument('--record', help="save the generated events as JSON lines")
+    parser.add_argument('--engine', choices=['mysql', 'postgres'], default='mysql')
+    parser.add_argument('--concurrency', type=int, default=10, help="concurrent executions per function")
+    parser.add_argument('--retries', type=int, default=2, help="retries of failed invocations")
+    parser.add_argument('--retry-delay', type=float, default=1.0, help="seconds before a retry")
+    parser.add_argument('--connect-ms', type=float, default=20.0, help="median DB connect latency")
+    parser.add_argument('--query-ms', type=float, default=2.0, help="median DB round trip latency")
+    parser.add_argument('--ddb-ms', type=float, default=5.0, help="median DynamoDB call latency")
+    parser.add_argument('--events-ms', type=float, default=15.0, help="median PutEvents latency")
+    parser.add_argument('--identitystore-ms', type=float, default=30.0, help="median DescribeUser latency")
+    parser.add_argument('--bus-ms', type=float, default=250.0, help="median EventBridge delivery latency")
+    parser.add_argument('--p99-factor', type=float, default=3.0, help="p99 latency as a multiple of the median")
+    parser.add_argument('--put-events-error-rate', type=float, default=0.0, help="share of throttled PutEvents entries")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+
+    def model(median_ms):
+        return fakes.lognormal(median_ms / 1000, median_ms * args.p99_factor / 1000)
+
+    fakes.set_latency(
+        connect=model(args.connect_ms), query=model(args.query_ms), ddb=model(args.ddb_ms),
+        events=model(args.events_ms), identitystore=model(args.identitystore_ms),
+    )
+
+    os.environ['RDS_DB_ENGINE'] = args.engine
+    # Per-invocation metrics lines would be printed between the results
+    os.environ['METRICS_ENABLED'] = 'false'
+
+    group_roles = {'group-dba': 'DBA', 'group-ro': 'RO'}
+    os.environ['IDENTITYSTORE_GROUP_IDS'] = json.dumps(group_roles)
+
+    user_names = {f"u-{i:06d}": f"user_{i:06d}" for i in range(args.users)}
+    aws = PipelineAWS(user_names=user_names)
+    rng = random.Random(args.seed)
+    aws.reject_event = lambda entry: rng.random() < args.put_events_error_rate
+    db = fakes.FakeDB(args.engine, roles=group_roles.values())
+    fakes.install(args.engine, aws=aws, db=db)
+
+    if args.replay:
+        events = load_replay(args.replay, args.speed, args.rate)
+    else:
+        events = generate(args, list(group_roles))
+
+    if args.record:
+        with open(args.record, 'w', encoding='utf-8') as log:
+            for _, event in events:
+                log.write(json.dumps(event) + '\n')
+
+    # Handler logging would dominate the measurements
+    logging.disable(logging.CRITICAL)
+
+    import connection_manager
+
+    handlers = {}
+    for function in list(dict.fromkeys(FORWARDERS.values())) + list(TARGETS.values()):
+        handlers[function] = fakes.load_handler(function)
+        if hasattr(handlers[function], 'DB_CONN'):
+            handlers[function].DB_CONN = PerContainer(connection_manager.ClusterConnections)
+
+    pipeline = Pipeline(args, aws, handlers, model(args.bus_ms))
+    elapsed = pipeline.run(events)
+    report = build_report(pipeline, events, elapsed, db, user_names)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print_report(report)
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,118 @@
+import json
 import logging
 import connection_manager
-from sql_executor import SQLExecutor as SE
+import idempotency
+import mapping_store
+import metrics
+import user_sync
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-DB_CONN = None
-DB_ENGINE = None
+DB_CONN = connection_manager.ClusterConnections()
 DDB_TABLE = None
+MEMBER_TABLE = None
 
+@metrics.instrument_handler
+@connection_manager.release_connections
 def handler(event, context):
     """Handler function, entry point for Lambda"""
 
-    global DB_CONN
-    global DB_ENGINE
-    global DDB_TABLE
+    global DDB_TABLE, MEMBER_TABLE
 
-    details = event['detail']
+    # Batch mode, e.g. SQS records with EventBridge events in the body
+    if 'Records' in event:
+        return handle_batch(event['Records'])
+
+    user_name, user_id, role_names = parse_details(event['detail'])
+
+    # Duplicate deliveries return before any DB connection is opened
+    idempotency_key = idempotency.get_event_key('create', event, [user_name, user_id, role_names])
+    if not idempotency.claim(idempotency_key):
+        logger.info("Event %s was already processed, skipping", event.get('id'))
+        return {"status": "Success"}
+
+    try:
+        # Init DynamoDB table if doesn't exist
+        if DDB_TABLE is None:
+            DDB_TABLE = connection_manager.get_ddb_table()
+            MEMBER_TABLE = connection_manager.get_member_table()
+
+        # Init DB executor for all DB targets, (re)connects if a connection doesn't exist or is stale
+        executor = DB_CONN.executor()
+
+        user_sync.sync_user(
+            user_name, user_id, role_names, executor, DDB_TABLE,
+            group_ids=parse_group_ids(event['detail']), member_table=MEMBER_TABLE
+        )
+    # Let retries process the event again
+    except Exception:
+        idempotency.release(idempotency_key)
+        raise
+
+    idempotency.complete(idempotency_key)
+
+    return {"status": "Success"}
+
+def handle_batch(records):
+    """
+    Provisions users from a batch of records in as few DB round trips as possible
+    Skips records this container already processed, only the in-process cache is checked
+    Returns partial batch response listing the failed record IDs
+    """
+
+    global DDB_TABLE, MEMBER_TABLE
+
+    failed = []
+    users = []
+    keys = {}
+    group_ids = {}
+
+    for record in records:
+        record_id = record.get('messageId')
+        try:
+            body = json.loads(record['body'])
+            user = parse_details(body['detail'])
+            group_ids[record_id] = parse_group_ids(body['detail'])
+        except Exception as err:
+            logger.error("Failed to parse record %s", record_id)
+            logger.error(err)
+            failed.append(record_id)
+            continue
+
+        keys[record_id] = idempotency.get_event_key('create', body, list(user))
+        if idempotency.is_processed(keys[record_id]):
+            logger.info("Event %s was already processed, skipping", body.get('id'))
+            continue
+
+        users.append((record_id, *user))
+
+    if users:
+        # Init DynamoDB table if doesn't exist
+        if DDB_TABLE is None:
+            DDB_TABLE = connection_manager.get_ddb_table()
+            MEMBER_TABLE = connection_manager.get_member_table()
+
+        executor = DB_CONN.executor()
+        failed_users = sync_users(users, executor, DDB_TABLE)
+        failed_users += record_memberships(
+            [(record_id, user_id) for record_id, _, user_id, _ in users if record_id not in failed_users],
+            group_ids, MEMBER_TABLE
+        )
+        failed += failed_users
+
+        for record_id, *_ in users:
+            if record_id not in failed_users:
+                idempotency.complete(keys[record_id], shared=False)
+
+    logger.info("Processed %d records, %d failed", len(records), len(failed))
+
+    return {"batchItemFailures": [{"itemIdentifier": record_id} for record_id in failed]}
+
+def parse_details(details):
+    """
+    Returns username, user ID and list of role names from the event details
+    Raises exception if any of them is missing
+    """
 
     # Required details
     user_name = details.get("user_name")
@@ -28,161 +125,258 @@ def handler(event, context):
         logger.error(details)
         raise ValueError("Username, id or role name is missing in the event")
 
-    # Init DynamoDB table if doesn't exist
-    if DDB_TABLE is None:
-        DDB_TABLE = connection_manager.get_ddb_table()
+    # Roles of all configured groups of the user, events of older forwarders carry a single role
+    return user_name, user_id, details.get("role_names") or [role_name]
 
-    # Init DB connection if doesn't exist
-    if DB_CONN is None:
-        DB_CONN, DB_ENGINE = connection_manager.get_db_connection()
+def parse_group_ids(details):
+    """
+    Returns IDs of the configured groups the user is a member of
+    Events of older forwarders carry only the group of the event
+    """
 
-    # Init DB executor
-    executor = SE(DB_CONN, DB_ENGINE)
+    return details.get("group_ids") or [group_id for group_id in [details.get("group_id")] if group_id]
+
+def record_memberships(users, group_ids, member_table):
+    """
+    Records group memberships of the provisioned users with batched writes
+    users is list of (record_id, user_id), group_ids dict of record ID to group IDs
+    Users skipped as unmanaged are recorded too, deleting their group finds no mapping for them
+    Returns list of failed record IDs, their users are already provisioned and managed
+    """
+
+    if member_table is None or not users:
+        return []
+
+    memberships = [
+        (group_id, user_id) for record_id, user_id in users for group_id in group_ids[record_id]
+    ]
+
+    try:
+        mapping_store.put_memberships(member_table, memberships)
+    except Exception as err:
+        logger.error("Failed to save group memberships to DDB")
+        logger.error(err)
+        return [record_id for record_id, _ in users]
 
-    # Check if the user exists in the db
-    managed_user = False
-    user_exists = check_if_user_exists(user_name, executor)
+    return []
+
+def sync_users(users, executor, ddb_table):
+    """
+    Creates users and grants roles for a list of (record_id, user_name, user_id, role_names)
+    Provisions all users with a single batch call
+    Falls back to one user at a time if the batch fails
+    Returns list of failed record IDs
+    """
+
+    to_provision = []
+    # Users to create per DB target, a managed user can be missing on some of them
+    new_users = {target: {} for target in executor.targets}
+
+    existing = check_existing_users([user_name for _, user_name, _, _ in users], executor)
+
+    def exists_on(target, user_name):
+        return existing is None or user_name in existing[target]
+
+    def exists_anywhere(user_name):
+        return any(exists_on(target, user_name) for target in new_users)
 
     # Check if managed (exists in DynamoDB) only when exists in the db
-    if user_exists:
-        managed_user = check_if_managed_user(user_id, user_name, DDB_TABLE)
+    managed = check_managed_users(
+        [user_id for _, user_name, user_id, _ in users if exists_anywhere(user_name)],
+        ddb_table
+    )
+
+    # Unmanaged users created by this solution lost their mapping to an interrupted call
+    owned = check_owned_users(
+        [user_name for _, user_name, user_id, _ in users if exists_anywhere(user_name) and user_id not in managed],
+        executor
+    )
+
+    def owned_everywhere(user_name):
+        return owned is not None and all(
+            user_name in owned[target] for target in new_users if exists_on(target, user_name)
+        )
 
-    # If user exists but not managed, don't modify it
-    if user_exists and not managed_user:
-        logger.error("User already exists in the database, but not managed. Exiting")
-        return {"status": "Success"}
+    for record_id, user_name, user_id, role_names in users:
+        user_exists = exists_anywhere(user_name)
+        managed_user = user_exists and user_id in managed
+
+        # If user exists but not managed, don't modify it
+        if user_exists and not managed_user and not owned_everywhere(user_name):
+            logger.error("User %s already exists in the database, but not managed. Skipping", user_name)
+            continue
 
-    # Safe to delete on rollback by default
-    safe_to_delete = True
-    # Not safe to delete if user already exists
-    if user_exists and managed_user:
-        logger.warning("User already exists in the database")
-        safe_to_delete = False
+        # Only users that didn't exist before are created and safe to delete
+        for target, target_users in new_users.items():
+            if not exists_on(target, user_name):
+                target_users[user_name] = True
+
+        to_provision.append((record_id, user_name, user_id, role_names, managed_user))
+
+    if not to_provision:
+        return []
+
+    pairs = [
+        (user_name, role_name) for _, user_name, _, role_names, _ in to_provision for role_name in role_names
+    ]
 
-    # Create user in the db
     try:
-        create_db_user(user_name, executor)
+        logger.info("Provisioning %d users on %d DB targets", len(to_provision), len(new_users))
+        executor.each(lambda target, target_executor: target_executor.provision_batch(
+            pairs, friendly_name="provision users", new_users=list(new_users[target])
+        ))
     except Exception as err:
-        logger.error("Failed to create user in the db")
+        logger.error("Batch provisioning failed, falling back to one user at a time")
         logger.error(err)
-        raise Exception("Failed to create user in the db") from err
+        # Start from a clean state, some statements might have been committed
+        rollback_batch(created_users(err, new_users), executor)
+        return sync_each(to_provision, executor, ddb_table)
+
+    # Add user mappings to DynamoDB in batches
+    mappings = {
+        user_id: user_name
+        for _, user_name, user_id, _, managed_user in to_provision
+        if not managed_user
+    }
 
-    # Grant role to the user
     try:
-        grant_role(user_name, role_name, executor)
+        create_user_mappings(mappings, ddb_table)
+        return []
     except Exception as err:
-        logger.error("Failed to grant role. Does the role %s exist in the DB?", role_name)
+        logger.error("Batch mapping failed, falling back to one mapping at a time")
         logger.error(err)
-        # Rollback if user didn't exist before
-        if safe_to_delete:
-            rollback(user_name, executor)
-            logger.info("Changes rolled back")
-        # Otherwise it's not safe to delete user
-        else:
-            logger.info("Not safe to rollback. Not deleting the user")
-        raise Exception("Failed to grant role") from err
-
-    # Add user mapping to DynamoDB if it doesn't exist
-    if not managed_user:
+
+    failed = []
+    mapped = {}
+
+    # Add user mappings to DynamoDB, once per user ID
+    for record_id, user_name, user_id, _, managed_user in to_provision:
+        if managed_user:
+            continue
+
+        if user_id not in mapped:
+            try:
+                user_sync.create_user_mapping(user_id=user_id, user_name=user_name, ddb_table=ddb_table)
+                mapped[user_id] = True
+            # Rollback on error
+            except Exception as err:
+                logger.error(err)
+                logger.info("Rolling back changes for user %s", user_name)
+                user_sync.rollback(user_name, executor)
+                mapped[user_id] = False
+
+        if not mapped[user_id]:
+            failed.append(record_id)
+
+    return failed
+
+def sync_each(to_provision, executor, ddb_table):
+    """
+    Provisions users one at a time
+    Returns list of failed record IDs
+    """
+
+    failed = []
+
+    for record_id, user_name, user_id, role_names, _ in to_provision:
         try:
-            create_user_mapping(user_id=user_id, user_name=user_name, ddb_table=DDB_TABLE)
-        # Rollback on error
+            user_sync.sync_user(user_name, user_id, role_names, executor, ddb_table)
         except Exception as err:
-            logger.info("Rolling back changes")
-            rollback(user_name, executor)
+            logger.error("Failed to provision user %s", user_name)
             logger.error(err)
-            raise Exception("Failed to create user in DynamoDB") from err
+            failed.append(record_id)
 
-    return {"status": "Success"}
+    return failed
 
-def rollback(user_name, executor):
+def created_users(err, new_users):
     """
-    Deletes database user
+    Returns dict of target name to the users a failed batch created there
+    Targets that succeeded created all their new users, failed ones report what they committed
     """
 
-    logger.info("Deleting user %s from the DB", user_name)
-    executor.drop(user_name, friendly_name="drop user")
-    logging.info("Deleted user from the database")
+    errors = getattr(err, 'errors', {})
+
+    return {
+        target: getattr(errors[target], 'created', []) if target in errors else target_users
+        for target, target_users in new_users.items()
+    }
 
-def grant_role(user_name, role, executor):
+def rollback_batch(new_users, executor):
     """
-    Grants role to the user
+    Deletes database users in a single statement per DB target
+    new_users is dict of target name to the users created there
     """
 
-    logger.info("Granting role %s to user %s", role, user_name)
-    executor.grant(user_name, role, friendly_name="grant role")
-    logger.info("Successfully granted role to the user")
+    if not any(new_users.values()):
+        return
+
+    logger.info("Deleting new users from %d DB targets", len(new_users))
+    executor.each(lambda target, target_executor: target_executor.drop_batch(
+        list(new_users[target]), friendly_name="drop users"
+    ))
+    logger.info("Deleted users from the database")
 
-def create_db_user(user_name, executor):
+def check_existing_users(user_names, executor):
     """
-    Creates MySQL user
-    Grants role to the user
+    Checks which users exist on every DB target with a set-based query
+    Returns dict of target name to set of existing user names
+    Returns None if it couldn't be determined, callers must assume all users exist
     """
 
-    logger.info("Creating user %s in the DB", user_name)
-    executor.create(user_name, friendly_name="create user")
-    logger.info("Created RDS user %s", user_name)
+    try:
+        return executor.existing_users(user_names, friendly_name="select users")
+    except Exception as err:
+        logger.warning("Couldn't determine whether the users already exist in the DB")
+        logger.warning(err)
+        logger.warning("Assuming users exist as a fail-safe")
+        return None
 
-def check_if_user_exists(user_name, executor):
+def check_owned_users(user_names, executor):
     """
-    Checks if user exists in the database
+    Checks which users were created by this solution on every DB target
+    Returns dict of target name to set of owned user names
+    Returns None if it couldn't be determined, callers must assume no user is owned
     """
 
-    user_exists = False
+    if not user_names:
+        return {target: set() for target in executor.targets}
 
     try:
-        row_count = executor.count_rows(user_name, friendly_name="select user")
-        if row_count >= 1:
-            user_exists = True
-    except Exception:
-        logger.warning("Couldn't determine whether the user already exists in the DB")
-        logger.warning("Assuming user exists as a fail-safe")
-        user_exists = True
-
-    return user_exists
+        return executor.owned_users(user_names, friendly_name="select owned users")
+    except Exception as err:
+        logger.warning("Couldn't determine whether the users were created by this solution")
+        logger.warning(err)
+        return None
 
-def check_if_managed_user(user_id, user_name, ddb_table):
+def check_managed_users(user_ids, ddb_table):
     """
-    Checks if user mapping already exists in DynamoDB
-    This allows to determine whether the user is managed by the solution or not
+    Checks which user mappings already exist in DynamoDB using batched reads
+    Returns set of managed user IDs
     """
 
-    logger.info("Fetching user %s from DDB", user_name)
-    managed_user = False
+    if not user_ids:
+        return set()
+
+    logger.info("Fetching %d users from DDB", len(user_ids))
 
     try:
-        resp = ddb_table.get_item(
-            Key={
-                'userID': user_id
-            }
-        )
-        user_data = resp.get('Item')
-        # If record exists in DDB, the user is managed
-        if user_data is not None:
-            managed_user = True
-    # Keep user as not managed as a fail-safe
+        return set(mapping_store.get_user_names(ddb_table, user_ids))
+    # Keep users as not managed as a fail-safe
     except Exception as err:
-        logger.error("Failed to get user mapping from DDB")
+        logger.error("Failed to get user mappings from DDB")
         logger.error(err)
-        logger.warning("Assuming the user is not managed")
+        logger.warning("Assuming the users are not managed")
+        return set()
 
-    return managed_user
-
-def create_user_mapping(user_id, user_name, ddb_table):
+def create_user_mappings(mappings, ddb_table):
     """
-    Creates user ID to username mapping in DynamoDB
-    Manages DDB connections
+    Creates user ID to username mappings in DynamoDB using batched writes
     Raises exception if not successful
     """
 
-    logger.info("Creating user ID to username mapping in DDB for user %s", user_name)
+    if not mappings:
+        return
 
-    try:
-        item = {'userID': user_id, 'username': user_name}
-        ddb_table.put_item(Item=item)
-    except Exception as err:
-        logger.error("Failed to save user mapping to DDB")
-        logger.error(err)
-        raise Exception("Failed to save user mapping to DDB") from err
+    logger.info("Creating %d user ID to username mappings in DDB", len(mappings))
+    mapping_store.put_mappings(ddb_table, mappings)
 
-    logger.info("Successfully created user ID to username mapping")
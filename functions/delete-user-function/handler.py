@@ -1,22 +1,26 @@
 import logging
 import connection_manager
-from sql_executor import SQLExecutor as SE
+import idempotency
+import metrics
+import user_sync
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-DB_CONN = None
-DB_ENGINE = None
+DB_CONN = connection_manager.ClusterConnections()
 DDB_TABLE = None
+MEMBER_TABLE = None
 
+@metrics.instrument_handler
+@connection_manager.release_connections
 def handler(event, context):
     """Handler function, entry point for Lambda"""
 
-    global DB_CONN
-    global DB_ENGINE
-    global DDB_TABLE
-
     details = event['detail']
 
+    # Deleted group, all recorded members are offboarded in one pass
+    if details.get("event_type") == 'DeleteGroup':
+        return handle_group_delete(event, details)
+
     # One specific group will trigger RDS user creation
     user_id = details.get("user_id")
 
@@ -25,93 +29,72 @@ def handler(event, context):
         logger.info("User doesn't belong to the specified group, skipping")
         return {"status": "Success"}
 
-    # Inint DynamoDB table if doesn't exist
-    if DDB_TABLE is None:
-        DDB_TABLE = connection_manager.get_ddb_table()
+    # Duplicate deliveries return before any DB connection is opened
+    # Without this, a duplicate fails because the first delivery deleted the mapping
+    idempotency_key = idempotency.get_event_key('delete', event, [user_id, details.get("event_type")])
+    if not idempotency.claim(idempotency_key):
+        logger.info("Event %s was already processed, skipping", event.get('id'))
+        return {"status": "Success"}
 
-    # Get username from DynamoDB
-    user_name = get_user_name(user_id, DDB_TABLE)
-    event_name = details.get("event_type")
+    try:
+        result = delete_user(user_id, details)
+    # Let retries process the event again
+    except Exception:
+        idempotency.release(idempotency_key)
+        raise
 
-    # Event type is required
-    if event_name is None:
-        logger.error("Event type not found")
-        logger.error(details)
-        raise ValueError("Event type is required but not found")
+    idempotency.complete(idempotency_key)
 
-    # When removing member from a group, it's expected to be recorded in DDB
-    if event_name == 'RemoveMemberFromGroup' and user_name is None:
-        raise Exception("Removing member from a group, but username not found in DynamoDB")
+    return result
 
-    # Return if username mapping not in DDB
-    if user_name is None:
-        logger.warning("Username not found, nothing to delete")
-        return {"status": "Success"}
+def handle_group_delete(event, details):
+    """
+    Deletes all recorded members of the deleted group
+    Returns the result of every member
+    Raises exception if any member failed, a retry processes only the remaining ones
+    """
 
-    # Init DB connection if doesn't exist
-    if DB_CONN is None:
-        DB_CONN, DB_ENGINE = connection_manager.get_db_connection()
+    group_id = details.get("group_id")
 
-    # Init DB executor
-    executor = SE(DB_CONN, DB_ENGINE)
+    if group_id is None:
+        logger.error("Event missing required parameter")
+        raise ValueError("Group ID is missing in the event")
 
-    # Delete user from SQL DB and DDB
-    delete_db_user(user_name, executor)
-    delete_user_mapping(user_id, DDB_TABLE)
+    idempotency_key = idempotency.get_event_key('delete', event, [group_id, details.get("event_type")])
+    if not idempotency.claim(idempotency_key):
+        logger.info("Event %s was already processed, skipping", event.get('id'))
+        return {"status": "Success"}
 
-    return {"status": "Success"}
+    try:
+        init_tables()
+        results = user_sync.delete_group(group_id, DDB_TABLE, MEMBER_TABLE, DB_CONN.executor)
+    # Let retries process the event again
+    except Exception:
+        idempotency.release(idempotency_key)
+        raise
 
-def get_user_name(user_id, ddb_table):
-    """
-    Returns username from DynamoDB table if exists
-    Returns None otherwise
-    Raises exceptions on errors
-    """
+    idempotency.complete(idempotency_key)
 
-    logger.info("Retrieving user ID %s from DynamoDB", user_id)
+    return {"status": "Success", "results": results}
 
-    try:
-        resp = ddb_table.get_item(
-            Key={
-                'userID': user_id
-            }
-        )
-        data = resp['Item']
-        logger.info(data)
-        user_name = data['username']
-    except KeyError:
-        logger.warning("User ID %s not found in DDB", user_id)
-        return None
-    except Exception as err:
-        raise Exception("Failed to get user mapping from DDB") from err
-
-    logger.info("Found username %s", user_name)
-    return user_name
-
-def delete_db_user(user_name, executor):
+def delete_user(user_id, details):
     """
-    Deletes user from MySQL database if exists
+    Deletes user from the DB, the user mapping and group memberships
+    Raises exceptions on errors
     """
 
-    logger.info("Deleting user %s from the DB", user_name)
-    executor.drop(user_name, friendly_name="drop user")
-    logger.info("Deleted RDS user %s", user_name)
+    init_tables()
+    user_sync.delete_user(user_id, details.get("event_type"), DDB_TABLE, DB_CONN.executor, MEMBER_TABLE)
 
-def delete_user_mapping(user_id, ddb_table):
+    return {"status": "Success"}
+
+def init_tables():
     """
-    Deletes user ID to username mapping from DynamoDB
-    Raises exceptions on errors
+    Inits DynamoDB tables if they don't exist
     """
 
-    logger.info("Retrieving user ID %s from DynamoDB", user_id)
+    global DDB_TABLE, MEMBER_TABLE
 
-    try:
-        ddb_table.delete_item(
-            Key={
-                'userID': user_id
-            }
-        )
-    except Exception as err:
-        raise Exception("Failed to delete user mapping from DDB") from err
-
-    logger.info("Deleted user mapping from DynamoDB")
+    if DDB_TABLE is None:
+        DDB_TABLE = connection_manager.get_ddb_table()
+        MEMBER_TABLE = connection_manager.get_member_table()
@@ -1,20 +1,52 @@
 import os
+import time
 import logging
 import json
-import boto3
+from collections import OrderedDict
+import aws_clients
+import event_publisher
+import metrics
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# In-process cache of Identity Store users, kept across warm invocations
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', '300'))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '1024'))
+# Optional DynamoDB table shared between containers, with TTL enabled on expiresAt
+USER_CACHE_TABLE = os.environ.get('USER_CACHE_TABLE')
+# IsMemberInGroups accepts up to 100 group IDs per call
+MEMBERSHIP_BATCH_SIZE = 100
+
+USER_CACHE = OrderedDict()
+CACHE_STATS = {'hits': 0, 'shared_hits': 0, 'misses': 0}
+CACHE_TABLE = None
+
+def load_group_roles():
+    """
+    Returns dict of configured group ID to role name from IDENTITYSTORE_GROUP_IDS
+    Raises exception if not valid
+    """
+
+    try:
+        group_roles = json.loads(os.environ.get('IDENTITYSTORE_GROUP_IDS', '{}'))
+    except ValueError as err:
+        raise Exception("IDENTITYSTORE_GROUP_IDS is not valid JSON. Please check env variables") from err
+
+    if not isinstance(group_roles, dict):
+        raise Exception("IDENTITYSTORE_GROUP_IDS must be an object of group ID to role name. Please check env variables")
+
+    return group_roles
+
+# Parsed once per container, events of other groups are filtered with a dict lookup
+GROUP_ROLES = load_group_roles()
+GROUP_IDS = sorted(GROUP_ROLES)
+
+@metrics.instrument_handler
 def handler(event, context):
     """Handler function, entry point for Lambda"""
 
-    group_ids = json.loads(os.environ.get('IDENTITYSTORE_GROUP_IDS'))
-    event_group_id = event['detail']['requestParameters']['groupId']
-    user_name, user_id = get_user_info(event['detail'])
-    role_name = group_ids[event_group_id]
-
     target_bus = os.environ.get('DEST_BUS_NAME')
 
     # Target bus is required in env
@@ -22,41 +54,103 @@ def handler(event, context):
         logger.info("Missing target event bus in ENV")
         raise ValueError("Target bus not specified")
 
+    # Batch mode, e.g. SQS records with CloudTrail events in the body
+    if 'Records' in event:
+        return handle_batch(event['Records'], target_bus)
+
+    modified_event = build_event(event)
+
     # User does not exist or not in the specified group ID
-    if user_name is None:
+    if modified_event is None:
         logger.info("Not adding user to RDS")
         return {"status": "Success"}
 
-    modified_event = {
+    # Send event to the target bus
+    publish_event(modified_event, target_bus)
+    logger.info("Forwarded create event for user %s", modified_event['user_name'])
+
+    return {"status": "Success"}
+
+def handle_batch(records, bus_name):
+    """
+    Forwards a batch of records with as few PutEvents calls as possible
+    Returns partial batch response listing the failed record IDs
+    """
+
+    failed = []
+    entries = []
+    record_ids = []
+
+    for record in records:
+        record_id = record.get('messageId')
+        try:
+            modified_event = build_event(json.loads(record['body']))
+        except Exception as err:
+            logger.error("Failed to parse record %s", record_id)
+            logger.error(err)
+            failed.append(record_id)
+            continue
+
+        if modified_event is not None:
+            entries.append(to_entry(modified_event, bus_name))
+            record_ids.append(record_id)
+
+    failed += [record_ids[i] for i in event_publisher.publish_events(entries)]
+    logger.info("Forwarded %d create events, %d records failed", len(entries), len(failed))
+
+    return {"batchItemFailures": [{"itemIdentifier": record_id} for record_id in failed]}
+
+def build_event(event):
+    """
+    Returns the event to forward with username, user ID, role name of the group
+    and role names and IDs of all configured groups the user is a member of
+    Returns None if the group isn't configured or the user doesn't exist
+    """
+
+    event_group_id = event['detail']['requestParameters']['groupId']
+
+    # Checked before any Identity Store call
+    if event_group_id not in GROUP_ROLES:
+        logger.info("Group %s is not configured, skipping", event_group_id)
+        return None
+
+    user_name, user_id = get_user_info(event['detail'])
+
+    if user_name is None:
+        return None
+
+    identitystore_id = event['detail']['requestParameters']['identityStoreId']
+    group_ids = get_member_groups(identitystore_id, user_id, event_group_id)
+
+    return {
         "user_name": user_name,
         "user_id": user_id,
-        "role_name": role_name,
+        "role_name": GROUP_ROLES[event_group_id],
+        # Every event of the user carries the complete set, so their order doesn't matter downstream
+        "role_names": sorted({GROUP_ROLES[group_id] for group_id in group_ids}),
         "group_id": event_group_id,
+        # Recorded as group memberships, so a deleted group can be offboarded
+        "group_ids": sorted(group_ids),
         "event_type": event['detail']['eventName']
     }
 
-    # Send event to the target bus
-    publish_event(modified_event, target_bus)
-    logger.info("Forwarded create event for user %s", user_name)
-
-    return {"status": "Success"}
+def to_entry(modified_event, bus_name):
+    return event_publisher.make_entry(
+        'Lambda function: forward-create-event',
+        modified_event['event_type'],
+        modified_event,
+        bus_name
+    )
 
 def publish_event(modified_event, bus_name):
     """
     Forwards event to the specified event bus
+    Raises exception if EventBridge doesn't accept the event after retries
     """
-    event_client = boto3.client('events')
+
     logger.info("Forwarding user details to the event bus")
-    event_client.put_events(
-            Entries=[
-                {
-                    'Source': 'Lambda function: forward-create-event',
-                    'DetailType': modified_event['event_type'],
-                    'Detail': json.dumps(modified_event),
-                    'EventBusName': bus_name
-                },
-            ]
-        )
+    if event_publisher.publish_events([to_entry(modified_event, bus_name)]):
+        raise Exception("Failed to forward event to the event bus")
 
 def get_user_info(event_details):
     """
@@ -71,10 +165,13 @@ def get_user_info(event_details):
     logger.info("Received new add user to group event with user_id %s", user_id)
 
     identitystore_id = event_details['requestParameters']['identityStoreId']
-    client = boto3.client('identitystore')
+
+    user_name = get_cached_user_name(identitystore_id, user_id)
+    if user_name is not None:
+        return user_name, user_id
 
     logger.info("Fetching user ID from Identity Store")
-    user_data = client.describe_user(
+    user_data = get_identitystore_client().describe_user(
         IdentityStoreId=identitystore_id,
         UserId=user_id
     )
@@ -85,4 +182,128 @@ def get_user_info(event_details):
 
     user_name = user_data.get('UserName', None)
 
+    if user_name is not None:
+        cache_user_name(identitystore_id, user_id, user_name)
+
     return user_name, user_id
+
+def get_member_groups(identitystore_id, user_id, event_group_id):
+    """
+    Returns set of the configured group IDs the user is a member of, always including the event group
+    Memberships are looked up for every event, removals are handled by another function
+    and a cached lookup could grant the role of a group the user was just removed from
+    Falls back to the event group only if the lookup fails
+    """
+
+    # Nothing else to look up
+    if len(GROUP_IDS) == 1:
+        return {event_group_id}
+
+    client = get_identitystore_client()
+    group_ids = {event_group_id}
+
+    try:
+        for start in range(0, len(GROUP_IDS), MEMBERSHIP_BATCH_SIZE):
+            resp = client.is_member_in_groups(
+                IdentityStoreId=identitystore_id,
+                MemberId={'UserId': user_id},
+                GroupIds=GROUP_IDS[start:start + MEMBERSHIP_BATCH_SIZE]
+            )
+            group_ids |= {
+                result['GroupId'] for result in resp.get('Results', []) if result.get('MembershipExists')
+            }
+    except Exception as err:
+        logger.warning("Failed to check group memberships of user %s, forwarding the event group only", user_id)
+        logger.warning(err)
+        return group_ids
+
+    logger.info("User %s is a member of %d configured groups", user_id, len(group_ids))
+    return group_ids
+
+def get_identitystore_client():
+    """
+    Returns Identity Store client cached for the lifetime of the container
+    """
+
+    return aws_clients.get_client('identitystore')
+
+def get_cache_table():
+    """
+    Returns shared DynamoDB cache table if configured
+    Returns None otherwise
+    """
+
+    global CACHE_TABLE
+
+    if USER_CACHE_TABLE and CACHE_TABLE is None:
+        CACHE_TABLE = aws_clients.get_resource('dynamodb').Table(USER_CACHE_TABLE)
+
+    return CACHE_TABLE
+
+def get_cached_user_name(identitystore_id, user_id):
+    """
+    Returns username from the in-process cache or the shared DynamoDB cache
+    Returns None on cache miss
+    """
+
+    key = f"{identitystore_id}#{user_id}"
+    now = time.time()
+    cached = USER_CACHE.get(key)
+
+    if cached is not None and cached[1] > now:
+        USER_CACHE.move_to_end(key)
+        CACHE_STATS['hits'] += 1
+        log_cache_stats()
+        return cached[0]
+
+    table = get_cache_table()
+    if table is not None:
+        try:
+            item = table.get_item(Key={'cacheKey': key}).get('Item')
+            # Expired items can still be returned until DynamoDB deletes them
+            if item is not None and int(item['expiresAt']) > now:
+                remember(key, item['username'], int(item['expiresAt']))
+                CACHE_STATS['shared_hits'] += 1
+                log_cache_stats()
+                return item['username']
+        except Exception as err:
+            logger.warning("Failed to read shared user cache")
+            logger.warning(err)
+
+    CACHE_STATS['misses'] += 1
+    log_cache_stats()
+    return None
+
+def cache_user_name(identitystore_id, user_id, user_name):
+    """
+    Stores username in the in-process cache and the shared DynamoDB cache
+    """
+
+    key = f"{identitystore_id}#{user_id}"
+    expires_at = int(time.time()) + USER_CACHE_TTL
+    remember(key, user_name, expires_at)
+
+    table = get_cache_table()
+    if table is not None:
+        try:
+            table.put_item(Item={'cacheKey': key, 'username': user_name, 'expiresAt': expires_at})
+        except Exception as err:
+            logger.warning("Failed to write shared user cache")
+            logger.warning(err)
+
+def remember(key, user_name, expires_at):
+    """
+    Adds username to the in-process cache, evicting the least recently used entries
+    """
+
+    USER_CACHE[key] = (user_name, expires_at)
+    USER_CACHE.move_to_end(key)
+
+    while len(USER_CACHE) > USER_CACHE_SIZE:
+        USER_CACHE.popitem(last=False)
+
+def log_cache_stats():
+    logger.info(
+        "User cache hits: %d, shared hits: %d, misses: %d",
+        CACHE_STATS['hits'], CACHE_STATS['shared_hits'], CACHE_STATS['misses']
+    )
@@ -1,12 +1,29 @@
 import os
 import logging
 import json
-import boto3
+import event_publisher
+import metrics
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+def load_group_ids():
+    """
+    Returns dict of configured group ID to role name from IDENTITYSTORE_GROUP_IDS
+    Returns None if not configured
+    Raises exception if not valid
+    """
+
+    try:
+        return json.loads(os.environ.get('IDENTITYSTORE_GROUP_IDS', 'null'))
+    except ValueError as err:
+        raise Exception("IDENTITYSTORE_GROUP_IDS is not valid JSON. Please check env variables") from err
+
+# Parsed once per container
+GROUP_IDS = load_group_ids()
+
+@metrics.instrument_handler
 def handler(event, context):
     """Handler function, entry point for Lambda"""
 
@@ -17,24 +34,92 @@ def handler(event, context):
         logger.info("Missing target event bus in ENV")
         raise ValueError("Target bus not specified")
 
-    # One specific group will trigger RDS user creation
-    user_id = get_user_id(event['detail'])
+    # Batch mode, e.g. SQS records with CloudTrail events in the body
+    if 'Records' in event:
+        return handle_batch(event['Records'], target_bus)
+
+    modified_event = build_event(event)
 
     # User does not exist or not in the specified group ID
-    if user_id is None:
+    if modified_event is None:
         logger.info("User doesn't belong to the specified group, skipping")
         return {"status": "Success"}
 
-    modified_event = {
+    # Send the event to the target bus
+    publish_event(modified_event, target_bus)
+    logger.info("Forwarded %s event", modified_event['event_type'])
+
+    return {"status": "Success"}
+
+def handle_batch(records, bus_name):
+    """
+    Forwards a batch of records with as few PutEvents calls as possible
+    Returns partial batch response listing the failed record IDs
+    """
+
+    failed = []
+    entries = []
+    record_ids = []
+
+    for record in records:
+        record_id = record.get('messageId')
+        try:
+            modified_event = build_event(json.loads(record['body']))
+        except Exception as err:
+            logger.error("Failed to parse record %s", record_id)
+            logger.error(err)
+            failed.append(record_id)
+            continue
+
+        if modified_event is not None:
+            entries.append(to_entry(modified_event, bus_name))
+            record_ids.append(record_id)
+
+    failed += [record_ids[i] for i in event_publisher.publish_events(entries)]
+    logger.info("Forwarded %d delete events, %d records failed", len(entries), len(failed))
+
+    return {"batchItemFailures": [{"itemIdentifier": record_id} for record_id in failed]}
+
+def build_event(event):
+    """
+    Returns the event to forward with user ID, or group ID if the group was deleted
+    Returns None if the user or the group doesn't belong to the configured groups
+    """
+
+    # Members of a deleted group aren't listed in the event, they're looked up downstream
+    if event['detail']['eventName'] == 'DeleteGroup':
+        return build_group_event(event['detail'])
+
+    # One specific group will trigger RDS user creation
+    user_id = get_user_id(event['detail'])
+
+    if user_id is None:
+        return None
+
+    return {
         "user_id": user_id,
         "event_type": event['detail']['eventName']
     }
 
-    # Send the event to the target bus
-    publish_event(modified_event, target_bus)
-    logger.info("Forwarded delete event for user id %s", user_id)
+def build_group_event(event_details):
+    """
+    Returns the event to forward with group ID
+    Returns None if the group isn't configured
+    """
 
-    return {"status": "Success"}
+    group_id = event_details['requestParameters']['groupId']
+
+    logger.info("Received new delete group event with group_id %s", group_id)
+
+    # Can't check the group if group IDs are not specified
+    if GROUP_IDS is not None and group_id not in GROUP_IDS:
+        logger.info("Configured group doesn't match")
+        return None
+
+    return {
+        "group_id": group_id,
+        "event_type": event_details['eventName']
+    }
 
 def get_user_id(event_details):
     """
@@ -47,27 +132,28 @@ def get_user_id(event_details):
     check_group = True
     group_matches = True
 
-    group_ids = json.loads(os.environ.get('IDENTITYSTORE_GROUP_IDS'))
-
     # Can't check group membership if group ID is not specified
-    if group_ids is None:
+    if GROUP_IDS is None:
         logger.warning("Group ID is not specified in env, skipping group checks")
         check_group = False
 
     # Removing user from a group
-    if event_type == 'RemoveMemberFromGroup' and check_group:
+    if event_type == 'RemoveMemberFromGroup':
         user_id = event_details['requestParameters']['memberId']
         event_name = "remove user from group"
 
         # Check group membership when group ID is configured
         if check_group:
             _group_id = event_details['requestParameters']['groupId']
-            group_matches = _group_id in group_ids.keys()
+            group_matches = _group_id in GROUP_IDS
     # Deleting user
     else:
-        user_id = event_details['requestParameters']['userId']
+        user_id = event_details['requestParameters'].get('userId')
         event_name = "delete user"
 
+    if user_id is None:
+        raise Exception(f"User ID not found in the {event_type} event")
+
     logger.info("Received new %s event with user_id %s", event_name, user_id)
 
     if not group_matches:
@@ -77,19 +163,20 @@ def get_user_id(event_details):
     logger.info("Succesfully parsed user ID")
     return user_id
 
+def to_entry(modified_event, bus_name):
+    return event_publisher.make_entry(
+        'Lambda function: forward-delete-event',
+        'New SSO to RDS delete event recieved',
+        modified_event,
+        bus_name
+    )
+
 def publish_event(modified_event, bus_name):
     """
     Forwards event to the specified event bus
+    Raises exception if EventBridge doesn't accept the event after retries
     """
-    event_client = boto3.client('events')
+
     logger.info("Forwarding user details to the event bus")
-    event_client.put_events(
-            Entries=[
-                {
-                    'Source': 'Lambda function: forward-delete-event',
-                    'DetailType': 'New SSO to RDS delete event recieved',
-                    'Detail': json.dumps(modified_event),
-                    'EventBusName': bus_name
-                },
-            ]
-        )
+    if event_publisher.publish_events([to_entry(modified_event, bus_name)]):
+        raise Exception("Failed to forward event to the event bus")
@@ -0,0 +1,77 @@
+import os
+import logging
+import threading
+import metrics
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Keeps connections open between warm invocations
+# Adaptive retries rate limit the client when the service throttles
+DEFAULT_CONFIG = {
+    'connect_timeout': 3,
+    'read_timeout': 5,
+    'tcp_keepalive': True,
+    'max_pool_connections': int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '10')),
+    'retries': {'max_attempts': 3, 'mode': 'adaptive'},
+}
+
+# Cached per container, reused across warm invocations
+CLIENTS = {}
+RESOURCES = {}
+LOCK = threading.Lock()
+
+def get_client(service, **overrides):
+    """
+    Returns boto3 client for the service, created on the first call
+    Keyword arguments override the default botocore config
+    Clients with different overrides are cached separately
+    API calls are recorded as metrics spans
+    """
+
+    key = (service, repr(sorted(overrides.items())))
+    client = CLIENTS.get(key)
+
+    if client is None:
+        # Session creation in boto3 isn't thread-safe
+        with LOCK:
+            client = CLIENTS.get(key)
+            if client is None:
+                logger.info("Creating %s client", service)
+                import boto3
+                client = boto3.client(service, config=get_config(overrides))
+                metrics.instrument_client(client)
+                CLIENTS[key] = client
+
+    return client
+
+def get_resource(service, **overrides):
+    """
+    Returns boto3 resource for the service, created on the first call
+    Keyword arguments override the default botocore config
+    Resources with different overrides are cached separately
+    """
+
+    key = (service, repr(sorted(overrides.items())))
+    resource = RESOURCES.get(key)
+
+    if resource is None:
+        with LOCK:
+            resource = RESOURCES.get(key)
+            if resource is None:
+                logger.info("Creating %s resource", service)
+                import boto3
+                resource = boto3.resource(service, config=get_config(overrides))
+                metrics.instrument_client(resource.meta.client)
+                RESOURCES[key] = resource
+
+    return resource
+
+def get_config(overrides):
+    """
+    Returns botocore config with the defaults and overrides
+    botocore is imported on the first call to keep module import cheap
+    """
+
+    from botocore.config import Config
+    return Config(**{**DEFAULT_CONFIG, **overrides})
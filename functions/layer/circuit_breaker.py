@@ -0,0 +1,174 @@
+import os
+import time
+import logging
+import threading
+import aws_clients
+import metrics
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Consecutive DB connection failures that open the circuit
+FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '3'))
+# Seconds the circuit stays open before a single probe is let through
+RESET_TIMEOUT = int(os.environ.get('CIRCUIT_RESET_TIMEOUT', '30'))
+# Optional DynamoDB table shared between containers, with TTL enabled on expiresAt
+CIRCUIT_TABLE = os.environ.get('CIRCUIT_TABLE')
+# Minimum number of seconds between reads of the shared state
+SYNC_INTERVAL = int(os.environ.get('CIRCUIT_SYNC_INTERVAL', '5'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Cached per container, one breaker per DB target
+BREAKERS = {}
+LOCK = threading.Lock()
+TABLE = None
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of connecting while the DB is considered unavailable
+    """
+
+class CircuitBreaker:
+    """
+    Tracks consecutive connection failures of a DB target
+    Closed: calls go through, failures are counted
+    Open: calls fail immediately until RESET_TIMEOUT has passed
+    Half-open: one probe goes through, its outcome closes or reopens the circuit
+    """
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_until = 0.0
+        self.probe = None
+        self.synced = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Raises CircuitOpenError if the call must not go through
+        """
+
+        self.sync()
+
+        with self.lock:
+            now = time.time()
+
+            # A probe that didn't finish in time is replaced, e.g. after a timed out invocation
+            if self.state != CLOSED and now >= self.opened_until:
+                if self.state == OPEN:
+                    logger.info("Circuit for DB %s is half-open, probing", self.name)
+                self.state = HALF_OPEN
+                self.probe = None
+                self.opened_until = now + RESET_TIMEOUT
+
+            # The probe thread may connect several times, e.g. when reconnecting
+            if self.state == HALF_OPEN and self.probe in (None, threading.get_ident()):
+                self.probe = threading.get_ident()
+                return
+
+            if self.state != CLOSED:
+                metrics.set_property('CircuitOpen', self.name)
+                raise CircuitOpenError(
+                    f"Circuit for DB {self.name} is open, retrying in {max(0.0, self.opened_until - now):.0f}s"
+                )
+
+    def record_success(self):
+        with self.lock:
+            closing = self.state != CLOSED
+            self.state = CLOSED
+            self.failures = 0
+            self.probe = None
+
+        if closing:
+            logger.info("Circuit for DB %s is closed", self.name)
+            self.publish(None)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state != HALF_OPEN and self.failures < FAILURE_THRESHOLD:
+                return
+            self.state = OPEN
+            self.probe = None
+            self.opened_until = time.time() + RESET_TIMEOUT
+
+        logger.warning("Circuit for DB %s is open for %ds after %d failures", self.name, RESET_TIMEOUT, self.failures)
+        self.publish(self.opened_until)
+
+    def sync(self):
+        """
+        Opens the circuit if another container opened the shared one
+        Reads the shared state at most every SYNC_INTERVAL seconds, ignores errors
+        """
+
+        table = get_table()
+        now = time.time()
+        if table is None or self.state != CLOSED or now - self.synced < SYNC_INTERVAL:
+            return
+        self.synced = now
+
+        try:
+            item = table.get_item(Key={'circuitName': self.name}).get('Item')
+        except Exception as err:
+            logger.warning("Failed to read shared circuit state: %s", err)
+            return
+
+        if item is not None and float(item['openUntil']) > now:
+            with self.lock:
+                if self.state == CLOSED:
+                    logger.warning("Circuit for DB %s was opened by another container", self.name)
+                    self.state = OPEN
+                    self.opened_until = float(item['openUntil'])
+
+    def publish(self, opened_until):
+        """
+        Saves the state to the shared table, ignores errors
+        """
+
+        table = get_table()
+        if table is None:
+            return
+
+        try:
+            if opened_until is None:
+                table.delete_item(Key={'circuitName': self.name})
+            else:
+                table.put_item(Item={
+                    'circuitName': self.name,
+                    'openUntil': int(opened_until),
+                    'expiresAt': int(opened_until) + RESET_TIMEOUT,
+                })
+        except Exception as err:
+            logger.warning("Failed to save shared circuit state: %s", err)
+
+def get_breaker(name) -> CircuitBreaker:
+    """
+    Returns the circuit breaker of the DB target, created on the first call
+    """
+
+    with LOCK:
+        breaker = BREAKERS.get(name)
+        if breaker is None:
+            breaker = BREAKERS[name] = CircuitBreaker(name)
+
+    return breaker
+
+def get_table():
+    """
+    Returns shared DynamoDB circuit table if configured
+    Returns None otherwise
+    """
+
+    global TABLE
+
+    if CIRCUIT_TABLE and TABLE is None:
+        ddb_res = aws_clients.get_resource(
+            'dynamodb', connect_timeout=1, read_timeout=1, retries={'max_attempts': 0}
+        )
+        TABLE = ddb_res.Table(CIRCUIT_TABLE)
+
+    return TABLE
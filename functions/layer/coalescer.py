@@ -0,0 +1,86 @@
+import logging
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Event types emitted by the forwarders
+ADD_EVENTS = ('AddMemberToGroup',)
+REMOVE_EVENTS = ('RemoveMemberFromGroup', 'DeleteUser')
+
+# Event type used for deletes that don't require an existing mapping
+LENIENT_DELETE = 'DeleteUser'
+
+def parse_event(event) -> dict:
+    """
+    Returns user ID, event type, username, role names, group IDs and time from a forwarded EventBridge event
+    Raises exception if required details are missing
+    """
+
+    details = event['detail']
+    user_id = details.get('user_id')
+    event_type = details.get('event_type')
+
+    if not user_id or event_type not in ADD_EVENTS + REMOVE_EVENTS:
+        raise ValueError(f"Unsupported event for user {user_id}: {event_type}")
+
+    if event_type in ADD_EVENTS and not all([details.get('user_name'), details.get('role_name')]):
+        raise ValueError("Username or role name is missing in the event")
+
+    return {
+        'user_id': user_id,
+        'event_type': event_type,
+        'user_name': details.get('user_name'),
+        # Events of older forwarders carry a single role
+        'role_names': details.get('role_names') or [details.get('role_name')],
+        'group_ids': details.get('group_ids') or [group_id for group_id in [details.get('group_id')] if group_id],
+        'time': event.get('time', ''),
+    }
+
+def coalesce(events) -> list:
+    """
+    Collapses the events of every user into the net change
+    events is list of (record_id, parsed event) in delivery order
+    Events of a user are ordered by event time, delivery order breaks ties
+    Returns list of changes in order of the first event of each user, dicts with:
+    user_id, user_name, delete (event type of the net delete or None), roles to grant after it,
+    group_ids of the granted roles, record_ids, time of the latest event
+    """
+
+    changes = {}
+
+    for record_id, event in events:
+        change = changes.setdefault(event['user_id'], {
+            'user_id': event['user_id'], 'user_name': None, 'delete': None,
+            'roles': [], 'group_ids': [], 'record_ids': [], 'events': [], 'time': '',
+        })
+        change['record_ids'].append(record_id)
+        change['events'].append(event)
+        change['time'] = max(change['time'], event['time'])
+
+    for change in changes.values():
+        # Stable sort keeps the delivery order of events with the same time
+        for event in sorted(change.pop('events'), key=lambda event: event['time']):
+            if event['event_type'] in ADD_EVENTS:
+                # Later adds must still be applied if the user of the earlier remove has no mapping
+                if change['delete'] is not None:
+                    change['delete'] = LENIENT_DELETE
+                change['user_name'] = event['user_name']
+                change['roles'] += [role for role in event['role_names'] if role not in change['roles']]
+                change['group_ids'] += [
+                    group_id for group_id in event['group_ids'] if group_id not in change['group_ids']
+                ]
+                continue
+
+            # Remove discards the earlier adds, the user is dropped once before the later adds
+            if change['roles'] or event['event_type'] == LENIENT_DELETE:
+                # The user created by a discarded add might not have a mapping, DeleteUser never requires one
+                change['delete'] = LENIENT_DELETE
+            elif change['delete'] is None:
+                change['delete'] = event['event_type']
+            change['roles'] = []
+            change['group_ids'] = []
+
+    result = list(changes.values())
+    logger.info("Coalesced %d events into changes for %d users", len(events), len(result))
+
+    return result
@@ -1,30 +1,106 @@
 import os
+import json
+import time
 import logging
-import boto3
-from botocore.client import Config
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import aws_clients
+import circuit_breaker
+import metrics
+from sql_executor import SQLExecutor, CONNECTION_LOST, UNKNOWN
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def get_db_connection():
+# IAM authentication tokens are valid for 15 minutes
+TOKEN_TTL = 900
+# Refresh tokens shortly before they expire to avoid connecting with a stale one
+TOKEN_REFRESH_MARGIN = 60
+
+# Minimum number of seconds between liveness checks of an idle connection
+HEALTH_CHECK_INTERVAL = 30
+# Reconnect attempts and base backoff in seconds, doubled on every attempt
+RECONNECT_ATTEMPTS = 3
+RECONNECT_BACKOFF = 0.2
+
+# Driver connect timeout in seconds, an unreachable DB fails the invocation quickly
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', '5'))
+
+# Connections per DB target in the driver pool of a container, 0 connects directly without a pool
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '0'))
+# Seconds to wait for a free pooled connection
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+
+# Connect with TLS, always enabled for RDS Proxy endpoints
+DB_TLS = os.environ.get('RDS_DB_TLS', 'false').lower() == 'true'
+# Optional CA bundle to verify the server certificate and hostname
+DB_CA_BUNDLE = os.environ.get('RDS_DB_CA_BUNDLE')
+
+# Cached per container, reused across warm invocations
+TOKEN_CACHE = {}
+POOLS = {}
+# Managed connections holding a pooled connection, returned when the handler run ends
+CHECKED_OUT = set()
+LOCK = threading.Lock()
+
+def get_db_targets() -> list:
     """
-    Creates DB connection using IAM credentials
-    Returns connector if successful
-    Raises exception if not successful
+    Returns list of DB targets, dicts with name, engine, endpoint, port and user
+    Targets are read from RDS_DB_TARGETS JSON list if set, otherwise from RDS_DB_* env variables
+    Raises exception if not valid
+    """
+
+    targets_json = os.environ.get('RDS_DB_TARGETS')
+
+    if not targets_json:
+        return [get_default_target()]
+
+    try:
+        targets = json.loads(targets_json)
+    except ValueError as err:
+        raise Exception("RDS_DB_TARGETS is not valid JSON. Please check env variables") from err
+
+    if not isinstance(targets, list) or not targets:
+        raise Exception("RDS_DB_TARGETS must be a non-empty list. Please check env variables")
+
+    targets = [make_target(target) for target in targets]
+
+    names = [target['name'] for target in targets]
+    if len(set(names)) != len(names):
+        raise Exception("DB target names must be unique. Please check env variables")
+
+    return targets
+
+def get_default_target() -> dict:
+    """
+    Returns the single DB target configured with RDS_DB_* env variables
     """
 
-    logger.info("Creating a DB connection")
-    config = Config(connect_timeout=3, retries={'max_attempts': 0})
-    client = boto3.client('rds', config=config)
+    return make_target({
+        'endpoint': os.environ.get('RDS_DB_EP'),
+        'port': os.environ.get('RDS_DB_PORT', '3306'),
+        'user': os.environ.get('RDS_DB_USER'),
+        'engine': os.environ.get('RDS_DB_ENGINE', 'mysql'), # mysql or postgres
+        'proxy_endpoint': os.environ.get('RDS_PROXY_EP'),
+    })
+
+def make_target(target) -> dict:
+    """
+    Validates DB target details and normalizes the engine name
+    Target name defaults to the endpoint
+    Connects through the RDS Proxy endpoint with TLS if one is given
+    Raises exception if not valid
+    """
 
-    db_ep = os.environ.get('RDS_DB_EP')
-    db_port = os.environ.get('RDS_DB_PORT', '3306')
-    db_username = os.environ.get('RDS_DB_USER')
-    db_engine = os.environ.get('RDS_DB_ENGINE', 'mysql') # mysql or postgres
+    db_ep = target.get('endpoint')
+    proxy_ep = target.get('proxy_endpoint')
+    db_username = target.get('user')
+    db_engine = target.get('engine', 'mysql')
 
-    if not all([db_ep, db_username]):
+    if not all([db_ep or proxy_ep, db_username]):
         raise Exception("DB connection details not valid. Please check env variables")
-    
+
     if 'mysql' in db_engine:
         db_engine = 'mysql'
     elif 'postgres' in db_engine:
@@ -32,39 +108,132 @@ def get_db_connection():
     else:
         raise Exception(f"DB engine {db_engine} is not supported")
 
-    try:
-        db_pass = client.generate_db_auth_token(
-            DBHostname=db_ep, Port=db_port, DBUsername=db_username
-        )
-    except Exception as err:
-        raise Exception("Failed to retrieve DB details, please check the execution role") from err
-    
+    default_port = '3306' if db_engine == 'mysql' else '5432'
+
+    return {
+        'name': target.get('name', db_ep or proxy_ep),
+        'engine': db_engine,
+        # IAM tokens are issued for the host the functions connect to
+        'endpoint': proxy_ep or db_ep,
+        'port': str(target.get('port', default_port)),
+        'user': db_username,
+        # RDS Proxy only accepts IAM authentication over TLS
+        'tls': bool(proxy_ep) or bool(target.get('tls', DB_TLS)),
+    }
+
+@metrics.timed('db_connect')
+def get_db_connection(target=None):
+    """
+    Creates DB connection using IAM credentials
+    Connects to the target if given, otherwise to the one configured with RDS_DB_* env variables
+    Returns connector if successful
+    Raises CircuitOpenError without connecting if the DB is considered unavailable
+    Raises exception if not successful
+    """
+
+    if target is None:
+        target = get_default_target()
+
+    logger.info("Creating a DB connection to %s", target['name'])
+
+    db_engine = target['engine']
+
+    # Fail fast before signing a token when the DB is considered unavailable
+    breaker = circuit_breaker.get_breaker(target['name'])
+    breaker.allow()
+
+    db_pass = get_auth_token(target['endpoint'], target['port'], target['user'])
+
     try:
         if db_engine == 'mysql':
             from mysql import connector
-            db_conn = connector.connect(
-                host=db_ep,
-                user=db_username,
-                password=db_pass,
-                port=db_port,
-                auth_plugin='mysql_clear_password'
-            )
+            db_conn = connector.connect(**get_connect_args(target, db_pass))
         if db_engine == 'postgres':
             import psycopg2
-            db_conn = psycopg2.connect(
-                host=db_ep,
-                port=db_port,
-                user=db_username,
-                password=db_pass,
-                dbname='postgres' # Connecting to the default database
-            )
+            db_conn = psycopg2.connect(**get_connect_args(target, db_pass))
 
     except Exception as err:
         logger.error(err)
-        raise Exception("Failed to connect to the db") from err
+        breaker.record_failure()
+        raise Exception(f"Failed to connect to the db {target['name']}") from err
 
+    breaker.record_success()
     return (db_conn, db_engine)
 
+def get_connect_args(target, db_pass) -> dict:
+    """
+    Returns driver connect arguments of the DB target
+    With TLS the server certificate is verified only if DB_CA_BUNDLE is set
+    """
+
+    if target['engine'] == 'mysql':
+        args = {
+            'host': target['endpoint'],
+            'user': target['user'],
+            'password': db_pass,
+            'port': target['port'],
+            'auth_plugin': 'mysql_clear_password',
+            'connection_timeout': DB_CONNECT_TIMEOUT,
+        }
+        if target['tls']:
+            args['ssl_disabled'] = False
+            if DB_CA_BUNDLE:
+                args.update(ssl_ca=DB_CA_BUNDLE, ssl_verify_cert=True, ssl_verify_identity=True)
+        return args
+
+    args = {
+        'host': target['endpoint'],
+        'port': target['port'],
+        'user': target['user'],
+        'password': db_pass,
+        'dbname': 'postgres', # Connecting to the default database
+        'connect_timeout': DB_CONNECT_TIMEOUT,
+    }
+    if target['tls']:
+        args['sslmode'] = 'verify-full' if DB_CA_BUNDLE else 'require'
+        if DB_CA_BUNDLE:
+            args['sslrootcert'] = DB_CA_BUNDLE
+    return args
+
+def get_rds_client():
+    """
+    Returns RDS client cached for the lifetime of the container
+    Creates a new client on the first call
+    """
+
+    return aws_clients.get_client('rds', connect_timeout=3, retries={'max_attempts': 0})
+
+@metrics.timed('db_token')
+def get_auth_token(db_ep, db_port, db_username):
+    """
+    Returns IAM authentication token for the DB user
+    Tokens are cached by endpoint, port and username until shortly before expiry
+    Raises exception if not successful
+    """
+
+    key = (db_ep, str(db_port), db_username)
+    cached = TOKEN_CACHE.get(key)
+    now = time.monotonic()
+
+    # Reuse cached token unless it's about to expire
+    if cached is not None and now < cached[1] - TOKEN_REFRESH_MARGIN:
+        logger.info("Using cached IAM authentication token")
+        return cached[0]
+
+    logger.info("Generating a new IAM authentication token")
+
+    try:
+        token = get_rds_client().generate_db_auth_token(
+            DBHostname=db_ep, Port=db_port, DBUsername=db_username
+        )
+    except Exception as err:
+        raise Exception("Failed to retrieve DB details, please check the execution role") from err
+
+    TOKEN_CACHE[key] = (token, now + TOKEN_TTL)
+
+    return token
+
+@metrics.timed('ddb_table')
 def get_ddb_table():
     """
     Creates DynamoDB connection 
@@ -73,13 +242,14 @@ def get_ddb_table():
     """
 
     logger.info("Creating a DynamoDB connection")
-    config = Config(connect_timeout=3, read_timeout=3, retries={'max_attempts': 0})
     ddb_table_name = os.environ.get('DDB_TABLE')
 
     if not ddb_table_name:
         raise Exception("DynamoDB table name not specified. Please check env variables")
 
-    ddb_res = boto3.resource('dynamodb', config=config)
+    ddb_res = aws_clients.get_resource(
+        'dynamodb', connect_timeout=3, read_timeout=3, retries={'max_attempts': 0}
+    )
 
     try:
         ddb_table = ddb_res.Table(ddb_table_name)
@@ -87,3 +257,547 @@ def get_ddb_table():
         raise Exception("Failed to get DynamoDB table") from err
 
     return ddb_table
+
+def get_member_table():
+    """
+    Returns DynamoDB group membership table if configured
+    Returns None otherwise
+    """
+
+    member_table_name = os.environ.get('GROUP_MEMBER_TABLE')
+
+    if not member_table_name:
+        return None
+
+    logger.info("Creating a DynamoDB connection to the group membership table")
+    ddb_res = aws_clients.get_resource(
+        'dynamodb', connect_timeout=3, read_timeout=3, retries={'max_attempts': 0}
+    )
+
+    return ddb_res.Table(member_table_name)
+
+class ConnectionPool:
+    """
+    Driver connection pool of a DB target, shared by the threads of the container
+    Connections are opened on demand and authenticate with the current IAM token
+    Callers wait up to DB_POOL_TIMEOUT seconds for a free connection, the driver pools fail immediately
+    """
+    def __init__(self, target):
+        self.target = target
+        self.pool = None
+        self.password = None
+        # Time every idle connection was returned, by id
+        self.returned = {}
+        self.slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+        self.lock = threading.Lock()
+        # MySQL checkouts may add a connection to the pool first
+        self.checkout_lock = threading.Lock()
+        self.stats = {
+            'size': DB_POOL_SIZE, 'in_use': 0, 'peak_in_use': 0, 'checkouts': 0,
+            'waits': 0, 'wait_ms': 0.0, 'timeouts': 0, 'discarded': 0,
+        }
+
+    @metrics.timed('db_pool_acquire')
+    def acquire(self):
+        """
+        Returns (connection, engine) checked out from the pool
+        Raises CircuitOpenError without connecting if the DB is considered unavailable
+        Raises exception if no connection was free in time or connecting failed
+        """
+
+        started = time.monotonic()
+
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.stats['waits'] += 1
+            if not self.slots.acquire(timeout=DB_POOL_TIMEOUT):
+                with self.lock:
+                    self.stats['timeouts'] += 1
+                raise Exception(f"No pooled connection to the db {self.target['name']} was free in {DB_POOL_TIMEOUT}s")
+
+        try:
+            conn = self.checkout()
+        except Exception:
+            self.slots.release()
+            raise
+
+        with self.lock:
+            self.stats['checkouts'] += 1
+            self.stats['in_use'] += 1
+            self.stats['peak_in_use'] = max(self.stats['peak_in_use'], self.stats['in_use'])
+            self.stats['wait_ms'] += (time.monotonic() - started) * 1000
+
+        return (conn, self.target['engine'])
+
+    def checkout(self):
+        """
+        Returns a free driver connection, creates the driver pool on the first call
+        Raises exception if not successful
+        """
+
+        target = self.target
+
+        # Fail fast before signing a token when the DB is considered unavailable
+        breaker = circuit_breaker.get_breaker(target['name'])
+        breaker.allow()
+
+        db_pass = get_auth_token(target['endpoint'], target['port'], target['user'])
+
+        try:
+            if target['engine'] == 'mysql':
+                conn = self.checkout_mysql(db_pass)
+            else:
+                conn = self.checkout_postgres(db_pass)
+        except Exception as err:
+            logger.error(err)
+            breaker.record_failure()
+            raise Exception(f"Failed to connect to the db {target['name']}") from err
+
+        breaker.record_success()
+        return conn
+
+    def checkout_mysql(self, db_pass):
+        from mysql.connector import pooling
+
+        with self.checkout_lock:
+            if self.pool is None:
+                logger.info("Creating a DB connection pool of %d to %s", DB_POOL_SIZE, self.target['name'])
+                # Without connect arguments the pool doesn't open connections up front
+                self.pool = pooling.MySQLConnectionPool(pool_name=f"sso-sync-{len(POOLS)}", pool_size=DB_POOL_SIZE)
+
+            # Idle connections reconnect with the new token on their next checkout
+            if db_pass != self.password:
+                self.pool.set_config(**get_connect_args(self.target, db_pass))
+                self.password = db_pass
+
+            try:
+                return self.pool.get_connection()
+            except pooling.PoolError:
+                # The slot guarantees the pool isn't full
+                self.pool.add_connection()
+                return self.pool.get_connection()
+
+    def checkout_postgres(self, db_pass):
+        with self.lock:
+            if self.pool is None:
+                logger.info("Creating a DB connection pool of %d to %s", DB_POOL_SIZE, self.target['name'])
+                # Created without connections, returned ones are kept up to the pool size
+                self.pool = create_postgres_pool(self, get_connect_args(self.target, db_pass))
+                self.pool.minconn = DB_POOL_SIZE
+
+            # New connections of the pool authenticate with the latest token
+            self.password = db_pass
+
+        return self.pool.getconn()
+
+    def release(self, conn, discard=False):
+        """
+        Returns the connection to the pool, closes it instead if discard is set
+        """
+
+        try:
+            if self.target['engine'] == 'mysql':
+                # Pooled MySQL connections go back to the pool on close, broken ones reconnect on the next checkout
+                conn.close()
+            else:
+                self.pool.putconn(conn, close=discard)
+        except Exception as err:
+            logger.warning("Failed to return DB connection to the pool: %s", err)
+        finally:
+            with self.lock:
+                self.stats['in_use'] -= 1
+                self.stats['discarded'] += int(discard)
+                if discard:
+                    self.returned.pop(id(conn), None)
+                else:
+                    self.returned[id(conn)] = time.monotonic()
+            self.slots.release()
+
+    def returned_at(self, conn) -> float:
+        """
+        Returns when the connection was last returned to the pool
+        New connections and MySQL ones, which the driver pings on checkout, count as just used
+        """
+
+        if self.target['engine'] == 'mysql':
+            return time.monotonic()
+
+        with self.lock:
+            return self.returned.get(id(conn), time.monotonic())
+
+def create_postgres_pool(conn_pool, connect_args):
+    """
+    Returns psycopg2 pool that opens new connections with the current password of conn_pool
+    """
+
+    import psycopg2
+    from psycopg2 import pool
+
+    class TokenConnectionPool(pool.ThreadedConnectionPool):
+        # psycopg2 pools connect with the arguments they were created with, IAM tokens expire after 15 minutes
+        def _connect(self, key=None):
+            conn = psycopg2.connect(*self._args, **dict(self._kwargs, password=conn_pool.password))
+            if key is not None:
+                self._used[key] = conn
+                self._rused[id(conn)] = key
+            else:
+                self._pool.append(conn)
+            return conn
+
+    return TokenConnectionPool(0, DB_POOL_SIZE, **connect_args)
+
+def get_pool(target) -> ConnectionPool:
+    """
+    Returns the connection pool of the DB target, created on the first call
+    """
+
+    with LOCK:
+        conn_pool = POOLS.get(target['name'])
+        if conn_pool is None:
+            conn_pool = POOLS[target['name']] = ConnectionPool(target)
+
+    return conn_pool
+
+def get_pool_stats() -> dict:
+    """
+    Returns dict of DB target name to the counters of its connection pool
+    """
+
+    with LOCK:
+        pools = dict(POOLS)
+
+    stats = {}
+    for name, conn_pool in pools.items():
+        with conn_pool.lock:
+            stats[name] = dict(conn_pool.stats, wait_ms=round(conn_pool.stats['wait_ms'], 1))
+
+    return stats
+
+def release_all():
+    """
+    Returns all checked out pooled connections of the container to their pools
+    Adds the pool counters to the metrics of the invocation
+    """
+
+    with LOCK:
+        managed_conns = list(CHECKED_OUT)
+
+    for managed_conn in managed_conns:
+        managed_conn.release()
+
+    if POOLS:
+        metrics.set_property('DBPools', get_pool_stats())
+
+def release_connections(func):
+    """
+    Decorator for Lambda handlers
+    Returns pooled connections to their pools when the handler run ends, no-op without pooling
+    """
+
+    @functools.wraps(func)
+    def wrapper(event, context):
+        try:
+            return func(event, context)
+        finally:
+            if DB_POOL_SIZE > 0:
+                release_all()
+
+    return wrapper
+
+class ManagedConnection:
+    """
+    Keeps DB connection healthy across warm invocations
+    Checks liveness of idle connections at most every HEALTH_CHECK_INTERVAL seconds
+    Reconnects with backoff when the connection is lost
+    With DB_POOL_SIZE set, connections are checked out from the pool of the target until released
+    """
+    def __init__(self, target=None):
+        self.target = target
+        self.conn = None
+        self.engine = None
+        self.last_used = 0.0
+        self.pool = None
+
+    def connection(self):
+        """
+        Returns (connection, engine) tuple
+        Connects on the first call and reconnects if the idle connection is dead
+        Raises CircuitOpenError if the DB is considered unavailable
+        Raises exception if not successful
+        """
+
+        if self.conn is None:
+            self.open()
+            # Pooled connections may have been idle in the pool, they're checked below
+            if self.pool is None:
+                return (self.conn, self.engine)
+        else:
+            # Open circuit fails fast even with a cached connection, e.g. opened by another container
+            self.breaker().allow()
+
+        if time.monotonic() - self.last_used >= HEALTH_CHECK_INTERVAL:
+            if not self.is_alive():
+                logger.warning("DB connection is not alive, reconnecting")
+                self.reconnect()
+            self.touch()
+
+        return (self.conn, self.engine)
+
+    def executor(self):
+        """
+        Returns executor that replays a failed query once after reconnecting
+        """
+
+        conn, engine = self.connection()
+        metrics.set_property('Engine', engine)
+        return ReconnectingExecutor(self, SQLExecutor(conn, engine))
+
+    def open(self):
+        """
+        Connects to the target, or checks out a connection from its pool if pooling is enabled
+        Raises exception if not successful
+        """
+
+        if DB_POOL_SIZE <= 0:
+            self.conn, self.engine = get_db_connection(self.target)
+            self.touch()
+            return
+
+        self.pool = get_pool(self.target or get_default_target())
+        self.conn, self.engine = self.pool.acquire()
+        self.last_used = self.pool.returned_at(self.conn)
+        with LOCK:
+            CHECKED_OUT.add(self)
+
+    def release(self, discard=False):
+        """
+        Returns the pooled connection to its pool, closed if discard is set
+        Direct connections are kept for the next invocation
+        """
+
+        if self.pool is None or self.conn is None:
+            return
+
+        conn, self.conn = self.conn, None
+        with LOCK:
+            CHECKED_OUT.discard(self)
+        self.pool.release(conn, discard)
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+    def breaker(self):
+        name = self.target['name'] if self.target else get_default_target()['name']
+        return circuit_breaker.get_breaker(name)
+
+    def is_alive(self) -> bool:
+        """
+        Runs a cheap query to check whether the connection is usable
+        """
+
+        if self.conn is None or getattr(self.conn, 'closed', 0):
+            return False
+
+        cursor = None
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.fetchall()
+        except Exception as err:
+            logger.warning("DB liveness check failed: %s", err)
+            return False
+        finally:
+            if cursor is not None:
+                try:
+                    cursor.close()
+                except Exception:
+                    pass
+
+        return True
+
+    def reconnect(self):
+        """
+        Replaces the connection with a new one
+        Retries with exponential backoff
+        Raises exception if all attempts fail
+        """
+
+        # Broken pooled connection isn't handed out again
+        self.release(discard=True)
+        self.close()
+
+        for attempt in range(RECONNECT_ATTEMPTS):
+            try:
+                self.open()
+                self.touch()
+                logger.info("Reconnected to the DB")
+                return
+            except circuit_breaker.CircuitOpenError:
+                raise
+            except Exception as err:
+                if attempt == RECONNECT_ATTEMPTS - 1:
+                    raise
+                delay = RECONNECT_BACKOFF * 2 ** attempt
+                logger.warning("Reconnect attempt %d failed, retrying in %.1fs: %s", attempt + 1, delay, err)
+                time.sleep(delay)
+
+    def close(self):
+        """
+        Closes the connection ignoring errors
+        Pooled connections are returned to the pool instead
+        """
+
+        if self.pool is not None:
+            self.release()
+            return
+
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+        self.conn = None
+
+class ReconnectingExecutor:
+    """
+    Proxies SQLExecutor methods, every call is recorded as a metrics span
+    If a call fails because the connection is lost, reconnects and replays the call once
+    A replayed provision_user tells the user the interrupted call created from unmanaged ones by its comment
+    Calls that reach the DB close the circuit of the target
+    """
+    def __init__(self, managed_conn, executor):
+        self.managed_conn = managed_conn
+        self.executor = executor
+
+    def __getattr__(self, name):
+        method = getattr(self.executor, name)
+        if not callable(method):
+            return method
+
+        def call(*args, **kwargs):
+            with metrics.span(f"sql.{name}"):
+                try:
+                    result = method(*args, **kwargs)
+                except Exception as err:
+                    code = getattr(err, 'code', UNKNOWN)
+                    metrics.set_property('ErrorCode', code)
+                    # Errors on a live connection are query errors, don't replay
+                    # Classified errors other than lost connections come from the server, no need to check
+                    if code not in (CONNECTION_LOST, UNKNOWN) or self.managed_conn.is_alive():
+                        self.managed_conn.breaker().record_success()
+                        raise
+                    logger.warning("DB connection lost during %s, reconnecting and replaying", name)
+                    self.managed_conn.reconnect()
+                    conn, engine = self.managed_conn.connection()
+                    self.executor = SQLExecutor(conn, engine)
+                    result = getattr(self.executor, name)(*args, **kwargs)
+            self.managed_conn.breaker().record_success()
+            self.managed_conn.touch()
+            return result
+
+        return call
+
+class TargetsError(Exception):
+    """
+    Raised when a call failed on some of the DB targets
+    Keeps results of the targets that succeeded and errors of the ones that failed
+    """
+    def __init__(self, results, errors):
+        self.results = results
+        self.errors = errors
+        failed = ", ".join(
+            f"{name} ({err.code})" if hasattr(err, 'code') else name for name, err in errors.items()
+        )
+        super().__init__(f"Failed on {len(errors)} of {len(results) + len(errors)} DB targets: {failed}")
+
+class ClusterConnections:
+    """
+    Keeps one managed connection per DB target
+    Targets are read from the env variables on the first call
+    """
+    def __init__(self):
+        self.connections = None
+
+    def executor(self):
+        """
+        Returns executor that applies every call to all DB targets in parallel
+        """
+
+        if self.connections is None:
+            self.connections = {
+                target['name']: ManagedConnection(target) for target in get_db_targets()
+            }
+            logger.info("Configured %d DB targets", len(self.connections))
+
+        return FanOutExecutor(self.connections)
+
+    def release(self):
+        """
+        Returns pooled connections of all targets to their pools
+        """
+
+        for managed_conn in (self.connections or {}).values():
+            managed_conn.release()
+
+    def close(self):
+        for managed_conn in (self.connections or {}).values():
+            managed_conn.close()
+
+class FanOutExecutor:
+    """
+    Proxies SQLExecutor methods to every DB target in parallel
+    Calls return dict of target name to result
+    Raises TargetsError if the call failed on any of the targets
+    """
+    def __init__(self, connections):
+        self.connections = connections
+
+    @property
+    def targets(self) -> list:
+        return list(self.connections)
+
+    def only(self, names):
+        """
+        Returns executor limited to the named targets
+        """
+
+        return FanOutExecutor({name: self.connections[name] for name in names})
+
+    def each(self, func) -> dict:
+        """
+        Calls func(target_name, executor) for every target in parallel
+        Connects to the targets in the worker threads, so total latency is close to the slowest target
+        """
+
+        def run(name):
+            started = time.perf_counter()
+            try:
+                result = func(name, self.connections[name].executor())
+            except Exception as err:
+                logger.error("DB target %s failed: %s", name, err)
+                return name, None, err
+            logger.info("DB target %s succeeded in %.0fms", name, (time.perf_counter() - started) * 1000)
+            return name, result, None
+
+        names = self.targets
+
+        # No point in a thread pool for a single target
+        if len(names) == 1:
+            outcomes = [run(names[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(names)) as pool:
+                outcomes = list(pool.map(run, names))
+
+        results = {name: result for name, result, err in outcomes if err is None}
+        errors = {name: err for name, _, err in outcomes if err is not None}
+
+        if errors:
+            raise TargetsError(results, errors) from next(iter(errors.values()))
+
+        return results
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            return self.each(lambda _, executor: getattr(executor, name)(*args, **kwargs))
+
+        return call
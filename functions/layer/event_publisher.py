@@ -0,0 +1,105 @@
+import json
+import time
+import logging
+import aws_clients
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# EventBridge limits per PutEvents request
+MAX_ENTRIES = 10
+MAX_REQUEST_SIZE = 256 * 1024
+
+# Retries for failed entries, base backoff in seconds doubled on every attempt
+MAX_ATTEMPTS = 4
+BACKOFF = 0.1
+
+def make_entry(source, detail_type, detail, bus_name):
+    """
+    Returns PutEvents entry for the event detail
+    """
+
+    return {
+        'Source': source,
+        'DetailType': detail_type,
+        'Detail': json.dumps(detail),
+        'EventBusName': bus_name
+    }
+
+def publish_events(entries) -> list:
+    """
+    Sends entries to EventBridge packing as many as fit into each PutEvents call
+    Retries only the failed entries with exponential backoff
+    Returns list of indexes of the entries that failed after all attempts
+    """
+
+    client = aws_clients.get_client('events')
+    pending = list(range(len(entries)))
+
+    for attempt in range(MAX_ATTEMPTS):
+        failed = []
+
+        for batch in pack(entries, pending):
+            try:
+                resp = client.put_events(Entries=[entries[i] for i in batch])
+            except Exception as err:
+                logger.error("Failed to put %d events", len(batch))
+                logger.error(err)
+                failed.extend(batch)
+                continue
+
+            if resp.get('FailedEntryCount', 0) == 0:
+                continue
+
+            # Result entries are in the same order as the request entries
+            for i, result in zip(batch, resp['Entries']):
+                if 'ErrorCode' in result:
+                    logger.warning("Event rejected: %s %s", result['ErrorCode'], result.get('ErrorMessage'))
+                    failed.append(i)
+
+        pending = failed
+        if not pending:
+            break
+
+        if attempt < MAX_ATTEMPTS - 1:
+            delay = BACKOFF * 2 ** attempt
+            logger.warning("Retrying %d failed events in %.1fs", len(pending), delay)
+            time.sleep(delay)
+
+    logger.info("Published %d of %d events", len(entries) - len(pending), len(entries))
+    return pending
+
+def pack(entries, indexes):
+    """
+    Splits entry indexes into batches within the PutEvents entry count and size limits
+    """
+
+    batch = []
+    batch_size = 0
+
+    for i in indexes:
+        size = entry_size(entries[i])
+        if batch and (len(batch) == MAX_ENTRIES or batch_size + size > MAX_REQUEST_SIZE):
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(i)
+        batch_size += size
+
+    if batch:
+        yield batch
+
+def entry_size(entry) -> int:
+    """
+    Calculates PutEvents entry size the same way EventBridge does
+    """
+
+    # Time field is counted as a fixed 14 bytes
+    size = 14
+    for field in ('Source', 'DetailType', 'Detail'):
+        if entry.get(field):
+            size += len(entry[field].encode('utf-8'))
+    for resource in entry.get('Resources', []):
+        size += len(resource.encode('utf-8'))
+
+    return size
@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+import aws_clients
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Optional DynamoDB table shared between containers, with TTL enabled on expiresAt
+IDEMPOTENCY_TABLE = os.environ.get('IDEMPOTENCY_TABLE')
+# Processed events are remembered longer than EventBridge keeps retrying (24 hours)
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', '90000'))
+# Claims of events being processed expire so a crashed invocation doesn't block retries
+# Must be longer than the function timeout (60 seconds for the delete function), or a running claim expires
+IN_PROGRESS_TTL = int(os.environ.get('IDEMPOTENCY_IN_PROGRESS_TTL', '120'))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '1024'))
+
+IN_PROGRESS = 'in_progress'
+COMPLETED = 'completed'
+
+# Keys of processed events, kept across warm invocations
+PROCESSED = OrderedDict()
+TABLE = None
+
+def get_event_key(scope, event, payload):
+    """
+    Returns idempotency key from the event ID and a hash of the payload
+    Returns None if the event has no ID
+    """
+
+    event_id = event.get('id')
+    if not event_id:
+        return None
+
+    digest = hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return f"{scope}#{event_id}#{digest}"
+
+def get_table():
+    """
+    Returns shared DynamoDB idempotency table if configured
+    Returns None otherwise
+    """
+
+    global TABLE
+
+    if IDEMPOTENCY_TABLE and TABLE is None:
+        ddb_res = aws_clients.get_resource(
+            'dynamodb', connect_timeout=3, read_timeout=3, retries={'max_attempts': 0}
+        )
+        TABLE = ddb_res.Table(IDEMPOTENCY_TABLE)
+
+    return TABLE
+
+def is_processed(key) -> bool:
+    """
+    Checks the in-process cache only
+    """
+
+    if key is None:
+        return False
+
+    expires_at = PROCESSED.get(key)
+    if expires_at is None:
+        return False
+
+    if expires_at <= time.time():
+        del PROCESSED[key]
+        return False
+
+    PROCESSED.move_to_end(key)
+    return True
+
+def claim(key) -> bool:
+    """
+    Claims the event for processing with a conditional write
+    Returns False if the event was already processed
+    Raises exception if the event is being processed by another invocation, so it's retried later
+    Fails open if the table can't be reached, duplicate processing is safe but slower
+    """
+
+    if key is None:
+        return True
+
+    if is_processed(key):
+        return False
+
+    table = get_table()
+    if table is None:
+        return True
+
+    now = int(time.time())
+
+    try:
+        table.put_item(
+            Item={'idempotencyKey': key, 'status': IN_PROGRESS, 'expiresAt': now + IN_PROGRESS_TTL},
+            # Expired items can still be returned until DynamoDB deletes them
+            ConditionExpression='attribute_not_exists(idempotencyKey) OR expiresAt < :now',
+            ExpressionAttributeValues={':now': now}
+        )
+        return True
+    except Exception as err:
+        code = getattr(err, 'response', {}).get('Error', {}).get('Code')
+        if code != 'ConditionalCheckFailedException':
+            logger.warning("Failed to claim event, processing it anyway")
+            logger.warning(err)
+            return True
+
+    try:
+        item = table.get_item(Key={'idempotencyKey': key}, ConsistentRead=True).get('Item')
+    except Exception as err:
+        logger.warning("Failed to read event status, processing it anyway")
+        logger.warning(err)
+        return True
+
+    # Deleted or expired between the two calls
+    if item is None or int(item['expiresAt']) < now:
+        return True
+
+    if item['status'] == COMPLETED:
+        remember(key, int(item['expiresAt']))
+        return False
+
+    raise Exception("Event is already being processed")
+
+def complete(key, shared=True):
+    """
+    Marks the event as processed in the in-process cache and the shared table
+    """
+
+    if key is None:
+        return
+
+    expires_at = int(time.time()) + IDEMPOTENCY_TTL
+    remember(key, expires_at)
+
+    table = get_table()
+    if shared and table is not None:
+        try:
+            table.put_item(Item={'idempotencyKey': key, 'status': COMPLETED, 'expiresAt': expires_at})
+        except Exception as err:
+            logger.warning("Failed to mark event as processed")
+            logger.warning(err)
+
+def release(key):
+    """
+    Deletes the claim after a failure, so a retry can process the event
+    """
+
+    table = get_table()
+    if key is None or table is None:
+        return
+
+    try:
+        table.delete_item(Key={'idempotencyKey': key})
+    except Exception as err:
+        logger.warning("Failed to release event claim, retries wait for it to expire")
+        logger.warning(err)
+
+def get_applied_time(user_id) -> str:
+    """
+    Returns time of the latest event applied for the user from the shared table
+    Returns empty string if unknown, fails open if the table can't be reached
+    """
+
+    table = get_table()
+    if table is None:
+        return ''
+
+    try:
+        item = table.get_item(Key={'idempotencyKey': f"applied#{user_id}"}, ConsistentRead=True).get('Item')
+    except Exception as err:
+        logger.warning("Failed to read the latest applied event of user ID %s", user_id)
+        logger.warning(err)
+        return ''
+
+    # Expired items can still be returned until DynamoDB deletes them
+    if item is None or int(item['expiresAt']) < time.time():
+        return ''
+
+    return item['eventTime']
+
+def set_applied_time(user_id, event_time):
+    """
+    Records time of the latest event applied for the user, never moving it back
+    """
+
+    table = get_table()
+    if table is None or not event_time:
+        return
+
+    try:
+        table.put_item(
+            Item={
+                'idempotencyKey': f"applied#{user_id}", 'eventTime': event_time,
+                'expiresAt': int(time.time()) + IDEMPOTENCY_TTL
+            },
+            ConditionExpression='attribute_not_exists(idempotencyKey) OR eventTime <= :time',
+            ExpressionAttributeValues={':time': event_time}
+        )
+    except Exception as err:
+        code = getattr(err, 'response', {}).get('Error', {}).get('Code')
+        if code != 'ConditionalCheckFailedException':
+            logger.warning("Failed to record the latest applied event of user ID %s", user_id)
+            logger.warning(err)
+
+def remember(key, expires_at):
+    """
+    Adds key to the in-process cache, evicting the least recently used entries
+    """
+
+    PROCESSED[key] = expires_at
+    PROCESSED.move_to_end(key)
+
+    while len(PROCESSED) > IDEMPOTENCY_CACHE_SIZE:
+        PROCESSED.popitem(last=False)
@@ -0,0 +1,227 @@
+"""
+Exports the user ID to username mapping table to a snapshot file and imports it back
+
+The export reads the table with a parallel segmented Scan and writes one JSON object per line,
+sorted by user ID, gzip compressed if the file name ends with .gz
+The import writes the snapshot with parallel BatchWriteItem requests
+
+Both are rate limited to a share of the provisioned capacity of the table,
+or to the given number of capacity units per second
+
+Usage:
+    python mapping_snapshot.py export [--table ssoUserTable] [--segments 4] [--rate 10] snapshot.jsonl.gz
+    python mapping_snapshot.py import [--table ssoUserTable] [--workers 4] [--rate 10] snapshot.jsonl.gz
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import aws_clients
+import mapping_store
+from sql_executor import chunks
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Share of the provisioned capacity used if no rate is given, leaves room for the Lambda functions
+CAPACITY_SHARE = float(os.environ.get('SNAPSHOT_CAPACITY_SHARE', '0.5'))
+SEGMENTS = int(os.environ.get('SNAPSHOT_SEGMENTS', '4'))
+WORKERS = int(os.environ.get('SNAPSHOT_WORKERS', '4'))
+# Items per Scan page, small pages keep the consumed capacity smooth
+PAGE_SIZE = int(os.environ.get('SNAPSHOT_PAGE_SIZE', '500'))
+
+class RateLimiter:
+    """
+    Token bucket shared by the worker threads
+    Capacity is paid after every request, the next request waits until the bucket is refilled
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.available = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                # At most one second of unused capacity is kept, like a provisioned table bursting
+                self.available = min(self.rate, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.available > 0:
+                    return
+                delay = -self.available / self.rate
+            time.sleep(delay)
+
+    def consume(self, units):
+        if not self.rate:
+            return
+
+        with self.lock:
+            self.available -= units
+
+def get_rate(ddb_table, kind, rate=None):
+    """
+    Returns capacity units per second to use, kind is Read or Write
+    Defaults to CAPACITY_SHARE of the provisioned capacity
+    Returns None (unlimited) for on-demand tables
+    """
+
+    if rate:
+        return rate
+
+    try:
+        table = ddb_table.meta.client.describe_table(TableName=ddb_table.name)['Table']
+    except Exception as err:
+        raise Exception("Failed to describe DDB table") from err
+
+    provisioned = table.get('ProvisionedThroughput', {}).get(f"{kind}CapacityUnits", 0)
+    if not provisioned:
+        logger.info("Table is on-demand, %s rate isn't limited", kind.lower())
+        return None
+
+    return max(1.0, provisioned * CAPACITY_SHARE)
+
+def scan_segment(ddb_table, segment, segments, limiter) -> list:
+    """
+    Reads one segment of the table
+    Returns list of (user ID, username)
+    Raises exception if not successful
+    """
+
+    mappings = []
+    kwargs = {
+        'Segment': segment,
+        'TotalSegments': segments,
+        'Limit': PAGE_SIZE,
+        'ProjectionExpression': '#id, #name',
+        'ExpressionAttributeNames': {'#id': 'userID', '#name': 'username'},
+        'ReturnConsumedCapacity': 'TOTAL',
+    }
+
+    while True:
+        limiter.wait()
+        try:
+            resp = ddb_table.scan(**kwargs)
+        except Exception as err:
+            raise Exception(f"Failed to scan segment {segment} of DDB table") from err
+
+        limiter.consume(resp.get('ConsumedCapacity', {}).get('CapacityUnits', 0))
+        mappings += [(item['userID'], item['username']) for item in resp.get('Items', [])]
+
+        if 'LastEvaluatedKey' not in resp:
+            break
+        kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+    return mappings
+
+def export_snapshot(ddb_table, path, segments=SEGMENTS, rate=None) -> int:
+    """
+    Writes all user mappings to the snapshot file, sorted by user ID
+    Returns number of exported mappings
+    Raises exception if not successful
+    """
+
+    limiter = RateLimiter(get_rate(ddb_table, 'Read', rate))
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        results = pool.map(lambda segment: scan_segment(ddb_table, segment, segments, limiter), range(segments))
+        mappings = sorted(mapping for result in results for mapping in result)
+
+    with open_snapshot(path, 'wt') as snapshot:
+        for user_id, user_name in mappings:
+            snapshot.write(json.dumps({'userID': user_id, 'username': user_name}, separators=(',', ':')) + '\n')
+
+    logger.info(
+        "Exported %d user mappings in %d segments in %.1fs", len(mappings), segments, time.monotonic() - started
+    )
+    return len(mappings)
+
+def read_snapshot(path) -> dict:
+    """
+    Reads the snapshot file
+    Returns dict of user ID to username
+    Raises exception if a line isn't a valid mapping
+    """
+
+    mappings = {}
+
+    with open_snapshot(path, 'rt') as snapshot:
+        for number, line in enumerate(snapshot, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                mappings[item['userID']] = item['username']
+            except Exception as err:
+                raise Exception(f"Invalid mapping on line {number} of the snapshot") from err
+
+    return mappings
+
+def import_snapshot(ddb_table, path, workers=WORKERS, rate=None) -> int:
+    """
+    Writes all user mappings of the snapshot file to the table
+    Existing mappings with the same user ID are overwritten, others are kept
+    Returns number of imported mappings
+    Raises exception if not successful
+    """
+
+    mappings = read_snapshot(path)
+    limiter = RateLimiter(get_rate(ddb_table, 'Write', rate))
+    started = time.monotonic()
+
+    requests = [
+        {'PutRequest': {'Item': {'userID': user_id, 'username': user_name}}}
+        for user_id, user_name in mappings.items()
+    ]
+
+    def write_chunk(chunk):
+        limiter.wait()
+        # Mappings are smaller than 1KB, every put consumes one write capacity unit
+        limiter.consume(len(chunk))
+        mapping_store.write_batch(ddb_table, chunk)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Consumes the results, so the first failure is raised
+        list(pool.map(write_chunk, chunks(requests, mapping_store.BATCH_WRITE_SIZE)))
+
+    logger.info("Imported %d user mappings in %.1fs", len(requests), time.monotonic() - started)
+    return len(requests)
+
+def open_snapshot(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, encoding='utf-8')
+    return open(path, mode[0], encoding='utf-8')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('path', help="snapshot file, gzip compressed if it ends with .gz")
+    parser.add_argument('--table', default=os.environ.get('DDB_TABLE'), help="table name, DDB_TABLE by default")
+    parser.add_argument('--segments', type=int, default=SEGMENTS, help="parallel Scan segments of the export")
+    parser.add_argument('--workers', type=int, default=WORKERS, help="parallel writers of the import")
+    parser.add_argument('--rate', type=float, help="capacity units per second, share of the provisioned capacity by default")
+    args = parser.parse_args()
+
+    if not args.table:
+        parser.error("table name not specified, use --table or DDB_TABLE")
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+    ddb_table = aws_clients.get_resource('dynamodb').Table(args.table)
+
+    if args.command == 'export':
+        export_snapshot(ddb_table, args.path, args.segments, args.rate)
+    else:
+        import_snapshot(ddb_table, args.path, args.workers, args.rate)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,260 @@
+import os
+import time
+import logging
+from sql_executor import chunks
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# DynamoDB limits per BatchGetItem and BatchWriteItem request
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+
+# Retries for unprocessed keys and items and throttled requests, base backoff in seconds doubled on every attempt
+MAX_ATTEMPTS = 6
+BACKOFF = 0.05
+MAX_BACKOFF = 2.0
+
+# Errors of requests rejected as a whole when the table capacity is exceeded
+THROTTLING_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+
+# Index of the group membership table keyed by group ID
+MEMBER_INDEX = os.environ.get('GROUP_MEMBER_INDEX', 'groupId-index')
+
+def get_user_names(ddb_table, user_ids) -> dict:
+    """
+    Reads user ID to username mappings using BatchGetItem
+    Returns dict of user ID to username for the mappings that exist
+    Raises exception if not successful
+    """
+
+    client = ddb_table.meta.client
+    table_name = ddb_table.name
+    user_names = {}
+
+    for chunk in chunks(list(dict.fromkeys(user_ids)), BATCH_GET_SIZE):
+        request = {table_name: {'Keys': [{'userID': user_id} for user_id in chunk]}}
+
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                resp = client.batch_get_item(RequestItems=request)
+            except Exception as err:
+                if is_throttled(err) and attempt < MAX_ATTEMPTS - 1:
+                    backoff(attempt, "DDB throttled the request")
+                    continue
+                raise Exception("Failed to get user mappings from DDB") from err
+
+            for item in resp.get('Responses', {}).get(table_name, []):
+                user_names[item['userID']] = item['username']
+
+            request = resp.get('UnprocessedKeys')
+            if not request:
+                break
+
+            backoff(attempt, "DDB returned unprocessed keys")
+        else:
+            raise Exception("Failed to get user mappings from DDB, keys left unprocessed")
+
+    logger.info("Found %d of %d user mappings in DDB", len(user_names), len(user_ids))
+    return user_names
+
+def scan_mappings(ddb_table) -> dict:
+    """
+    Reads all user ID to username mappings with a paginated Scan
+    Returns dict of user ID to username
+    Raises exception if not successful
+    """
+
+    user_names = {}
+    kwargs = {
+        'ProjectionExpression': '#id, #name',
+        'ExpressionAttributeNames': {'#id': 'userID', '#name': 'username'},
+    }
+
+    while True:
+        try:
+            resp = ddb_table.scan(**kwargs)
+        except Exception as err:
+            raise Exception("Failed to scan user mappings in DDB") from err
+
+        for item in resp.get('Items', []):
+            user_names[item['userID']] = item['username']
+
+        if 'LastEvaluatedKey' not in resp:
+            break
+        kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+    logger.info("Scanned %d user mappings in DDB", len(user_names))
+    return user_names
+
+def put_mappings(ddb_table, mappings) -> None:
+    """
+    Saves user ID to username mappings using BatchWriteItem
+    Mappings is a dict of user ID to username
+    Raises exception if not successful
+    """
+
+    requests = [
+        {'PutRequest': {'Item': {'userID': user_id, 'username': user_name}}}
+        for user_id, user_name in mappings.items()
+    ]
+    write_batch(ddb_table, requests)
+    logger.info("Saved %d user mappings to DDB", len(requests))
+
+def delete_mappings(ddb_table, user_ids) -> None:
+    """
+    Deletes user ID to username mappings using BatchWriteItem
+    Raises exception if not successful
+    """
+
+    requests = [
+        {'DeleteRequest': {'Key': {'userID': user_id}}}
+        for user_id in dict.fromkeys(user_ids)
+    ]
+    write_batch(ddb_table, requests)
+    logger.info("Deleted %d user mappings from DDB", len(requests))
+
+def put_memberships(member_table, memberships) -> None:
+    """
+    Records group memberships using BatchWriteItem
+    Memberships is a list of (group ID, user ID)
+    Raises exception if not successful
+    """
+
+    requests = [
+        {'PutRequest': {'Item': {'userID': user_id, 'groupId': group_id}}}
+        for group_id, user_id in dict.fromkeys(memberships)
+    ]
+    write_batch(member_table, requests, "group memberships")
+    logger.info("Saved %d group memberships to DDB", len(requests))
+
+def delete_memberships(member_table, memberships) -> None:
+    """
+    Deletes group memberships using BatchWriteItem
+    Memberships is a list of (group ID, user ID)
+    Raises exception if not successful
+    """
+
+    requests = [
+        {'DeleteRequest': {'Key': {'userID': user_id, 'groupId': group_id}}}
+        for group_id, user_id in dict.fromkeys(memberships)
+    ]
+    write_batch(member_table, requests, "group memberships")
+    logger.info("Deleted %d group memberships from DDB", len(requests))
+
+def query_members(member_table, group_id) -> list:
+    """
+    Reads user IDs recorded as members of the group from the group index
+    Raises exception if not successful
+    """
+
+    items = query(
+        member_table, IndexName=MEMBER_INDEX,
+        KeyConditionExpression='groupId = :id', ExpressionAttributeValues={':id': group_id}
+    )
+    logger.info("Found %d members of group %s in DDB", len(items), group_id)
+    return [item['userID'] for item in items]
+
+def query_groups(member_table, user_id) -> list:
+    """
+    Reads group IDs the user is recorded as a member of
+    Raises exception if not successful
+    """
+
+    items = query(
+        member_table, KeyConditionExpression='userID = :id', ExpressionAttributeValues={':id': user_id}
+    )
+    return [item['groupId'] for item in items]
+
+def scan_memberships(member_table) -> set:
+    """
+    Reads all group memberships with a paginated Scan
+    Returns set of (group ID, user ID)
+    Raises exception if not successful
+    """
+
+    memberships = set()
+    kwargs = {}
+
+    while True:
+        try:
+            resp = member_table.scan(**kwargs)
+        except Exception as err:
+            raise Exception("Failed to scan group memberships in DDB") from err
+
+        memberships |= {(item['groupId'], item['userID']) for item in resp.get('Items', [])}
+
+        if 'LastEvaluatedKey' not in resp:
+            break
+        kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+    logger.info("Scanned %d group memberships in DDB", len(memberships))
+    return memberships
+
+def query(member_table, **kwargs) -> list:
+    """
+    Reads all pages of a Query
+    Raises exception if not successful
+    """
+
+    items = []
+
+    while True:
+        try:
+            resp = member_table.query(**kwargs)
+        except Exception as err:
+            raise Exception("Failed to query group memberships in DDB") from err
+
+        items += resp.get('Items', [])
+
+        if 'LastEvaluatedKey' not in resp:
+            break
+        kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+    return items
+
+def write_batch(ddb_table, requests, description="user mappings") -> None:
+    """
+    Sends write requests in chunks of BATCH_WRITE_SIZE
+    Retries unprocessed items and throttled requests with exponential backoff
+    Raises exception if not successful
+    """
+
+    client = ddb_table.meta.client
+    table_name = ddb_table.name
+
+    for chunk in chunks(requests, BATCH_WRITE_SIZE):
+        request = {table_name: chunk}
+
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                resp = client.batch_write_item(RequestItems=request)
+            except Exception as err:
+                if is_throttled(err) and attempt < MAX_ATTEMPTS - 1:
+                    backoff(attempt, "DDB throttled the request")
+                    continue
+                raise Exception(f"Failed to write {description} to DDB") from err
+
+            request = resp.get('UnprocessedItems')
+            if not request:
+                break
+
+            backoff(attempt, "DDB returned unprocessed items")
+        else:
+            raise Exception(f"Failed to write {description} to DDB, items left unprocessed")
+
+def is_throttled(err) -> bool:
+    """
+    Returns True if the request was rejected because the table capacity was exceeded
+    """
+
+    return getattr(err, 'response', {}).get('Error', {}).get('Code') in THROTTLING_ERRORS
+
+def backoff(attempt, reason):
+    """
+    Sleeps with exponential backoff before retrying
+    """
+
+    delay = min(BACKOFF * 2 ** attempt, MAX_BACKOFF)
+    logger.warning("%s, retrying in %.2fs", reason, delay)
+    time.sleep(delay)
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# CloudWatch namespace of the metrics extracted from the log lines
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'SSOSyncToRDS')
+
+# True until the first invocation of the container finishes
+COLD_START = True
+
+# Spans of the running invocation, shared with worker threads
+CURRENT = None
+LOCK = threading.Lock()
+
+class Invocation:
+    """
+    Durations and properties collected during one invocation
+    """
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.started = time.perf_counter()
+        self.durations = {}
+        self.calls = {}
+        self.properties = {}
+
+    def add(self, name, duration):
+        with LOCK:
+            self.durations[name] = self.durations.get(name, 0.0) + duration
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+@contextmanager
+def span(name):
+    """
+    Adds the duration of the block to the running invocation
+    Durations of spans with the same name are summed
+    """
+
+    invocation = CURRENT
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if invocation is not None:
+            invocation.add(name, time.perf_counter() - started)
+
+def timed(name):
+    """
+    Decorator recording every call of the function as a span
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+def set_property(name, value):
+    """
+    Adds a property to the metrics line of the running invocation
+    """
+
+    if CURRENT is not None:
+        CURRENT.properties[name] = value
+
+def instrument_handler(func):
+    """
+    Decorator for Lambda handlers
+    Emits one CloudWatch Embedded Metric Format line per invocation with
+    the total and per span durations, cold start flag and outcome
+    """
+
+    @functools.wraps(func)
+    def wrapper(event, context):
+        global CURRENT, COLD_START
+
+        function_name = getattr(context, 'function_name', None) or \
+            os.environ.get('AWS_LAMBDA_FUNCTION_NAME', func.__module__)
+        invocation = Invocation(function_name)
+        CURRENT = invocation
+        outcome = 'error'
+
+        try:
+            result = func(event, context)
+            # Batch handlers report failed records instead of raising
+            if isinstance(result, dict) and result.get('batchItemFailures'):
+                outcome = 'partial'
+            else:
+                outcome = 'success'
+            return result
+        finally:
+            CURRENT = None
+            emit(invocation, outcome, COLD_START)
+            COLD_START = False
+
+    return wrapper
+
+def instrument_client(client):
+    """
+    Records every API call of a boto3 client as a span named service.Operation
+    Uses botocore event hooks, so no extra calls are made
+    """
+
+    service = client.meta.service_model.service_name
+
+    def before_call(model, context, **kwargs):
+        context['metrics_span'] = (f"{service}.{model.name}", time.perf_counter())
+
+    # Also called on errors, with the exception instead of the response
+    def after_call(context, **kwargs):
+        name, started = context.get('metrics_span', (None, None))
+        if name is not None and CURRENT is not None:
+            CURRENT.add(name, time.perf_counter() - started)
+
+    client.meta.events.register('before-call', before_call)
+    client.meta.events.register('after-call', after_call)
+    client.meta.events.register('after-call-error', after_call)
+
+def emit(invocation, outcome, cold_start):
+    """
+    Prints the EMF line, CloudWatch extracts the metrics from the function logs
+    Never raises, metrics mustn't fail the invocation
+    """
+
+    if os.environ.get('METRICS_ENABLED', 'true').lower() == 'false':
+        return
+
+    try:
+        total = (time.perf_counter() - invocation.started) * 1000
+        durations = {name: round(value * 1000, 3) for name, value in invocation.durations.items()}
+        metrics = {'Duration': round(total, 3), **durations, 'ColdStart': int(cold_start),
+                   'Error': int(outcome == 'error')}
+
+        units = {'ColdStart': 'Count', 'Error': 'Count'}
+        line = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [['Function']],
+                    'Metrics': [
+                        {'Name': name, 'Unit': units.get(name, 'Milliseconds')} for name in metrics
+                    ],
+                }],
+            },
+            'Function': invocation.function_name,
+            'Outcome': outcome,
+            'Calls': invocation.calls,
+            **invocation.properties,
+            **metrics,
+        }
+
+        # Printed, not logged, the line must be plain JSON for EMF
+        print(json.dumps(line))
+    except Exception as err:
+        logger.warning("Failed to emit metrics: %s", err)
@@ -1,6 +1,94 @@
-import psycopg2
-from mysql import connector
+import os
+import time
+import random
+import logging
 
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Maximum number of user names per existence check query
+EXISTS_CHUNK_SIZE = 500
+
+# MySQL error raised by CREATE USER when the user already exists
+ER_CANNOT_USER = 1396
+
+# Attempts of queries failing with transient errors, base backoff in seconds doubled on every attempt
+# At least one attempt, or queries would silently do nothing
+RETRY_ATTEMPTS = max(1, int(os.environ.get('SQL_RETRY_ATTEMPTS', '3')))
+RETRY_BACKOFF = float(os.environ.get('SQL_RETRY_BACKOFF', '0.05'))
+RETRY_MAX_BACKOFF = float(os.environ.get('SQL_RETRY_MAX_BACKOFF', '1.0'))
+
+# Comment of the users created by this solution, tells them apart from existing unmanaged users
+# A user with this comment but no mapping was created by an interrupted call
+CREATED_BY = 'Created by SSO sync to Amazon RDS'
+
+# Results of provision_user
+CREATED = 'created'
+UPDATED = 'updated'
+EXISTS = 'exists'
+
+# Error codes of SQLError
+DEADLOCK = 'deadlock'
+LOCK_TIMEOUT = 'lock_timeout'
+SERIALIZATION_FAILURE = 'serialization_failure'
+TOO_MANY_CONNECTIONS = 'too_many_connections'
+CONNECTION_LOST = 'connection_lost'
+USER_CONFLICT = 'user_conflict'
+ROLE_NOT_FOUND = 'role_not_found'
+PERMISSION_DENIED = 'permission_denied'
+DEPENDENT_OBJECTS = 'dependent_objects'
+SYNTAX_ERROR = 'syntax_error'
+UNKNOWN = 'unknown'
+
+# Errors that can succeed if the query is sent again
+TRANSIENT_ERRORS = {DEADLOCK, LOCK_TIMEOUT, SERIALIZATION_FAILURE, TOO_MANY_CONNECTIONS, CONNECTION_LOST}
+
+# MySQL server and client error numbers
+MYSQL_ERRORS = {
+    1213: DEADLOCK,
+    1205: LOCK_TIMEOUT,
+    3572: LOCK_TIMEOUT,
+    1040: TOO_MANY_CONNECTIONS,
+    1203: TOO_MANY_CONNECTIONS,
+    2006: CONNECTION_LOST,
+    2013: CONNECTION_LOST,
+    2055: CONNECTION_LOST,
+    ER_CANNOT_USER: USER_CONFLICT,
+    3523: ROLE_NOT_FOUND,
+    1044: PERMISSION_DENIED,
+    1142: PERMISSION_DENIED,
+    1227: PERMISSION_DENIED,
+    1064: SYNTAX_ERROR,
+}
+
+# PostgreSQL SQLSTATE codes, class 08 is handled as a lost connection
+PG_ERRORS = {
+    '40P01': DEADLOCK,
+    '55P03': LOCK_TIMEOUT,
+    '40001': SERIALIZATION_FAILURE,
+    '53300': TOO_MANY_CONNECTIONS,
+    '57P01': CONNECTION_LOST,
+    '42710': USER_CONFLICT,
+    '42704': ROLE_NOT_FOUND,
+    '42501': PERMISSION_DENIED,
+    '2BP01': DEPENDENT_OBJECTS,
+    '42601': SYNTAX_ERROR,
+}
+
+class SQLError(Exception):
+    """
+    Raised by the executors when a query fails
+    code is one of the error codes above, db_code is the MySQL error number or PostgreSQL SQLSTATE
+    """
+    def __init__(self, message, code=UNKNOWN, db_code=None):
+        super().__init__(message)
+        self.code = code
+        self.db_code = db_code
+        self.transient = code in TRANSIENT_ERRORS
+        # Statements committed before the failure, set by MySQL write_multi
+        self.completed = 0
+        # Users a failed provision_batch created, set by provision_batch
+        self.created = []
 
 class SQLExecutor:
     def __init__(self, conn, engine):
@@ -18,8 +106,120 @@ class SQLExecutor:
     def create(self, user_name, friendly_name):
         self.executor.create(user_name, friendly_name)
 
-    def count_rows(self, user_name, friendly_name) -> int:
-        return self.executor.count_rows(user_name, friendly_name)
+    def existing_users(self, user_names, friendly_name) -> set:
+        return self.executor.existing_users(user_names, friendly_name)
+
+    def owned_users(self, user_names, friendly_name) -> set:
+        return self.executor.owned_users(user_names, friendly_name)
+
+    def provision_user(self, user_name, role, friendly_name, managed=False) -> str:
+        return self.executor.provision_user(user_name, role, friendly_name, managed)
+
+    def provision_batch(self, pairs, friendly_name, new_users=None):
+        self.executor.provision_batch(pairs, friendly_name, new_users)
+
+    def drop_batch(self, user_names, friendly_name):
+        self.executor.drop_batch(user_names, friendly_name)
+
+    def current_roles(self, user_names, friendly_name) -> dict:
+        return self.executor.current_roles(user_names, friendly_name)
+
+    def apply_roles(self, desired, friendly_name, managed_roles=None, current=None) -> tuple:
+        return self.executor.apply_roles(desired, friendly_name, managed_roles, current)
+
+def role_names(role) -> list:
+    """
+    Returns list of role names from a role name or a list of them
+    """
+
+    return [role] if isinstance(role, str) else list(role)
+
+def mysql_string(value: str) -> str:
+    """
+    Returns value as a MySQL string literal, for user and role names that can't be query parameters
+    """
+
+    return "'" + value.replace("\\", "\\\\").replace("'", "''") + "'"
+
+def pg_identifier(name: str) -> str:
+    """
+    Returns name as a quoted PostgreSQL identifier
+    """
+
+    return '"' + name.replace('"', '""') + '"'
+
+def pg_literal(value: str) -> str:
+    """
+    Returns value as a PostgreSQL string literal, backslashes are literal with standard_conforming_strings
+    """
+
+    return "'" + value.replace("'", "''") + "'"
+
+def group_by_role(pairs) -> dict:
+    """
+    Groups (user, role) pairs by role
+    Returns dict of role to the list of unique user names, preserving order
+    """
+
+    roles = {}
+    for user_name, role in pairs:
+        users = roles.setdefault(role, [])
+        if user_name not in users:
+            users.append(user_name)
+
+    return roles
+
+def diff_roles(desired, current, managed_roles=None) -> tuple:
+    """
+    Compares desired and current roles, dicts of user name to set of roles
+    Only roles in managed_roles are revoked if given, rds_iam is never revoked
+    Returns (grants, revokes) lists of (user, role) pairs
+    """
+
+    grants = []
+    revokes = []
+
+    for user_name, roles in desired.items():
+        user_roles = current.get(user_name, set())
+        grants += [(user_name, role) for role in sorted(set(roles) - user_roles)]
+        revokes += [
+            (user_name, role) for role in sorted(user_roles - set(roles))
+            if role != 'rds_iam' and (managed_roles is None or role in managed_roles)
+        ]
+
+    return grants, revokes
+
+def unique_users(pairs) -> list:
+    """
+    Returns unique user names from (user, role) pairs, preserving order
+    """
+
+    return list(dict.fromkeys(user_name for user_name, _ in pairs))
+
+def retry(func, friendly_name=""):
+    """
+    Calls func, retrying transient errors with exponential backoff and full jitter
+    Raises SQLError immediately on permanent errors and after RETRY_ATTEMPTS attempts
+    """
+
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return func()
+        except SQLError as err:
+            # Lost connections are replayed by the connection manager after reconnecting
+            if not err.transient or err.code == CONNECTION_LOST or attempt == RETRY_ATTEMPTS - 1:
+                raise
+            delay = random.uniform(0, min(RETRY_MAX_BACKOFF, RETRY_BACKOFF * 2 ** attempt))
+            logger.warning("Query %s failed with %s, retrying in %.2fs", friendly_name, err.code, delay)
+            time.sleep(delay)
+
+def chunks(items, size):
+    """
+    Splits a list into chunks of the given size
+    """
+
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 class MySQLExecutor:
     """
@@ -27,55 +227,267 @@ class MySQLExecutor:
     Methods support friendly_name for human readable errors
     """
     def __init__(self, conn):
+        # Driver is imported only when the engine is used
+        from mysql import connector
         self.conn = conn
+        self.db_error = connector.errors.Error
 
     def create(self, user_name: str, friendly_name="") -> None:
-        query = f"CREATE USER IF NOT EXISTS '{user_name}' IDENTIFIED WITH AWSAuthenticationPlugin as 'RDS';"
+        query = (
+            f"CREATE USER IF NOT EXISTS {mysql_string(user_name)} IDENTIFIED WITH AWSAuthenticationPlugin as 'RDS' "
+            f"COMMENT {mysql_string(CREATED_BY)};"
+        )
         self.write(query, friendly_name)
 
     def grant(self, user_name: str, role: str, friendly_name="") -> None:
-        query = f"GRANT '{role}' TO '{user_name}'@'%';"
+        query = f"GRANT {mysql_string(role)} TO {mysql_string(user_name)}@'%';"
         self.write(query, friendly_name)
 
     def drop(self, user_name: str, friendly_name=""):
-        query = f"DROP USER IF EXISTS '{user_name}';"
+        query = f"DROP USER IF EXISTS {mysql_string(user_name)};"
         self.write(query, friendly_name)
 
+    def provision_user(self, user_name: str, role, friendly_name="", managed=False) -> str:
+        """
+        Creates user if needed and grants role in a single multi-statement round trip
+        role is a role name or a list of role names
+        Managed users are created if missing, unmanaged users are never modified
+        Users created by an earlier call that didn't save the mapping are granted the roles as new ones
+        Returns CREATED, UPDATED or EXISTS if the user exists but isn't managed
+        Raises exception on errors, dropping the user if it was created by this call
+        """
+
+        # Without IF NOT EXISTS the batch stops before GRANT when the user exists
+        if_not_exists = "IF NOT EXISTS " if managed else ""
+        statements = [
+            f"CREATE USER {if_not_exists}{mysql_string(user_name)} IDENTIFIED WITH AWSAuthenticationPlugin as 'RDS' "
+            f"COMMENT {mysql_string(CREATED_BY)};",
+        ]
+        statements += [
+            f"GRANT {mysql_string(role_name)} TO {mysql_string(user_name)}@'%';" for role_name in role_names(role)
+        ]
+
+        try:
+            self.write_multi(statements, friendly_name)
+        except Exception as err:
+            if managed:
+                raise
+            if getattr(err, 'db_code', None) == ER_CANNOT_USER:
+                if user_name not in self.owned_users([user_name], "select owned user"):
+                    return EXISTS
+                self.provision_user(user_name, role, friendly_name, managed=True)
+                return CREATED
+            # MySQL commits DDL implicitly, drop the user only if this call's CREATE USER was committed
+            if getattr(err, 'completed', 0) >= 1:
+                try:
+                    self.drop(user_name, "drop user")
+                except Exception as drop_err:
+                    logger.error("Failed to drop user %s after failed provisioning: %s", user_name, drop_err)
+            raise
+
+        return UPDATED if managed else CREATED
+
+    def provision_batch(self, pairs, friendly_name="", new_users=None) -> None:
+        """
+        Creates users and grants roles for a list of (user, role) pairs
+        new_users limits which users are created, all users are created by default
+        Sends one CREATE USER statement and one GRANT statement per role in a single round trip
+        Each statement is atomic, but MySQL commits DDL implicitly between them
+        Raises SQLError on errors, created lists the new users if CREATE USER was committed
+        """
+
+        if new_users is None:
+            new_users = unique_users(pairs)
+
+        statements = []
+
+        # Without IF NOT EXISTS the statement fails if any of the users exists, so it creates all of them or none
+        if new_users:
+            users = ", ".join(
+                f"{mysql_string(user_name)} IDENTIFIED WITH AWSAuthenticationPlugin as 'RDS'"
+                for user_name in new_users
+            )
+            statements.append(f"CREATE USER {users} COMMENT {mysql_string(CREATED_BY)};")
+
+        for role, user_names in group_by_role(pairs).items():
+            users = ", ".join(f"{mysql_string(user_name)}@'%'" for user_name in user_names)
+            statements.append(f"GRANT {mysql_string(role)} TO {users};")
+
+        try:
+            self.write_multi(statements, friendly_name)
+        except SQLError as err:
+            err.created = list(new_users) if new_users and err.completed else []
+            raise
+
+    def drop_batch(self, user_names, friendly_name="") -> None:
+        if not user_names:
+            return
+        users = ", ".join(mysql_string(user_name) for user_name in user_names)
+        self.write(f"DROP USER IF EXISTS {users};", friendly_name)
+
+    def current_roles(self, user_names, friendly_name="") -> dict:
+        """
+        Reads role memberships of the users from mysql.role_edges
+        Runs one query per EXISTS_CHUNK_SIZE names
+        Returns dict of user name to set of roles
+        """
+
+        roles = {user_name: set() for user_name in user_names}
+        for chunk in chunks(list(roles), EXISTS_CHUNK_SIZE):
+            placeholders = ", ".join(["%s"] * len(chunk))
+            query = (
+                "SELECT TO_USER, FROM_USER FROM mysql.role_edges "
+                f"WHERE TO_HOST = %s AND TO_USER IN ({placeholders});"
+            )
+            for user_name, role in self.read(query, ('%', *chunk), friendly_name):
+                roles[user_name].add(role)
+
+        return roles
+
+    def apply_roles(self, desired, friendly_name="", managed_roles=None, current=None) -> tuple:
+        """
+        Grants and revokes roles so the users have exactly the desired roles
+        desired is dict of user name to roles, current roles are read in one query unless given
+        Sends one GRANT and one REVOKE statement per role in a single round trip, skipping no-op changes
+        Returns (grants, revokes) lists of the applied (user, role) pairs
+        """
+
+        if current is None:
+            current = self.current_roles(list(desired), friendly_name)
+
+        grants, revokes = diff_roles(desired, current, managed_roles)
+
+        statements = []
+        for role, user_names in group_by_role(grants).items():
+            users = ", ".join(f"{mysql_string(user_name)}@'%'" for user_name in user_names)
+            statements.append(f"GRANT {mysql_string(role)} TO {users};")
+        for role, user_names in group_by_role(revokes).items():
+            users = ", ".join(f"{mysql_string(user_name)}@'%'" for user_name in user_names)
+            statements.append(f"REVOKE {mysql_string(role)} FROM {users};")
+
+        self.write_multi(statements, friendly_name)
+
+        return grants, revokes
+
     def write(self, query: str, friendly_name="") -> None:
         """
-        Executes SQL queries
-        Raises exception on errors
+        Executes SQL queries, retrying transient errors
+        Raises SQLError on errors
         Doesn't return results
         """
 
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute(query)
-        except connector.errors.Error as err:
-            raise Exception(f"Failed to execute {friendly_name} query: {err.msg}") from err
-        finally:
-            cursor.close()
+        retry(lambda: self.execute(query, friendly_name=friendly_name), friendly_name)
 
-    def count_rows(self, user_name: str, friendly_name="") -> int:
+    def write_multi(self, statements, friendly_name="") -> None:
         """
-        Executes SQL queries
-        Raises exception on errors
-        Returns number of rows
+        Executes several SQL statements in a single round trip
+        Execution stops at the first failing statement
+        Transient errors are retried from the failed statement
+        Raises SQLError on errors
+        """
+
+        if not statements:
+            return
+
+        pending = list(statements)
+
+        def run():
+            completed = 0
+            cursor = None
+            try:
+                cursor = self.conn.cursor()
+                # Connector 9.2+ runs multiple statements natively, results are consumed with nextset
+                cursor.execute("\n".join(pending))
+                completed = 1
+                while cursor.nextset():
+                    completed += 1
+            except self.db_error as err:
+                # Every statement is committed on its own, the ones before the failure aren't sent again
+                del pending[:completed]
+                error = self.error(err, friendly_name)
+                error.completed = len(statements) - len(pending)
+                raise error from err
+            finally:
+                if cursor is not None:
+                    cursor.close()
+
+        retry(run, friendly_name)
+
+    def read(self, query: str, params=None, friendly_name="") -> list:
+        """
+        Executes SQL queries with optional parameters, retrying transient errors
+        Raises SQLError on errors
+        Returns all rows
         """
 
-        query = f"SELECT user FROM mysql.user WHERE user = '{user_name}';"
+        return retry(lambda: self.execute(query, params, friendly_name, fetch=True), friendly_name)
 
+    def execute(self, query: str, params=None, friendly_name="", fetch=False) -> list:
+        """
+        Executes SQL query once
+        Raises SQLError on errors
+        Returns all rows if fetch is set
+        """
+
+        cursor = None
         try:
             cursor = self.conn.cursor()
-            cursor.execute(query)
-            cursor.fetchall()
-            row_count = cursor.rowcount
-        except connector.errors.Error as err:
-            raise Exception(f"Failed to execute {friendly_name} query: {err.msg}") from err
+            cursor.execute(query, params)
+            return cursor.fetchall() if fetch else []
+        except self.db_error as err:
+            raise self.error(err, friendly_name) from err
         finally:
-            cursor.close()
+            if cursor is not None:
+                cursor.close()
+
+    def error(self, err, friendly_name="") -> SQLError:
+        """
+        Returns SQLError with the error code of the driver error
+        """
 
-        return row_count
+        errno = getattr(err, 'errno', None)
+        return SQLError(
+            f"Failed to execute {friendly_name} query: {err.msg}", MYSQL_ERRORS.get(errno, UNKNOWN), errno
+        )
+
+    def existing_users(self, user_names, friendly_name="") -> set:
+        """
+        Checks which of the user names exist in the database
+        Runs one query per EXISTS_CHUNK_SIZE names, or a single row probe for one name
+        Returns set of existing user names
+        """
+
+        names = list(dict.fromkeys(user_names))
+        if len(names) == 1:
+            query = "SELECT 1 FROM mysql.user WHERE user = %s LIMIT 1;"
+            return set(names) if self.read(query, (names[0],), friendly_name) else set()
+
+        existing = set()
+        for chunk in chunks(names, EXISTS_CHUNK_SIZE):
+            placeholders = ", ".join(["%s"] * len(chunk))
+            query = f"SELECT DISTINCT user FROM mysql.user WHERE user IN ({placeholders});"
+            existing.update(row[0] for row in self.read(query, tuple(chunk), friendly_name))
+
+        return existing
+
+    def owned_users(self, user_names, friendly_name="") -> set:
+        """
+        Checks which of the user names were created by this solution, by the comment of the user
+        Runs one query per EXISTS_CHUNK_SIZE names
+        Returns set of owned user names
+        """
+
+        owned = set()
+        for chunk in chunks(list(dict.fromkeys(user_names)), EXISTS_CHUNK_SIZE):
+            placeholders = ", ".join(["%s"] * len(chunk))
+            query = (
+                "SELECT USER FROM INFORMATION_SCHEMA.USER_ATTRIBUTES "
+                f"WHERE HOST = %s AND USER IN ({placeholders}) "
+                "AND JSON_UNQUOTE(JSON_EXTRACT(ATTRIBUTE, '$.comment')) = %s;"
+            )
+            owned.update(row[0] for row in self.read(query, ('%', *chunk, CREATED_BY), friendly_name))
+
+        return owned
 
 class PGExecutor:
     """
@@ -83,55 +495,262 @@ class PGExecutor:
     Methods support friendly_name for human readable errors
     """
     def __init__(self, conn):
+        # Driver is imported only when the engine is used
+        import psycopg2
         self.conn = conn
         self.conn.autocommit = True
+        self.driver = psycopg2
+        self.db_error = psycopg2.Error
 
     def create(self, user_name: str, friendly_name="") -> None:
-        query = f'CREATE USER "{user_name}";'
+        query = f'CREATE USER {pg_identifier(user_name)};'
+        self.write(query, friendly_name)
+        query = f'COMMENT ON ROLE {pg_identifier(user_name)} IS {pg_literal(CREATED_BY)};'
         self.write(query, friendly_name)
-        query = f'GRANT rds_iam to "{user_name}";'
+        query = f'GRANT rds_iam to {pg_identifier(user_name)};'
         self.write(query, friendly_name)
 
     def grant(self, user_name: str, role: str, friendly_name="") -> None:
-        query = f'GRANT "{role}" TO "{user_name}";'
+        query = f'GRANT {pg_identifier(role)} TO {pg_identifier(user_name)};'
         self.write(query, friendly_name)
 
     def drop(self, user_name: str, friendly_name=""):
-        query = f'DROP USER IF EXISTS "{user_name}";'
+        query = f'DROP USER IF EXISTS {pg_identifier(user_name)};'
         self.write(query, friendly_name)
 
-    def write(self, query: str, friendly_name="") -> None:
+    def provision_user(self, user_name: str, role, friendly_name="", managed=False) -> str:
         """
-        Executes SQL queries
+        Creates user if needed and grants roles in a single round trip
+        role is a role name or a list of role names
+        Runs as one DO block, so all changes are rolled back on errors
+        Managed users are created if missing, unmanaged users are never modified
+        Users created by an earlier call that didn't save the mapping are granted the roles as new ones
+        Returns CREATED, UPDATED or EXISTS if the user exists but isn't managed
         Raises exception on errors
+        """
+
+        user = pg_identifier(user_name)
+        grants = "".join(f"""
+    GRANT {pg_identifier(role_name)} TO {user};""" for role_name in role_names(role))
+        create = f"""
+    CREATE USER {user};
+    COMMENT ON ROLE {user} IS {pg_literal(CREATED_BY)};
+    GRANT rds_iam TO {user};{grants}
+    PERFORM set_config('sso_sync.result', '{CREATED}', false);"""
+
+        # Existing users are only granted the memberships they're missing
+        missing = "".join(f"""
+    IF NOT pg_has_role({pg_literal(user_name)}, {pg_literal(role_name)}, 'MEMBER') THEN
+      GRANT {pg_identifier(role_name)} TO {user};
+    END IF;""" for role_name in ['rds_iam', *role_names(role)])
+
+        if managed:
+            existing = f"""{missing}
+    PERFORM set_config('sso_sync.result', '{UPDATED}', false);"""
+        else:
+            existing = f"""
+    IF EXISTS (SELECT 1 FROM pg_catalog.pg_roles WHERE rolname = {pg_literal(user_name)}
+               AND pg_catalog.shobj_description(oid, 'pg_authid') = {pg_literal(CREATED_BY)}) THEN{missing}
+      PERFORM set_config('sso_sync.result', '{CREATED}', false);
+    ELSE
+      PERFORM set_config('sso_sync.result', '{EXISTS}', false);
+    END IF;"""
+
+        body = f"""
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_catalog.pg_roles WHERE rolname = {pg_literal(user_name)}) THEN{existing}
+  ELSE{create}
+  END IF;
+END
+"""
+
+        # The body is passed as a string literal, so names can't end a dollar-quoted block
+        # The DO block can't return values, the result is passed in a session setting
+        query = f"""DO {pg_literal(body)};
+SELECT current_setting('sso_sync.result');"""
+
+        return self.read(query, friendly_name=friendly_name)[0][0]
+
+    def provision_batch(self, pairs, friendly_name="", new_users=None) -> None:
+        """
+        Creates users and grants roles for a list of (user, role) pairs
+        new_users limits which users are created, all users are created by default
+        Sends all statements in a single round trip inside one transaction
+        Raises SQLError on errors, the transaction is rolled back so created is empty
+        """
+
+        if new_users is None:
+            new_users = unique_users(pairs)
+
+        statements = [f'CREATE USER {pg_identifier(user_name)};' for user_name in new_users]
+        statements += [
+            f'COMMENT ON ROLE {pg_identifier(user_name)} IS {pg_literal(CREATED_BY)};' for user_name in new_users
+        ]
+        if new_users:
+            users = ", ".join(pg_identifier(user_name) for user_name in new_users)
+            statements.append(f'GRANT rds_iam TO {users};')
+
+        for role, user_names in group_by_role(pairs).items():
+            users = ", ".join(pg_identifier(user_name) for user_name in user_names)
+            statements.append(f'GRANT {pg_identifier(role)} TO {users};')
+
+        self.write_transaction(statements, friendly_name)
+
+    def drop_batch(self, user_names, friendly_name="") -> None:
+        if not user_names:
+            return
+        users = ", ".join(pg_identifier(user_name) for user_name in user_names)
+        self.write(f'DROP USER IF EXISTS {users};', friendly_name)
+
+    def current_roles(self, user_names, friendly_name="") -> dict:
+        """
+        Reads direct role memberships of the users from pg_auth_members
+        Runs one query per EXISTS_CHUNK_SIZE names
+        Returns dict of user name to set of roles
+        """
+
+        roles = {user_name: set() for user_name in user_names}
+        for chunk in chunks(list(roles), EXISTS_CHUNK_SIZE):
+            query = """SELECT m.rolname, r.rolname FROM pg_catalog.pg_auth_members a
+JOIN pg_catalog.pg_roles r ON r.oid = a.roleid
+JOIN pg_catalog.pg_roles m ON m.oid = a.member
+WHERE m.rolname = ANY(%s);"""
+            for user_name, role in self.read(query, (chunk,), friendly_name):
+                roles[user_name].add(role)
+
+        return roles
+
+    def apply_roles(self, desired, friendly_name="", managed_roles=None, current=None) -> tuple:
+        """
+        Grants and revokes roles so the users have exactly the desired roles
+        desired is dict of user name to roles, current roles are read in one query unless given
+        Sends one GRANT and one REVOKE statement per role in a single transaction, skipping no-op changes
+        Returns (grants, revokes) lists of the applied (user, role) pairs
+        """
+
+        if current is None:
+            current = self.current_roles(list(desired), friendly_name)
+
+        grants, revokes = diff_roles(desired, current, managed_roles)
+
+        statements = []
+        for role, user_names in group_by_role(grants).items():
+            users = ", ".join(pg_identifier(user_name) for user_name in user_names)
+            statements.append(f'GRANT {pg_identifier(role)} TO {users};')
+        for role, user_names in group_by_role(revokes).items():
+            users = ", ".join(pg_identifier(user_name) for user_name in user_names)
+            statements.append(f'REVOKE {pg_identifier(role)} FROM {users};')
+
+        self.write_transaction(statements, friendly_name)
+
+        return grants, revokes
+
+    def write_transaction(self, statements, friendly_name="") -> None:
+        """
+        Executes SQL statements in a single round trip inside one transaction
+        Transient errors are retried with the whole transaction
+        Rolls back and raises SQLError on errors
+        """
+
+        if not statements:
+            return
+
+        query = "BEGIN;\n" + "\n".join(statements) + "\nCOMMIT;"
+
+        def run():
+            try:
+                self.execute(query, friendly_name=friendly_name)
+            except SQLError as err:
+                # The failed transaction stays open until rolled back
+                if err.code != CONNECTION_LOST:
+                    self.execute("ROLLBACK;", friendly_name="rollback")
+                raise
+
+        retry(run, friendly_name)
+
+    def write(self, query: str, friendly_name="") -> None:
+        """
+        Executes SQL queries, retrying transient errors
+        Raises SQLError on errors
         Doesn't return results
         """
 
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute(query)
-        except psycopg2.OperationalError as err:
-            raise Exception(f"Failed to execute {friendly_name} query: {err.msg}") from err
-        finally:
-            cursor.close()
+        retry(lambda: self.execute(query, friendly_name=friendly_name), friendly_name)
 
-    def count_rows(self, user_name: str, friendly_name="") -> int:
+    def read(self, query: str, params=None, friendly_name="") -> list:
         """
-        Executes SQL queries
-        Raises exception on errors
-        Returns number of rows
+        Executes SQL queries with optional parameters, retrying transient errors
+        Raises SQLError on errors
+        Returns all rows
         """
 
-        query = f"SELECT usename FROM pg_catalog.pg_user WHERE usename = '{user_name}';"
+        return retry(lambda: self.execute(query, params, friendly_name, fetch=True), friendly_name)
+
+    def execute(self, query: str, params=None, friendly_name="", fetch=False) -> list:
+        """
+        Executes SQL query once
+        Raises SQLError on errors
+        Returns all rows if fetch is set
+        """
 
+        cursor = None
         try:
             cursor = self.conn.cursor()
-            cursor.execute(query)
-            cursor.fetchall()
-            row_count = cursor.rowcount
-        except psycopg2.OperationalError as err:
-            raise Exception(f"Failed to execute {friendly_name} query: {err.msg}") from err
+            cursor.execute(query, params)
+            return cursor.fetchall() if fetch else []
+        except self.db_error as err:
+            raise self.error(err, friendly_name) from err
         finally:
-            cursor.close()
+            if cursor is not None:
+                cursor.close()
+
+    def error(self, err, friendly_name="") -> SQLError:
+        """
+        Returns SQLError with the error code of the driver error
+        psycopg2 errors have no msg, the server message is the string value
+        """
+
+        pgcode = getattr(err, 'pgcode', None)
+        code = PG_ERRORS.get(pgcode, UNKNOWN)
+
+        # Errors without SQLSTATE are raised by the driver when the connection is broken
+        if (pgcode or '').startswith('08') or (pgcode is None and isinstance(
+                err, (self.driver.InterfaceError, self.driver.OperationalError))):
+            code = CONNECTION_LOST
+
+        message = str(err).strip() or type(err).__name__
+        return SQLError(f"Failed to execute {friendly_name} query: {message}", code, pgcode)
+
+    def existing_users(self, user_names, friendly_name="") -> set:
+        """
+        Checks which of the user names exist in the database
+        Runs one query per EXISTS_CHUNK_SIZE names, or a single row probe for one name
+        Returns set of existing user names
+        """
+
+        names = list(dict.fromkeys(user_names))
+        if len(names) == 1:
+            query = "SELECT 1 FROM pg_catalog.pg_user WHERE usename = %s LIMIT 1;"
+            return set(names) if self.read(query, (names[0],), friendly_name) else set()
+
+        existing = set()
+        for chunk in chunks(names, EXISTS_CHUNK_SIZE):
+            query = "SELECT usename FROM pg_catalog.pg_user WHERE usename = ANY(%s);"
+            existing.update(row[0] for row in self.read(query, (chunk,), friendly_name))
+
+        return existing
+
+    def owned_users(self, user_names, friendly_name="") -> set:
+        """
+        Checks which of the user names were created by this solution, by the comment of the role
+        Runs one query per EXISTS_CHUNK_SIZE names
+        Returns set of owned user names
+        """
+
+        owned = set()
+        for chunk in chunks(list(dict.fromkeys(user_names)), EXISTS_CHUNK_SIZE):
+            query = """SELECT rolname FROM pg_catalog.pg_roles
+WHERE rolname = ANY(%s) AND pg_catalog.shobj_description(oid, 'pg_authid') = %s;"""
+            owned.update(row[0] for row in self.read(query, (chunk, CREATED_BY), friendly_name))
 
-        return row_count
+        return owned
@@ -0,0 +1,334 @@
+import logging
+import connection_manager
+import mapping_store
+from sql_executor import CREATED, EXISTS, chunks
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Users dropped by a single DROP USER statement when a group is deleted
+DROP_BATCH_SIZE = 100
+
+# Per user results of a group delete
+DROPPED = 'dropped'
+NOT_FOUND = 'not_found'
+FAILED = 'failed'
+
+def sync_user(user_name, user_id, role_name, executor, ddb_table, group_ids=None, member_table=None):
+    """
+    Creates a single user, grants role and records user mapping
+    role_name is a role name or a list of role names, granted together
+    The DB changes are applied in a single round trip to every DB target
+    Rolls back the DB user if the mapping can't be saved
+    Records the group memberships if the membership table is configured
+    Raises exception if not successful
+    """
+
+    # Check if managed (exists in DynamoDB), managed users can be modified if they exist
+    managed_user = check_if_managed_user(user_id, user_name, ddb_table)
+
+    # Create user and grant role in the db
+    try:
+        results = provision_user(user_name, role_name, managed_user, executor)
+    except connection_manager.TargetsError as err:
+        logger.error("Failed to provision user in the db. Does the role %s exist in the DB?", role_name)
+        logger.error(err)
+        # Don't leave a new unmanaged user behind on the targets that succeeded
+        if not managed_user:
+            rollback_created(user_name, err.results, executor)
+        raise Exception("Failed to provision user in the db") from err
+
+    # If user exists on any target but not managed, don't modify it
+    if EXISTS in results.values():
+        logger.error("User already exists in the database, but not managed. Exiting")
+        rollback_created(user_name, results, executor)
+        return
+
+    # Add user mapping to DynamoDB if it doesn't exist
+    if not managed_user:
+        try:
+            create_user_mapping(user_id=user_id, user_name=user_name, ddb_table=ddb_table)
+        # Rollback on error
+        except Exception as err:
+            logger.info("Rolling back changes")
+            rollback(user_name, executor)
+            logger.error(err)
+            raise Exception("Failed to create user in DynamoDB") from err
+
+    # The user is managed now, a retry only records the memberships again
+    record_memberships(user_id, group_ids, member_table)
+
+def rollback(user_name, executor):
+    """
+    Deletes database user
+    """
+
+    logger.info("Deleting user %s from the DB", user_name)
+    executor.drop(user_name, friendly_name="drop user")
+    logging.info("Deleted user from the database")
+
+def rollback_created(user_name, results, executor):
+    """
+    Deletes database user from the DB targets where it was just created
+    """
+
+    created = [target for target, result in results.items() if result == CREATED]
+
+    if not created:
+        return
+
+    logger.info("Rolling back user %s on %d DB targets", user_name, len(created))
+    rollback(user_name, executor.only(created))
+
+def provision_user(user_name, role, managed_user, executor):
+    """
+    Creates user if needed and grants role to the user on every DB target
+    Returns dict of target name to sql_executor result: created, updated or exists
+    """
+
+    logger.info("Provisioning user %s with role %s in the DB", user_name, role)
+    results = executor.provision_user(user_name, role, friendly_name="provision user", managed=managed_user)
+    logger.info("Provisioned RDS user %s: %s", user_name, results)
+
+    return results
+
+def check_if_managed_user(user_id, user_name, ddb_table):
+    """
+    Checks if user mapping already exists in DynamoDB
+    This allows to determine whether the user is managed by the solution or not
+    """
+
+    logger.info("Fetching user %s from DDB", user_name)
+    managed_user = False
+
+    try:
+        resp = ddb_table.get_item(
+            Key={
+                'userID': user_id
+            }
+        )
+        user_data = resp.get('Item')
+        # If record exists in DDB, the user is managed
+        if user_data is not None:
+            managed_user = True
+    # Keep user as not managed as a fail-safe
+    except Exception as err:
+        logger.error("Failed to get user mapping from DDB")
+        logger.error(err)
+        logger.warning("Assuming the user is not managed")
+
+    return managed_user
+
+def create_user_mapping(user_id, user_name, ddb_table):
+    """
+    Creates user ID to username mapping in DynamoDB
+    Manages DDB connections
+    Raises exception if not successful
+    """
+
+    logger.info("Creating user ID to username mapping in DDB for user %s", user_name)
+
+    try:
+        item = {'userID': user_id, 'username': user_name}
+        ddb_table.put_item(Item=item)
+    except Exception as err:
+        logger.error("Failed to save user mapping to DDB")
+        logger.error(err)
+        raise Exception("Failed to save user mapping to DDB") from err
+
+    logger.info("Successfully created user ID to username mapping")
+
+def record_memberships(user_id, group_ids, member_table):
+    """
+    Records the user as a member of the groups, so deleting a group can offboard the user
+    Raises exception if not successful
+    """
+
+    if member_table is None or not group_ids:
+        return
+
+    try:
+        mapping_store.put_memberships(member_table, [(group_id, user_id) for group_id in group_ids])
+    except Exception as err:
+        raise Exception("Failed to save group memberships to DDB") from err
+
+def delete_memberships(user_id, member_table):
+    """
+    Deletes all group memberships of the user, the user is no longer managed
+    Raises exception if not successful
+    """
+
+    if member_table is None:
+        return
+
+    try:
+        group_ids = mapping_store.query_groups(member_table, user_id)
+        mapping_store.delete_memberships(member_table, [(group_id, user_id) for group_id in group_ids])
+    except Exception as err:
+        raise Exception("Failed to delete group memberships from DDB") from err
+
+def delete_user(user_id, event_name, ddb_table, get_executor, member_table=None):
+    """
+    Deletes user from every DB target, the user mapping and group memberships
+    get_executor is called only when there is a user to delete, so no DB connection is opened otherwise
+    Raises exceptions on errors
+    """
+
+    # Get username from DynamoDB
+    user_name = get_user_name(user_id, ddb_table)
+
+    # Event type is required
+    if event_name is None:
+        logger.error("Event type not found")
+        raise ValueError("Event type is required but not found")
+
+    # When removing member from a group, it's expected to be recorded in DDB
+    if event_name == 'RemoveMemberFromGroup' and user_name is None:
+        raise Exception("Removing member from a group, but username not found in DynamoDB")
+
+    # Return if username mapping not in DDB, memberships left by a failed attempt are deleted
+    if user_name is None:
+        logger.warning("Username not found, nothing to delete")
+        delete_memberships(user_id, member_table)
+        return
+
+    # Init DB executor for all DB targets, (re)connects if a connection doesn't exist or is stale
+    executor = get_executor()
+
+    # Delete user from every DB target, keep the mapping for a retry if any of them fails
+    delete_db_user(user_name, executor)
+    delete_user_mapping(user_id, ddb_table)
+    delete_memberships(user_id, member_table)
+
+def delete_group(group_id, ddb_table, member_table, get_executor) -> dict:
+    """
+    Deletes every recorded member of a deleted group from every DB target, with their mappings and memberships
+    Members of other configured groups are deleted too, like a user removed from one of the groups
+    Users are dropped in batches on the same DB connections, one at a time if a batch fails
+    Returns dict of user ID to result: dropped, not_found (no mapping) or failed
+    Raises exception if any user failed, so a retry processes the remaining ones
+    """
+
+    if member_table is None:
+        raise Exception("Group membership table not configured, members of the deleted group are unknown")
+
+    user_ids = mapping_store.query_members(member_table, group_id)
+
+    if not user_ids:
+        logger.info("No members of group %s recorded, nothing to delete", group_id)
+        return {}
+
+    user_names = mapping_store.get_user_names(ddb_table, user_ids)
+    results = {user_id: NOT_FOUND for user_id in user_ids if user_id not in user_names}
+
+    if user_names:
+        # Init DB executor for all DB targets, (re)connects if a connection doesn't exist or is stale
+        dropped = drop_users(list(user_names.values()), get_executor())
+        for user_id, user_name in user_names.items():
+            results[user_id] = DROPPED if user_name in dropped else FAILED
+
+        # Mappings of the failed users are kept for a retry
+        mapping_store.delete_mappings(
+            ddb_table, [user_id for user_id, result in results.items() if result == DROPPED]
+        )
+
+    # Memberships in other groups go too, the users are no longer managed
+    done = [user_id for user_id, result in results.items() if result != FAILED]
+    memberships = [(group_id, user_id) for user_id in done]
+    for user_id in done:
+        memberships += [(other_id, user_id) for other_id in mapping_store.query_groups(member_table, user_id)]
+    mapping_store.delete_memberships(member_table, memberships)
+
+    counts = {result: list(results.values()).count(result) for result in (DROPPED, NOT_FOUND, FAILED)}
+    logger.info("Deleted members of group %s: %s", group_id, counts)
+
+    failed = [user_id for user_id, result in results.items() if result == FAILED]
+    if failed:
+        logger.error("Failed to delete user IDs %s", failed)
+        raise Exception(f"Failed to delete {len(failed)} of {len(user_ids)} members of group {group_id}")
+
+    return results
+
+def drop_users(user_names, executor) -> set:
+    """
+    Deletes users from every DB target with one DROP USER statement per chunk
+    Falls back to one user at a time if a chunk fails
+    Returns set of deleted usernames
+    """
+
+    dropped = set()
+
+    for chunk in chunks(user_names, DROP_BATCH_SIZE):
+        try:
+            executor.drop_batch(chunk, friendly_name="drop users")
+            dropped.update(chunk)
+            continue
+        except Exception as err:
+            logger.error("Batch drop failed, falling back to one user at a time")
+            logger.error(err)
+
+        for user_name in chunk:
+            try:
+                delete_db_user(user_name, executor)
+                dropped.add(user_name)
+            except Exception as err:
+                logger.error("Failed to delete user %s", user_name)
+                logger.error(err)
+
+    logger.info("Deleted %d of %d users from %d DB targets", len(dropped), len(user_names), len(executor.targets))
+    return dropped
+
+def get_user_name(user_id, ddb_table):
+    """
+    Returns username from DynamoDB table if exists
+    Returns None otherwise
+    Raises exceptions on errors
+    """
+
+    logger.info("Retrieving user ID %s from DynamoDB", user_id)
+
+    try:
+        resp = ddb_table.get_item(
+            Key={
+                'userID': user_id
+            }
+        )
+        data = resp['Item']
+        logger.info(data)
+        user_name = data['username']
+    except KeyError:
+        logger.warning("User ID %s not found in DDB", user_id)
+        return None
+    except Exception as err:
+        raise Exception("Failed to get user mapping from DDB") from err
+
+    logger.info("Found username %s", user_name)
+    return user_name
+
+def delete_db_user(user_name, executor):
+    """
+    Deletes user from the database on every DB target if exists
+    """
+
+    logger.info("Deleting user %s from the DB", user_name)
+    executor.drop(user_name, friendly_name="drop user")
+    logger.info("Deleted RDS user %s from %d DB targets", user_name, len(executor.targets))
+
+def delete_user_mapping(user_id, ddb_table):
+    """
+    Deletes user ID to username mapping from DynamoDB
+    Raises exceptions on errors
+    """
+
+    logger.info("Retrieving user ID %s from DynamoDB", user_id)
+
+    try:
+        ddb_table.delete_item(
+            Key={
+                'userID': user_id
+            }
+        )
+    except Exception as err:
+        raise Exception("Failed to delete user mapping from DDB") from err
+
+    logger.info("Deleted user mapping from DynamoDB")
@@ -0,0 +1,321 @@
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import aws_clients
+import connection_manager
+import mapping_store
+import metrics
+from sql_executor import chunks
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Number of parallel workers for Identity Store lookups and DB changes
+CONCURRENCY = int(os.environ.get('RECONCILE_CONCURRENCY', '4'))
+# Number of users provisioned or dropped by a single worker call
+CHUNK_SIZE = 100
+
+# One DB connection per worker thread, DB-API connections aren't thread-safe
+THREAD_LOCAL = threading.local()
+
+@metrics.instrument_handler
+@connection_manager.release_connections
+def handler(event, context):
+    """
+    Handler function, entry point for Lambda
+    Reconciles configured group memberships with the DB users, their roles and DynamoDB mappings
+    Applies only the delta and returns timings and counts
+    """
+
+    event = event or {}
+    identitystore_id = event.get('identity_store_id', os.environ.get('IDENTITYSTORE_ID'))
+    group_ids = event.get('group_ids') or json.loads(os.environ.get('IDENTITYSTORE_GROUP_IDS', '{}'))
+    dry_run = event.get('dry_run', False)
+    # Members of the groups left out of an override would look like orphans, so deleting must be asked for
+    delete_orphans = event.get('delete_orphans', not event.get('group_ids'))
+
+    if not identitystore_id or not group_ids:
+        logger.error("Identity Store ID or group IDs are not configured")
+        raise ValueError("Identity Store ID and group IDs are required")
+
+    timings = {}
+    started = time.perf_counter()
+    client = aws_clients.get_client('identitystore')
+
+    # Desired state from Identity Store
+    phase = time.perf_counter()
+    memberships = set()
+    members = get_group_members(client, identitystore_id, group_ids, memberships)
+    timings['memberships'] = elapsed(phase)
+
+    # Current state from DynamoDB
+    phase = time.perf_counter()
+    ddb_table = connection_manager.get_ddb_table()
+    mappings = mapping_store.scan_mappings(ddb_table)
+    timings['mappings'] = elapsed(phase)
+
+    # Usernames are only needed for members that aren't mapped yet
+    phase = time.perf_counter()
+    user_names = resolve_user_names(
+        client, identitystore_id, [user_id for user_id in members if user_id not in mappings]
+    )
+    timings['user_lookups'] = elapsed(phase)
+
+    # Current state from the DB
+    phase = time.perf_counter()
+    db_conn = connection_manager.ManagedConnection()
+    candidates = set(mappings.values()) | set(user_names.values())
+    existing = db_conn.executor().existing_users(list(candidates), friendly_name="select users")
+    # Unmapped users created by this solution are completed instead of skipped as unmanaged
+    unmapped = [user_name for user_name in user_names.values() if user_name in existing]
+    owned = db_conn.executor().owned_users(unmapped, friendly_name="select owned users") if unmapped else set()
+    timings['db_users'] = elapsed(phase)
+
+    # Current roles of the managed users, read in one query
+    phase = time.perf_counter()
+    managed_in_db = [
+        mappings[user_id] for user_id in members
+        if user_id in mappings and mappings[user_id] in existing
+    ]
+    current_roles = db_conn.executor().current_roles(managed_in_db, friendly_name="select roles")
+    timings['db_roles'] = elapsed(phase)
+    # Workers use their own connections, the pooled one is needed back
+    db_conn.close()
+
+    # Only roles of the configured groups are revoked, other grants are left as they are
+    managed_roles = set(group_ids.values())
+    to_create, to_update, to_delete, counts = plan(
+        members, mappings, user_names, existing, owned, current_roles, managed_roles, delete_orphans
+    )
+    logger.info("Reconciliation plan: %s", counts)
+
+    if dry_run:
+        logger.info("Dry run, not applying changes")
+    else:
+        phase = time.perf_counter()
+        failed = apply(to_create, to_update, to_delete, ddb_table)
+        counts['failed'] = len(failed)
+        counts['failed_user_ids'] = failed[:20]
+        timings['apply'] = elapsed(phase)
+
+        # Recorded memberships are needed to offboard the members of a deleted group
+        member_table = connection_manager.get_member_table()
+        if member_table is not None:
+            phase = time.perf_counter()
+            counts['memberships'] = reconcile_memberships(memberships, set(group_ids), set(failed), member_table)
+            timings['memberships_apply'] = elapsed(phase)
+
+    timings['total'] = elapsed(started)
+    logger.info("Reconciliation finished in %.2fs: %s", timings['total'], counts)
+
+    return {"status": "Success", "dry_run": dry_run, "counts": counts, "timings": timings}
+
+def get_group_members(client, identitystore_id, group_ids, memberships):
+    """
+    Pages through the memberships of every configured group
+    Adds (group ID, user ID) of every membership to memberships
+    Returns dict of user ID to the list of role names
+    """
+
+    members = {}
+
+    for group_id, role_name in group_ids.items():
+        paginator = client.get_paginator('list_group_memberships')
+        pages = paginator.paginate(IdentityStoreId=identitystore_id, GroupId=group_id)
+        count = 0
+
+        for page in pages:
+            for membership in page.get('GroupMemberships', []):
+                user_id = membership.get('MemberId', {}).get('UserId')
+                if user_id is None:
+                    continue
+                roles = members.setdefault(user_id, [])
+                if role_name not in roles:
+                    roles.append(role_name)
+                memberships.add((group_id, user_id))
+                count += 1
+
+        logger.info("Found %d members in group %s", count, role_name)
+
+    return members
+
+def resolve_user_names(client, identitystore_id, user_ids):
+    """
+    Looks up usernames in Identity Store with bounded concurrency
+    Returns dict of user ID to username for the users that were found
+    """
+
+    def describe(user_id):
+        try:
+            user_data = client.describe_user(IdentityStoreId=identitystore_id, UserId=user_id)
+            return user_id, user_data.get('UserName')
+        except Exception as err:
+            logger.error("Failed to get user data for user id %s", user_id)
+            logger.error(err)
+            return user_id, None
+
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+        results = pool.map(describe, user_ids)
+
+    return {user_id: user_name for user_id, user_name in results if user_name}
+
+def plan(members, mappings, user_names, existing, owned, current_roles, managed_roles, delete_orphans):
+    """
+    Compares desired and current state
+    Returns users to create, users whose roles changed, users to delete and counts
+    Users to create are (user ID, user name, roles, mapping missing, exists in the DB)
+    """
+
+    to_create = []
+    to_update = []
+    to_delete = []
+    counts = {'members': len(members), 'mapped': len(mappings), 'in_sync': 0,
+              'unmanaged': 0, 'not_found': 0, 'create': 0, 'update': 0, 'delete': 0}
+
+    for user_id, roles in members.items():
+        # Managed user, recreate in the DB if missing
+        if user_id in mappings:
+            user_name = mappings[user_id]
+            if user_name in existing:
+                current = current_roles.get(user_name, set()) & managed_roles
+                if current == set(roles):
+                    counts['in_sync'] += 1
+                else:
+                    to_update.append((user_id, user_name, roles, current))
+            else:
+                to_create.append((user_id, user_name, roles, False, False))
+            continue
+
+        user_name = user_names.get(user_id)
+
+        # User is not in Identity Store anymore
+        if user_name is None:
+            counts['not_found'] += 1
+        # Created by this solution, but the mapping wasn't saved
+        elif user_name in owned:
+            to_create.append((user_id, user_name, roles, True, True))
+        # User exists but not managed, don't modify it
+        elif user_name in existing:
+            logger.warning("User %s already exists in the database, but not managed. Skipping", user_name)
+            counts['unmanaged'] += 1
+        else:
+            to_create.append((user_id, user_name, roles, True, False))
+
+    # Managed users that aren't members of any configured group anymore
+    if delete_orphans:
+        to_delete = [
+            (user_id, user_name, user_name in existing)
+            for user_id, user_name in mappings.items()
+            if user_id not in members
+        ]
+
+    counts['create'] = len(to_create)
+    counts['update'] = len(to_update)
+    counts['delete'] = len(to_delete)
+
+    return to_create, to_update, to_delete, counts
+
+def apply(to_create, to_update, to_delete, ddb_table):
+    """
+    Applies the delta in chunks with bounded concurrency
+    Returns list of failed user IDs
+    """
+
+    tasks = [(create_chunk, chunk) for chunk in chunks(to_create, CHUNK_SIZE)]
+    tasks += [(update_chunk, chunk) for chunk in chunks(to_update, CHUNK_SIZE)]
+    tasks += [(delete_chunk, chunk) for chunk in chunks(to_delete, CHUNK_SIZE)]
+    connections = []
+
+    def run(task):
+        func, chunk = task
+        if not hasattr(THREAD_LOCAL, 'db_conn'):
+            THREAD_LOCAL.db_conn = connection_manager.ManagedConnection()
+            connections.append(THREAD_LOCAL.db_conn)
+        try:
+            func(chunk, THREAD_LOCAL.db_conn.executor(), ddb_table)
+            return []
+        except Exception as err:
+            logger.error("Failed to apply %s for %d users", func.__name__, len(chunk))
+            logger.error(err)
+            return [item[0] for item in chunk]
+        finally:
+            # Pooled connections are shared by the workers
+            THREAD_LOCAL.db_conn.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+            results = list(pool.map(run, tasks))
+    finally:
+        for db_conn in connections:
+            db_conn.close()
+
+    return [user_id for failed in results for user_id in failed]
+
+def reconcile_memberships(memberships, group_ids, failed, member_table):
+    """
+    Replaces the recorded group memberships of the reconciled groups with the current ones
+    Memberships of other groups and of the failed users are left as they are
+    Returns dict of added and removed counts
+    """
+
+    current = {
+        membership for membership in mapping_store.scan_memberships(member_table) if membership[0] in group_ids
+    }
+    to_add = [membership for membership in memberships - current if membership[1] not in failed]
+    to_remove = [membership for membership in current - memberships if membership[1] not in failed]
+
+    mapping_store.put_memberships(member_table, to_add)
+    mapping_store.delete_memberships(member_table, to_remove)
+
+    return {'added': len(to_add), 'removed': len(to_remove)}
+
+def create_chunk(chunk, executor, ddb_table):
+    """
+    Creates users, grants roles and saves missing mappings
+    Drops the created users if the mappings can't be saved
+    """
+
+    pairs = [(user_name, role) for _, user_name, roles, _, _ in chunk for role in roles]
+    new_users = [user_name for _, user_name, _, _, exists in chunk if not exists]
+
+    try:
+        executor.provision_batch(pairs, friendly_name="provision users", new_users=new_users)
+    except Exception as err:
+        # Only the users this call created are dropped, on PostgreSQL the transaction was rolled back
+        executor.drop_batch(getattr(err, 'created', []), friendly_name="drop users")
+        raise
+
+    mappings = {user_id: user_name for user_id, user_name, _, new, _ in chunk if new}
+
+    try:
+        mapping_store.put_mappings(ddb_table, mappings)
+    except Exception:
+        executor.drop_batch(list(mappings.values()), friendly_name="drop users")
+        raise
+
+def update_chunk(chunk, executor, ddb_table):
+    """
+    Grants missing roles and revokes stale ones with batched statements
+    Current roles are already limited to the configured groups, so other grants are kept
+    """
+
+    desired = {user_name: set(roles) for _, user_name, roles, _ in chunk}
+    current = {user_name: current for _, user_name, _, current in chunk}
+    grants, revokes = executor.apply_roles(desired, friendly_name="sync roles", current=current)
+    logger.info("Granted %d and revoked %d roles", len(grants), len(revokes))
+
+def delete_chunk(chunk, executor, ddb_table):
+    """
+    Drops users that still exist in the DB and deletes their mappings
+    """
+
+    executor.drop_batch(
+        [user_name for _, user_name, exists in chunk if exists], friendly_name="drop users"
+    )
+    mapping_store.delete_mappings(ddb_table, [user_id for user_id, _, _ in chunk])
+
+def elapsed(started):
+    return round(time.perf_counter() - started, 3)
@@ -1,18 +1,52 @@
 import os
+import re
+import time
+import hashlib
 import logging
-import boto3
+import aws_clients
+import metrics
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Optional DynamoDB table of failure signatures, with TTL enabled on expiresAt
+# Every failure is sent immediately if not configured
+DIGEST_TABLE = os.environ.get('DIGEST_TABLE')
+# Repeated failures with the same signature are sent once per window as a digest
+DIGEST_WINDOW = int(os.environ.get('DIGEST_WINDOW', '900'))
+DIGEST_SAMPLE_SIZE = int(os.environ.get('DIGEST_SAMPLE_SIZE', '10'))
+
+# Parts of error messages that differ between otherwise identical failures
+NORMALIZE_PATTERNS = [
+    (re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', re.IGNORECASE), '<id>'),
+    (re.compile(r"'[^']*'|\"[^\"]*\"|`[^`]*`"), '<str>'),
+    (re.compile(r'\b\d+(\.\d+)*\b'), '<n>'),
+]
+
+SUBJ_FAILURE = "SSO to RDS user sync failed"
+SUBJ_DIGEST = "SSO to RDS user sync failures digest"
+
+TABLE = None
+
+@metrics.instrument_handler
 def handler(event, context):
     """Handler function, entry point for Lambda"""
 
+    # Scheduled invocation sends digests of the failures no other failure has flushed
+    if event.get('flush_digests'):
+        flush_digests()
+        return
+
     logger.info("Received new event")
     event_name = function_status_code = function_error = ""
+    function_name = user_id = None
 
     try:
-        event_name = event['requestPayload']['detail']['eventName']
+        details = event['requestPayload']['detail']
+        # Original IAM Identity Center events have eventName, forwarded events event_type
+        event_name = details.get('eventName') or details.get('event_type', '')
+        user_id = details.get('user_id')
+        function_name = get_function_name(event)
         function_error = event['responseContext']['functionError']
         function_status_code = event['responseContext']['statusCode']
         error_message = event['responsePayload']['errorMessage']
@@ -20,15 +54,40 @@ def handler(event, context):
         logger.error("Failed to parse the message. Sending full event details")
         logger.error(event)
         error_message = f"Failed to parse event details. The full event is provided below:\n\n{event}"
+        send_sns_message(format_failure(event_name, function_error, function_status_code, error_message), SUBJ_FAILURE)
+        return
     except Exception as err:
         logger.error("Unexpected error when parsing the event")
         logger.error(err)
         raise
 
-    subj_failure = "SSO to RDS user sync failed"
-    msg = f"""\
+    msg = format_failure(event_name, function_error, function_status_code, error_message)
+    signature = get_signature(function_name, event_name, error_message)
+
+    try:
+        previous = record_failure(signature, function_name, event_name, error_message, user_id)
+    except Exception as err:
+        logger.warning("Failed to record the failure, sending it immediately")
+        logger.warning(err)
+        send_sns_message(msg, SUBJ_FAILURE)
+        return
+
+    if previous is None or (previous and 'lastSent' not in previous):
+        # Digests disabled or first occurrence of the signature
+        send_sns_message(msg, SUBJ_FAILURE)
+    elif previous:
+        send_sns_message(format_digest(previous), SUBJ_DIGEST)
+    else:
+        logger.info("Failure %s was already notified in this window", signature)
+
+def format_failure(event_name, function_error, function_status_code, error_message):
+    """
+    Returns notification text of a single failure
+    """
+
+    return f"""\
     Lamda function failed when synchronizing SSO users to RDS.
-    
+
     Event name: {event_name}
     Function error: {function_error}
     Status code: {function_status_code}
@@ -38,8 +97,161 @@ def handler(event, context):
     Check the Lambda function logs to find out more
     """
 
-    send_sns_message(msg, subj_failure)
+def format_digest(item):
+    """
+    Returns notification text of the failures grouped under one signature
+    """
+
+    if 'lastSent' in item:
+        since = time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(int(item['lastSent'])))
+        count = f"Failures since {since}: {int(item['pendingCount'])}"
+    else:
+        count = f"Failures: {int(item['pendingCount'])}"
+    samples = ', '.join(sorted(item.get('sampleUserIds', []))) or 'none'
+
+    return f"""\
+    Lamda function kept failing when synchronizing SSO users to RDS.
+
+    Function: {item.get('functionName')}
+    Event name: {item.get('eventName')}
+    {count}
+    Sample user IDs: {samples}
+
+    {item.get('errorMessage')}
+
+    Check the Lambda function logs to find out more
+    """
+
+def get_function_name(event):
+    """
+    Returns name of the failed function from the destination record
+    """
+
+    function_arn = event.get('requestContext', {}).get('functionArn', '')
+    # arn:aws:lambda:region:account:function:name:version
+    parts = function_arn.split(':')
+    return parts[6] if len(parts) > 6 else function_arn
+
+def get_signature(function_name, event_name, error_message):
+    """
+    Returns hash of the function, event name and error message without IDs, names and numbers
+    """
+
+    message = error_message
+    for pattern, replacement in NORMALIZE_PATTERNS:
+        message = pattern.sub(replacement, message)
+
+    payload = '\n'.join([function_name or '', event_name or '', message])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+def get_table():
+    """
+    Returns DynamoDB digest table if configured
+    Returns None otherwise
+    """
+
+    global TABLE
+
+    if DIGEST_TABLE and TABLE is None:
+        ddb_res = aws_clients.get_resource(
+            'dynamodb', connect_timeout=3, read_timeout=3, retries={'max_attempts': 0}
+        )
+        TABLE = ddb_res.Table(DIGEST_TABLE)
+
+    return TABLE
+
+def record_failure(signature, function_name, event_name, error_message, user_id):
+    """
+    Counts the failure under its signature and claims the notification if the window has passed
+    Returns None if the digest table isn't configured
+    Returns the signature item before the claim if a notification should be sent, {} otherwise
+    """
+
+    table = get_table()
+    if table is None:
+        return None
+
+    now = int(time.time())
+    values = {
+        ':one': 1, ':expires': now + 2 * DIGEST_WINDOW, ':function': function_name,
+        ':event': event_name, ':message': error_message,
+    }
+    counters = 'pendingCount :one'
+    attributes = 'expiresAt = :expires, functionName = :function, eventName = :event, errorMessage = :message'
+
+    if user_id:
+        try:
+            # Samples are kept small, later failures are only counted
+            table.update_item(
+                Key={'signature': signature},
+                UpdateExpression=f"ADD {counters}, sampleUserIds :sample SET {attributes}",
+                ConditionExpression='attribute_not_exists(sampleUserIds) OR size(sampleUserIds) < :max',
+                ExpressionAttributeValues={**values, ':sample': {user_id}, ':max': DIGEST_SAMPLE_SIZE},
+            )
+            return claim_notification(table, signature, now)
+        except Exception as err:
+            if getattr(err, 'response', {}).get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                raise
+
+    table.update_item(
+        Key={'signature': signature},
+        UpdateExpression=f"ADD {counters} SET {attributes}",
+        ExpressionAttributeValues=values,
+    )
+    return claim_notification(table, signature, now)
+
+def claim_notification(table, signature, now):
+    """
+    Resets the counters if the window has passed, the update is atomic so only one invocation sends
+    Returns the item before the reset, or {} if another notification was sent in the window
+    """
+
+    try:
+        resp = table.update_item(
+            Key={'signature': signature},
+            UpdateExpression='SET lastSent = :now, pendingCount = :zero REMOVE sampleUserIds',
+            ConditionExpression='pendingCount > :zero AND (attribute_not_exists(lastSent) OR lastSent <= :cutoff)',
+            ExpressionAttributeValues={':now': now, ':zero': 0, ':cutoff': now - DIGEST_WINDOW},
+            ReturnValues='ALL_OLD',
+        )
+    except Exception as err:
+        if getattr(err, 'response', {}).get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+            return {}
+        raise
+
+    return resp.get('Attributes', {})
+
+def flush_digests():
+    """
+    Sends digests of the signatures with failures pending for longer than the window
+    """
+
+    table = get_table()
+    if table is None:
+        logger.warning("No digest table configured. Exiting")
+        return
+
+    now = int(time.time())
+    kwargs = {}
+    sent = 0
+
+    while True:
+        resp = table.scan(**kwargs)
+
+        for item in resp.get('Items', []):
+            if not item.get('pendingCount') or int(item.get('lastSent', 0)) > now - DIGEST_WINDOW:
+                continue
+
+            previous = claim_notification(table, item['signature'], now)
+            if previous:
+                send_sns_message(format_digest(previous), SUBJ_DIGEST)
+                sent += 1
+
+        if 'LastEvaluatedKey' not in resp:
+            break
+        kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
 
+    logger.info("Sent %d failure digests", sent)
 
 def send_sns_message(msg, subj):
     """
@@ -53,7 +265,7 @@ def send_sns_message(msg, subj):
         logger.warning("No SNS ARN configured. Exiting")
         return
 
-    client = boto3.client('sns')
+    client = aws_clients.get_client('sns')
     try:
         client.publish(TopicArn=sns_arn, Message=msg, Subject=subj)
     except Exception as err:
@@ -0,0 +1,179 @@
+import os
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import coalescer
+import connection_manager
+import idempotency
+import metrics
+import user_sync
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Number of users synchronized in parallel
+CONCURRENCY = int(os.environ.get('SYNC_CONCURRENCY', '4'))
+
+# Worker threads and their DB connections are kept across warm invocations
+POOL = ThreadPoolExecutor(max_workers=CONCURRENCY)
+# One set of DB connections per worker thread, DB-API connections aren't thread-safe
+THREAD_LOCAL = threading.local()
+DDB_TABLE = None
+MEMBER_TABLE = None
+
+@metrics.instrument_handler
+@connection_manager.release_connections
+def handler(event, context):
+    """
+    Handler function, entry point for Lambda
+    Buffers create and delete events from SQS and applies only the net change of every user
+    Users are synchronized in parallel, events of the same user in order
+    Deleted groups are offboarded after the changes of the batch
+    Returns partial batch response listing the failed record IDs
+    """
+
+    global DDB_TABLE, MEMBER_TABLE
+
+    failed = []
+    events = []
+    group_deletes = []
+
+    for record in event.get('Records', []):
+        record_id = record.get('messageId')
+        try:
+            body = json.loads(record['body'])
+            # Group deletes carry no user, they're applied as a whole
+            if body['detail'].get('event_type') == 'DeleteGroup':
+                group_id = body['detail']['group_id']
+                key = idempotency.get_event_key('sync', body, [group_id, 'DeleteGroup'])
+                if not idempotency.is_processed(key):
+                    group_deletes.append((record_id, group_id, key))
+                continue
+            parsed = coalescer.parse_event(body)
+        except Exception as err:
+            logger.error("Failed to parse record %s", record_id)
+            logger.error(err)
+            failed.append(record_id)
+            continue
+
+        parsed['key'] = idempotency.get_event_key('sync', body, [parsed['user_id'], parsed['event_type']])
+        if idempotency.is_processed(parsed['key']):
+            logger.info("Event %s was already processed, skipping", body.get('id'))
+            continue
+
+        events.append((record_id, parsed))
+
+    changes = coalescer.coalesce(skip_stale(events))
+
+    # Init DynamoDB tables if don't exist
+    if (changes or group_deletes) and DDB_TABLE is None:
+        DDB_TABLE = connection_manager.get_ddb_table()
+        MEMBER_TABLE = connection_manager.get_member_table()
+
+    if changes:
+        results = POOL.map(lambda change: apply_change(change, DDB_TABLE, MEMBER_TABLE), changes)
+
+        for change, success in zip(changes, results):
+            # All events of the user are retried together to keep them in order
+            if not success:
+                failed += change['record_ids']
+            else:
+                idempotency.set_applied_time(change['user_id'], change['time'])
+
+    for record_id, group_id, key in group_deletes:
+        if apply_group_delete(group_id, DDB_TABLE, MEMBER_TABLE):
+            idempotency.complete(key, shared=False)
+        else:
+            failed.append(record_id)
+
+    # Processed events are remembered by this container only, the function runs with a concurrency of one
+    for record_id, parsed in events:
+        if record_id not in failed:
+            idempotency.complete(parsed['key'], shared=False)
+
+    logger.info(
+        "Processed %d events for %d users, %d records failed", len(events), len(changes), len(failed)
+    )
+
+    return {"batchItemFailures": [{"itemIdentifier": record_id} for record_id in failed]}
+
+def skip_stale(events) -> list:
+    """
+    Drops events older than the latest applied event of their user
+    A failed event is retried after the visibility timeout, when later batches might have applied newer events
+    Returns the remaining (record_id, parsed event) in delivery order
+    """
+
+    user_ids = list(dict.fromkeys(event['user_id'] for _, event in events))
+    applied = dict(zip(user_ids, POOL.map(idempotency.get_applied_time, user_ids)))
+
+    current = []
+    for record_id, event in events:
+        if event['time'] and event['time'] < applied[event['user_id']]:
+            logger.warning(
+                "Skipping %s event of user ID %s from %s, a newer event was already applied",
+                event['event_type'], event['user_id'], event['time']
+            )
+            continue
+        current.append((record_id, event))
+
+    return current
+
+def get_db_conn():
+    """
+    Returns DB connections of the current thread
+    """
+
+    if not hasattr(THREAD_LOCAL, 'db_conn'):
+        THREAD_LOCAL.db_conn = connection_manager.ClusterConnections()
+
+    return THREAD_LOCAL.db_conn
+
+def apply_change(change, ddb_table, member_table):
+    """
+    Drops the user if the net change starts with a delete, then grants the remaining roles
+    Returns True if successful
+    """
+
+    db_conn = get_db_conn()
+
+    try:
+        if change['delete']:
+            logger.info("Deleting user ID %s", change['user_id'])
+            user_sync.delete_user(change['user_id'], change['delete'], ddb_table, db_conn.executor, member_table)
+
+        if change['roles']:
+            # All roles are granted in one round trip
+            user_sync.sync_user(
+                change['user_name'], change['user_id'], change['roles'], db_conn.executor(), ddb_table,
+                group_ids=change['group_ids'], member_table=member_table
+            )
+    except Exception as err:
+        logger.error("Failed to synchronize user ID %s", change['user_id'])
+        logger.error(err)
+        return False
+    finally:
+        # Pooled connections are shared by the worker threads
+        db_conn.release()
+
+    return True
+
+def apply_group_delete(group_id, ddb_table, member_table):
+    """
+    Deletes all recorded members of the deleted group
+    Returns True if successful
+    """
+
+    db_conn = get_db_conn()
+
+    try:
+        user_sync.delete_group(group_id, ddb_table, member_table, db_conn.executor)
+    except Exception as err:
+        logger.error("Failed to delete members of group %s", group_id)
+        logger.error(err)
+        return False
+    finally:
+        db_conn.release()
+
+    return True
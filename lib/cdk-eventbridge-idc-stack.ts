@@ -2,6 +2,7 @@ import * as path from "path";
 import * as cdk from "aws-cdk-lib";
 import * as iam from "aws-cdk-lib/aws-iam";
 import * as lambda from "aws-cdk-lib/aws-lambda";
+import { PythonLayerVersion } from "@aws-cdk/aws-lambda-python-alpha";
 import * as events_targets from "aws-cdk-lib/aws-events-targets";
 import { Queue } from "aws-cdk-lib/aws-sqs";
 import { Construct } from "constructs";
@@ -116,6 +117,29 @@ export class EventBridgeSSOLambda extends cdk.Stack {
       },
     );
 
+    // Default bus rule to match delete IAM Identity Center group events
+    const deleteSSOGroupRule = new Rule(this, "DeleteGroupRule", {
+      description:
+        "Deletes RDS users of all members when an IAM Identity Center group is deleted",
+      eventPattern: {
+        source: ["aws.sso-directory"],
+        detail: {
+          eventSource: ["sso-directory.amazonaws.com"],
+          eventName: ["DeleteGroup"],
+          requestParameters: {
+            groupId: groupIDs, // Only matches a specific set of groups
+          },
+        },
+      },
+      eventBus: defaultBus,
+    });
+
+    // Lambda layer with shared AWS clients for python Functions
+    const coreLayer = new PythonLayerVersion(this, "PL", {
+      entry: path.join(__dirname, "../functions/layer"),
+      compatibleRuntimes: [Runtime.PYTHON_3_12],
+    });
+
     // Lambda function triggered by a IAM IdC user creation
     const forwardCreateFunction: lambda.Function = new lambda.Function(
       this,
@@ -125,6 +149,7 @@ export class EventBridgeSSOLambda extends cdk.Stack {
         timeout: Duration.seconds(10),
         runtime: Runtime.PYTHON_3_12,
         handler: "handler.handler",
+        layers: [coreLayer],
         code: lambda.Code.fromAsset(
           path.join(__dirname, "../functions/forward-create-event"),
         ),
@@ -144,6 +169,7 @@ export class EventBridgeSSOLambda extends cdk.Stack {
         timeout: Duration.seconds(10),
         runtime: Runtime.PYTHON_3_12,
         handler: "handler.handler",
+        layers: [coreLayer],
         code: lambda.Code.fromAsset(
           path.join(__dirname, "../functions/forward-delete-event"),
         ),
@@ -186,6 +212,7 @@ export class EventBridgeSSOLambda extends cdk.Stack {
     createSSOUserRule.addTarget(forwardCreateFuncTarget);
     deleteSSOUserRule.addTarget(forwardDeleteFuncTarget);
     removeSSOUserFromGroupoRule.addTarget(forwardDeleteFuncTarget);
+    deleteSSOGroupRule.addTarget(forwardDeleteFuncTarget);
 
     // Allow Lambda to put events
     ssoBus.grantPutEventsTo(forwardCreateFunction);
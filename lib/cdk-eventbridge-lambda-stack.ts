@@ -2,6 +2,8 @@ import * as path from 'path';
 import * as cdk from 'aws-cdk-lib';
 import * as iam from 'aws-cdk-lib/aws-iam';
 import * as lambda from 'aws-cdk-lib/aws-lambda';
+import { SqsEventSource } from 'aws-cdk-lib/aws-lambda-event-sources';
+import { Queue } from 'aws-cdk-lib/aws-sqs';
 import { PythonLayerVersion } from '@aws-cdk/aws-lambda-python-alpha';
 import * as events_targets from 'aws-cdk-lib/aws-events-targets';
 import * as dynamodb from 'aws-cdk-lib/aws-dynamodb';
@@ -31,6 +33,18 @@ export class NewSSOUserToRDS extends cdk.Stack {
     // IDC account to allow creating events in RDS account
     const idcAccountID = context.IDC_ACCOUNT_ID;
 
+    // Optional buffering window to coalesce events of the same user, disabled if not set
+    const coalesceWindow = context.COALESCE_WINDOW_SECONDS;
+
+    // Optional RDS Proxy endpoint and driver pool size, the functions connect directly without a pool if not set
+    const dbConnectionEnv: { [key: string]: string } = {};
+    if (context.RDS_PROXY_EP) {
+      dbConnectionEnv.RDS_PROXY_EP = context.RDS_PROXY_EP;
+    }
+    if (context.DB_POOL_SIZE) {
+      dbConnectionEnv.DB_POOL_SIZE = `${context.DB_POOL_SIZE}`;
+    }
+
     // Import values from stack
     const rdsClusterEPAddr = cdk.Fn.importValue('rdsClusterEPAddr');
     const dbSgID = cdk.Fn.importValue('dbSgID');
@@ -90,6 +104,41 @@ export class NewSSOUserToRDS extends cdk.Stack {
       writeCapacity: 2
     });
 
+    /* DynamoDB table to store IDs of processed events
+       EventBridge delivers events at least once, duplicates are skipped before connecting to the DB
+       Expired items are removed by DynamoDB TTL
+    */
+    const idempotencyTable = new dynamodb.Table(this, 'idempotencyTable', {
+      partitionKey: {name: 'idempotencyKey', type: dynamodb.AttributeType.STRING},
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: 'expiresAt'
+    });
+
+    /* DynamoDB table to share the circuit breaker state of the databases
+       When a function finds a database unavailable, the others fail fast instead of waiting to connect
+       Expired items are removed by DynamoDB TTL
+    */
+    const circuitTable = new dynamodb.Table(this, 'circuitTable', {
+      partitionKey: {name: 'circuitName', type: dynamodb.AttributeType.STRING},
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: 'expiresAt'
+    });
+
+    /* DynamoDB table to store group memberships of the managed users
+       DeleteGroup events don't list the members, so they're read from the groupId index
+    */
+    const groupMemberTable = new dynamodb.Table(this, 'groupMemberTable', {
+      partitionKey: {name: 'userID', type: dynamodb.AttributeType.STRING},
+      sortKey: {name: 'groupId', type: dynamodb.AttributeType.STRING},
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST
+    });
+    groupMemberTable.addGlobalSecondaryIndex({
+      indexName: 'groupId-index',
+      partitionKey: {name: 'groupId', type: dynamodb.AttributeType.STRING},
+      sortKey: {name: 'userID', type: dynamodb.AttributeType.STRING},
+      projectionType: dynamodb.ProjectionType.KEYS_ONLY
+    });
+
     // Lambda layer with boto3 and db clients for python Function
     const coreLayer = new PythonLayerVersion(this, "PL", {
       entry: path.join(__dirname, '../functions/layer'),
@@ -117,6 +166,10 @@ export class NewSSOUserToRDS extends cdk.Stack {
         RDS_DB_PORT: rdsDBPort,
         RDS_DB_ENGINE: rdsEngine,
         DDB_TABLE: rdsUserTable.tableName,
+        GROUP_MEMBER_TABLE: groupMemberTable.tableName,
+        IDEMPOTENCY_TABLE: idempotencyTable.tableName,
+        CIRCUIT_TABLE: circuitTable.tableName,
+        ...dbConnectionEnv,
       },
       code: lambda.Code.fromAsset(path.join(__dirname, '../functions/create-user-function'))
     });
@@ -128,7 +181,8 @@ export class NewSSOUserToRDS extends cdk.Stack {
     */
     const deleteRDSUserFunction: lambda.Function = new lambda.Function(this, 'deleteRDSUserFunction', {
         memorySize: 128,
-        timeout: Duration.seconds(10),
+        // Deleting a group offboards all of its members in one invocation
+        timeout: Duration.seconds(60),
         runtime: Runtime.PYTHON_3_12,
         handler: 'handler.handler',
         vpc: lambdaVPC,
@@ -142,6 +196,10 @@ export class NewSSOUserToRDS extends cdk.Stack {
           RDS_DB_PORT: rdsDBPort,
           RDS_DB_ENGINE: rdsEngine,
           DDB_TABLE: rdsUserTable.tableName,
+          GROUP_MEMBER_TABLE: groupMemberTable.tableName,
+          IDEMPOTENCY_TABLE: idempotencyTable.tableName,
+          CIRCUIT_TABLE: circuitTable.tableName,
+          ...dbConnectionEnv,
         },
         code: lambda.Code.fromAsset(path.join(__dirname, '../functions/delete-user-function'))
       });
@@ -150,10 +208,20 @@ export class NewSSOUserToRDS extends cdk.Stack {
     const actions = [
       'dynamodb:PutItem',
       'dynamodb:GetItem',
-      'dynamodb:DeleteItem'
+      'dynamodb:DeleteItem',
+      'dynamodb:BatchGetItem',
+      'dynamodb:BatchWriteItem'
     ];
     rdsUserTable.grant(createRDSUserFunction, ...actions);
     rdsUserTable.grant(deleteRDSUserFunction, ...actions);
+    // Memberships are written on create, read from the index and deleted on delete
+    const memberActions = ['dynamodb:Query', 'dynamodb:BatchWriteItem'];
+    groupMemberTable.grant(createRDSUserFunction, ...memberActions);
+    groupMemberTable.grant(deleteRDSUserFunction, ...memberActions);
+    idempotencyTable.grant(createRDSUserFunction, 'dynamodb:PutItem', 'dynamodb:GetItem', 'dynamodb:DeleteItem');
+    idempotencyTable.grant(deleteRDSUserFunction, 'dynamodb:PutItem', 'dynamodb:GetItem', 'dynamodb:DeleteItem');
+    circuitTable.grant(createRDSUserFunction, 'dynamodb:PutItem', 'dynamodb:GetItem', 'dynamodb:DeleteItem');
+    circuitTable.grant(deleteRDSUserFunction, 'dynamodb:PutItem', 'dynamodb:GetItem', 'dynamodb:DeleteItem');
 
     /* Policy for Lambda to connect to the DB
        RDS must have preconfigured IAM Authentication and user
@@ -195,10 +263,81 @@ export class NewSSOUserToRDS extends cdk.Stack {
       eventBus: ssoBus,
     });
 
-    // Add Lambda Functions as targets to the respective EventBridge Rules
-    const deleteFunctionTarget = new events_targets.LambdaFunction(deleteRDSUserFunction);
-    createSSOUserRule.addTarget(new events_targets.LambdaFunction(createRDSUserFunction));
-    deleteSSOUserRule.addTarget(deleteFunctionTarget);
+    if (coalesceWindow) {
+      // Events that failed all retries
+      const syncDLQ = new Queue(this, 'syncUserDLQ', {
+        queueName: 'SSO-RDS-Sync-User-DLQ'
+      });
+
+      /* Queue buffering create and delete events for the coalescing window
+         EventBridge can't set a message group per user, so a standard queue is used
+         and events of a user are ordered by event time
+         The function has a single concurrent execution, so the SQS pollers are throttled during bursts
+         and every throttled receive counts towards maxReceiveCount without processing the message
+         A high count keeps bursts out of the DLQ, at the cost of a failing event being retried
+         for hours (count times visibility timeout) before it's moved to the DLQ
+      */
+      const syncQueue = new Queue(this, 'syncUserQueue', {
+        queueName: 'SSO-RDS-Sync-User',
+        // At least 6 times the function timeout, as recommended for SQS event sources
+        visibilityTimeout: Duration.seconds(720),
+        deadLetterQueue: {
+          queue: syncDLQ,
+          maxReceiveCount: 50
+        }
+      });
+
+      /* Lambda function triggered by the buffered events
+         Applies only the net change of every user
+         Single concurrent execution, so events of a user are never applied in parallel
+         Deleted groups are offboarded in the same invocation as the changes of up to 100 users
+      */
+      const syncRDSUserFunction: lambda.Function = new lambda.Function(this, 'syncRDSUserFunction', {
+        memorySize: 128,
+        timeout: Duration.seconds(120),
+        reservedConcurrentExecutions: 1,
+        runtime: Runtime.PYTHON_3_12,
+        handler: 'handler.handler',
+        vpc: lambdaVPC,
+        allowPublicSubnet: true, // Not needed with private subnets
+        securityGroups: [lambdaSG],
+        layers: [coreLayer],
+        environment: {
+          RDS_DB_USER: rdsLambdaDBUser,
+          RDS_DB_EP: rdsClusterEPAddr,
+          RDS_DB_PORT: rdsDBPort,
+          RDS_DB_ENGINE: rdsEngine,
+          DDB_TABLE: rdsUserTable.tableName,
+          GROUP_MEMBER_TABLE: groupMemberTable.tableName,
+          // Keeps the time of the latest applied event of every user, so retried older events are skipped
+          IDEMPOTENCY_TABLE: idempotencyTable.tableName,
+          CIRCUIT_TABLE: circuitTable.tableName,
+          ...dbConnectionEnv,
+        },
+        code: lambda.Code.fromAsset(path.join(__dirname, '../functions/sync-user-function'))
+      });
+
+      syncRDSUserFunction.addEventSource(new SqsEventSource(syncQueue, {
+        batchSize: 100,
+        maxBatchingWindow: Duration.seconds(+coalesceWindow),
+        reportBatchItemFailures: true
+      }));
+
+      rdsUserTable.grant(syncRDSUserFunction, ...actions);
+      groupMemberTable.grant(syncRDSUserFunction, ...memberActions);
+      idempotencyTable.grant(syncRDSUserFunction, 'dynamodb:PutItem', 'dynamodb:GetItem');
+      circuitTable.grant(syncRDSUserFunction, 'dynamodb:PutItem', 'dynamodb:GetItem', 'dynamodb:DeleteItem');
+      syncRDSUserFunction.role?.attachInlinePolicy(rdsConnectIamPolicy);
+
+      // Both rules send events to the same queue
+      createSSOUserRule.addTarget(new events_targets.SqsQueue(syncQueue));
+      deleteSSOUserRule.addTarget(new events_targets.SqsQueue(syncQueue));
+    } else {
+      // Add Lambda Functions as targets to the respective EventBridge Rules
+      const deleteFunctionTarget = new events_targets.LambdaFunction(deleteRDSUserFunction);
+      createSSOUserRule.addTarget(new events_targets.LambdaFunction(createRDSUserFunction));
+      deleteSSOUserRule.addTarget(deleteFunctionTarget);
+    }
 
     // New VPC interface endpoint for Lambda functions to reach IAM Identity Center Store
     const vpeIDC = new InterfaceVpcEndpoint(this, 'VpcEpIDC', {
@@ -2,6 +2,10 @@ import * as path from 'path';
 import * as sns from 'aws-cdk-lib/aws-sns';
 import * as cdk from 'aws-cdk-lib';
 import * as lambda from 'aws-cdk-lib/aws-lambda';
+import * as dynamodb from 'aws-cdk-lib/aws-dynamodb';
+import * as events_targets from 'aws-cdk-lib/aws-events-targets';
+import { Rule, RuleTargetInput, Schedule } from 'aws-cdk-lib/aws-events';
+import { PythonLayerVersion } from '@aws-cdk/aws-lambda-python-alpha';
 import * as iam from 'aws-cdk-lib/aws-iam';
 import { EmailSubscription } from 'aws-cdk-lib/aws-sns-subscriptions';
 import { Construct } from 'constructs';
@@ -25,14 +29,36 @@ export class LambdaSNSFailureNotification extends cdk.Stack {
         new EmailSubscription(props.email)
       );
 
+      // Lambda layer with shared AWS clients for python Function
+      const coreLayer = new PythonLayerVersion(this, "PL", {
+        entry: path.join(__dirname, '../functions/layer'),
+        compatibleRuntimes: [Runtime.PYTHON_3_12]
+      });
+
+      /* DynamoDB table to count failures by error signature
+         Repeated failures are sent as one digest per window instead of one e-mail each
+         Expired items are removed by DynamoDB TTL
+      */
+      const digestTable = new dynamodb.Table(this, 'failureDigestTable', {
+        partitionKey: {name: 'signature', type: dynamodb.AttributeType.STRING},
+        billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+        timeToLiveAttribute: 'expiresAt'
+      });
+
+      // Failures with the same signature are notified once per window (seconds)
+      const digestWindow = 900;
+
       // Lambda function formats message to be human-readable and sends it to a SNS topic
       const notifyFailure: lambda.Function = new lambda.Function(this, 'notifyFailureFunction', {
         memorySize: 128,
         timeout: Duration.seconds(10),
         runtime: Runtime.PYTHON_3_12,
         handler: 'handler.handler',
+        layers: [coreLayer],
         environment: {
           SNS_ARN: topic.topicArn,
+          DIGEST_TABLE: digestTable.tableName,
+          DIGEST_WINDOW: `${digestWindow}`,
         },
         code: lambda.Code.fromAsset(path.join(__dirname, '../functions/sns-notify-function'))
       });
@@ -54,6 +80,18 @@ export class LambdaSNSFailureNotification extends cdk.Stack {
         })
       );
 
+      // Grant Lambda function access to the digest table
+      digestTable.grant(notifyFailure, 'dynamodb:UpdateItem', 'dynamodb:Scan');
+
+      // Sends digests of the failures that didn't repeat after the window
+      new Rule(this, 'FlushFailureDigests', {
+        description: 'Sends digests of pending SSO to RDS sync failures',
+        schedule: Schedule.rate(Duration.seconds(digestWindow)),
+        targets: [new events_targets.LambdaFunction(notifyFailure, {
+          event: RuleTargetInput.fromObject({flush_digests: true})
+        })]
+      });
+
       this.notifyFailureDest = new LambdaDestination(notifyFailure);
 
     }